@@ -1,10 +1,13 @@
-import cdsapi, sys, os, time
+import sys, os, copy
 from pathlib import Path
+from ERA5_request_queue import requestQueue, cdsClient
+from ERA5_download_check import downloadManifest
 
 # https://cds.climate.copernicus.eu/how-to-api
 # Input argument order:
 # [0] script; [1] start year; [2] end year; [3] start month; [4] end month
 #   [5] latitude; [6] longitude [7] output path [8] single variable [9] ERA5 dataset
+#   [10] (optional) maximum number of requests in the CDS queue at once
 
 month_default = list(("01", "02", "03",
                     "04", "05", "06",
@@ -91,44 +94,39 @@ mnth_rng = list(range(mnth_st,mnth_end+1))
 
 
 
-#client = cdsapi.Client()
-client = cdsapi.Client(wait_until_complete=False, delete=False)
+out_pth = Path(str(sys.argv[7])) if len(sys.argv)>7 else Path('.')
+# Optional [10] maximum number of requests queued at the CDS at once
+max_in_flight = int(sys.argv[10]) if len(sys.argv)>10 else 8
+
 request["area"] = [lat_1+resolution, lon_1-resolution, lat_2-resolution, lon_2+resolution]
 
+# Submit every (variable, year) request up front and download each one as soon as it is ready
+# The queue state is kept in the output folder, so re-running after an interruption resumes the same requests
+# Files are validated before being renamed into place, and recorded in a manifest so damaged files are re-fetched
+manifest = downloadManifest(out_pth)
+queue = requestQueue(cdsClient(), str(out_pth / 'era5_request_queue.json'), maxInFlight=max_in_flight, manifest=manifest)
+
 for i in range(len(var_str)):
     variable = var_str[i]
     for j in range(len(year_rng)):
         year = str(year_rng[j])
         
-        if j==0:
-            month = list(range(mnth_st,13))
-            month = [str(x) for x in month]
-        elif j==(len(year_rng)-1):
-            month = list(range(1,mnth_end+1))
-            month = [str(x) for x in month]
-        else:
-            month = list(range(1,13))
-            month = [str(x) for x in month]
+        # First and last year can be partial
+        first_month = mnth_st if j==0 else 1
+        last_month = mnth_end if j==(len(year_rng)-1) else 12
+        month = [str(x) for x in range(first_month,last_month+1)]
         
-        #month = str(mnth_rng[k])
         filename = "{v}_{y}.nc".format(v=variable, y=year)
-        out_pth = Path(str(sys.argv[7]))
         target = os.path.join(out_pth, filename)
-        request["variable"] = variable
-        request["month"] = month
-        request["year"] = year
         
-        fileExists = os.path.isfile(target)
+        job_request = copy.deepcopy(request)
+        job_request["variable"] = variable
+        job_request["month"] = month
+        job_request["year"] = year
         
-        if not fileExists:
-            print(f"\nStarting download for {filename} -> {target}")
-            result = client.retrieve(dataset, request)
-            
-            try:
-                result.download(target)
-                print(f"\nFinished download for {filename}")
-                time.sleep(1)
-            except:
-                print(f"\nNo data found for {filename} or API error")
+        if not manifest.is_complete(target, dataset, job_request):
+            queue.add(filename, dataset, job_request, target)
         else:
             print(f"\n{target} already exits.")
+
+queue.run()
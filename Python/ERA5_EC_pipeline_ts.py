@@ -1,10 +1,13 @@
-import cdsapi, sys, os, time
+import sys, os, copy
 from pathlib import Path
+from ERA5_request_queue import requestQueue, cdsClient
+from ERA5_download_check import downloadManifest
 
 # https://cds.climate.copernicus.eu/how-to-api
 # Input argument order:
 # [0] script; [1] start date; [2] end date; [3] latitude;
 #    [4] longitude [5] output path
+#    [6] (optional) maximum number of requests in the CDS queue at once
 
 # Variable names
 var_str = list(("2m_dewpoint_temperature",
@@ -33,8 +36,15 @@ request = {
     "data_format": "netcdf"
 }
 
-#client = cdsapi.Client()
-client = cdsapi.Client(wait_until_complete=False, delete=False)
+out_pth = Path(str(sys.argv[5])) if len(sys.argv)>5 else Path('.')
+# Optional [6] maximum number of requests in the CDS queue at once
+max_in_flight = int(sys.argv[6]) if len(sys.argv)>6 else 8
+
+# Requests for all variables are submitted up front and downloaded as soon as each is ready
+# The queue state is kept in the output folder, so re-running after an interruption resumes the same requests
+# Files are validated before being renamed into place, and recorded in a manifest so damaged files are re-fetched
+manifest = downloadManifest(out_pth)
+queue = requestQueue(cdsClient(), str(out_pth / 'era5_request_queue.json'), maxInFlight=max_in_flight, manifest=manifest)
 
 # This could be updated so that all variables are downloaded with one API 
 #   request instead of one per variable, but it works and the rest of the 
@@ -44,24 +54,17 @@ for i in range(len(var_str)):
     variable = var_str[i]
     
     filename = "{v}.zip".format(v=variable)
-    out_pth = Path(str(sys.argv[5]))
     target = os.path.join(out_pth, filename)
-    request["variable"] = variable
-    request["location"]["longitude"] = lon
-    request["location"]["latitude"] = lat
-    request["date"] = date_st + '/' + date_end
             
-    fileExists = os.path.isfile(target)
+    job_request = copy.deepcopy(request)
+    job_request["variable"] = variable
+    job_request["location"]["longitude"] = lon
+    job_request["location"]["latitude"] = lat
+    job_request["date"] = date_st + '/' + date_end
             
-    if not fileExists:
-        print(f"\nStarting download for {filename} -> {target}")
-        result = client.retrieve(dataset, request)
-        
-        try:
-            result.download(target)
-            print(f"\nFinished download for {filename}")
-            time.sleep(1)
-        except:
-            print(f"\nNo data found for {filename} or API error")
+    if not manifest.is_complete(target, dataset, job_request):
+        queue.add(filename, dataset, job_request, target)
     else:
         print(f"\n{target} already exits.")
+
+queue.run()
@@ -0,0 +1,200 @@
+# Atomic, verified ERA5 downloads
+# Intended to be called by the ERA5 scripts, e.g.:
+    # manifest = downloadManifest('path/to/output')
+    # if not manifest.is_complete(target,dataset,request):
+    #     manifest.download(lambda tmp: result.download(tmp),target,dataset,request)
+# Downloads are written to <target>.part and only renamed to <target> once they pass validation:
+    # .nc files must be NetCDF, not truncated (NetCDF4), and if xarray is installed, open and cover the requested time period
+    #   up to the latest published hour: ERA5 is published with a delay, so recent requests are partly filled
+    # .zip files must pass a CRC check of every member
+# Each complete file is recorded in <output>/era5_manifest.json with its request, size and sha256
+# so re-runs skip files that are truly complete and re-fetch those that are damaged or were requested differently
+
+import os
+import json
+import zipfile
+import hashlib
+import threading
+import calendar
+from datetime import datetime, timedelta, timezone
+
+manifestName = 'era5_manifest.json'
+# ERA5 (ERA5T) and ERA5-Land are published about 5 days behind real time, with some slack for delays
+publicationDelay = timedelta(days=7)
+
+# Leading bytes of NetCDF3 (classic/64-bit offset) and NetCDF4 (HDF5) files
+netcdfMagic = [b'CDF\x01',b'CDF\x02',b'\x89HDF\r\n\x1a\n']
+
+class validationError(Exception):
+    pass
+
+def sha256(path,blockSize=2**20):
+    h = hashlib.sha256()
+    with open(path,'rb') as f:
+        for block in iter(lambda: f.read(blockSize),b''):
+            h.update(block)
+    return(h.hexdigest())
+
+def requested_period(request):
+    # First and last hour covered by a request, from "date": "start/end" or "year" and "month" keys
+    if 'date' in request:
+        date = request['date'][0] if isinstance(request['date'],list) else request['date']
+        start,end = date.split('/')
+        return(datetime.fromisoformat(start),datetime.fromisoformat(end).replace(hour=23))
+    if 'year' in request and 'month' in request:
+        years = sorted(int(y) for y in (request['year'] if isinstance(request['year'],list) else [request['year']]))
+        months = sorted(int(m) for m in (request['month'] if isinstance(request['month'],list) else [request['month']]))
+        last_day = calendar.monthrange(years[-1],months[-1])[1]
+        return(datetime(years[0],months[0],1),datetime(years[-1],months[-1],last_day,23))
+    return(None)
+
+def hdf5_truncated(path):
+    # True if the file is shorter than the end of file address in its HDF5 superblock (NetCDF4 files are HDF5)
+    with open(path,'rb') as f:
+        head = f.read(64)
+    version = head[8]
+    if version in [0,1]:
+        offsetSize,base = head[13],(24 if version == 0 else 28)
+    elif version in [2,3]:
+        offsetSize,base = head[9],12
+    else:
+        # Unknown superblock version, can't tell
+        return(False)
+    address = lambda i: int.from_bytes(head[base+i*offsetSize:base+(i+1)*offsetSize],'little')
+    baseAddress,eof = address(0),address(2)
+    # An undefined address (all bits set) is left by a writer that didn't close the file
+    return(eof == 2**(8*offsetSize)-1 or baseAddress+eof > os.path.getsize(path))
+
+def published_until(period):
+    # The last hour of a requested period that can be published by now
+    latest = datetime.now(timezone.utc).replace(tzinfo=None)-publicationDelay
+    return(min(period[1],latest.replace(minute=0,second=0,microsecond=0)))
+
+def validate_netcdf(path,request=None):
+    with open(path,'rb') as f:
+        head = f.read(8)
+    if not any(head.startswith(m) for m in netcdfMagic):
+        raise validationError(f"{path} is not a NetCDF file")
+    if head.startswith(netcdfMagic[2]) and hdf5_truncated(path):
+        raise validationError(f"{path} is truncated")
+    try:
+        import xarray as xr
+    except ImportError:
+        # Without xarray only the file signature can be checked
+        return
+    try:
+        with xr.open_dataset(path) as ds:
+            time_name = 'valid_time' if 'valid_time' in ds.coords else 'time'
+            times = ds[time_name].values
+    except Exception as e:
+        raise validationError(f"{path} could not be opened: {e}")
+    period = requested_period(request) if request is not None else None
+    if period is not None:
+        if times.size == 0:
+            raise validationError(f"{path} has no time steps")
+        first,last = [datetime.fromisoformat(str(t.astype('datetime64[s]'))) for t in [times.min(),times.max()]]
+        if first > period[0] or last < published_until(period):
+            raise validationError(f"{path} covers {first} to {last}, requested {period[0]} to {period[1]}")
+
+def validate_zip(path,request=None):
+    if not zipfile.is_zipfile(path):
+        raise validationError(f"{path} is not a zip archive")
+    with zipfile.ZipFile(path) as z:
+        if not z.namelist():
+            raise validationError(f"{path} is empty")
+        bad = z.testzip()
+        if bad is not None:
+            raise validationError(f"{path} failed the CRC check on {bad}")
+
+validators = {
+    '.nc':validate_netcdf,
+    '.zip':validate_zip,
+}
+
+def validate(path,request=None,name=None):
+    # name is the final file name, used to pick the validator when checking a temporary file
+    ext = os.path.splitext(name or path)[1].lower()
+    if os.path.getsize(path) == 0:
+        raise validationError(f"{path} is empty")
+    if ext in validators:
+        validators[ext](path,request)
+
+class downloadManifest():
+    def __init__(self,folder):
+        self.folder = str(folder)
+        self.file = os.path.join(self.folder,manifestName)
+        self.lock = threading.Lock()
+        if os.path.isfile(self.file):
+            with open(self.file) as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+
+    def key(self,target):
+        # Files are identified by their path relative to the manifest folder
+        return(os.path.relpath(os.path.abspath(target),os.path.abspath(self.folder)).replace(os.sep,'/'))
+
+    def save(self):
+        os.makedirs(self.folder,exist_ok=True)
+        tmp = self.file+'.tmp'
+        with open(tmp,'w') as f:
+            json.dump(self.entries,f,indent=1)
+        os.replace(tmp,self.file)
+
+    def record(self,target,dataset,request):
+        stat = os.stat(target)
+        with self.lock:
+            self.entries[self.key(target)] = {
+                'dataset':dataset,
+                'request':request,
+                'size':stat.st_size,
+                'mtime':stat.st_mtime,
+                'sha256':sha256(target),
+                'validated':datetime.now().isoformat(timespec='seconds'),
+            }
+            self.save()
+
+    def forget(self,target):
+        with self.lock:
+            if self.entries.pop(self.key(target),None) is not None:
+                self.save()
+
+    def is_complete(self,target,dataset,request):
+        # True if target exists, matches its manifest entry and was downloaded for the same request
+        if not os.path.isfile(target):
+            return(False)
+        entry = self.entries.get(self.key(target))
+        if entry is None:
+            # Downloaded before the manifest existed: adopt it if it validates
+            try:
+                validate(target,request)
+            except validationError as e:
+                print(f"{e}, it will be downloaded again")
+                return(False)
+            self.record(target,dataset,request)
+            return(True)
+        if entry['dataset'] != dataset or entry['request'] != request:
+            print(f"{target} was downloaded for a different request, it will be downloaded again")
+            return(False)
+        stat = os.stat(target)
+        if stat.st_size == entry['size'] and stat.st_mtime == entry['mtime']:
+            return(True)
+        if stat.st_size == entry['size'] and sha256(target) == entry['sha256']:
+            return(True)
+        print(f"{target} does not match its checksum, it will be downloaded again")
+        return(False)
+
+    def download(self,fetch,target,dataset,request):
+        # fetch(path) writes the file to path; the result only replaces target once validated
+        tmp = target+'.part'
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        try:
+            fetch(tmp)
+            validate(tmp,request,name=target)
+        except BaseException:
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+            raise
+        os.replace(tmp,target)
+        self.record(target,dataset,request)
@@ -0,0 +1,208 @@
+# Download ERA5 data for a network of sites with as few CDS requests as possible
+# Sites are read from a csv file with columns: ID, lat, lon (and optionally GMT_offset for the conversion step)
+
+# Gridded datasets (reanalysis-era5-land, reanalysis-era5-single-levels):
+    # nearby sites are grouped into shared bounding boxes of at most maxCells x maxCells grid cells
+    # one request per (box, variable, year) is saved as <outputPath>/box_<north>_<west>/{variable}_{year}.nc
+    # with --convert, each site's traces are then extracted from its box by ERA5_to_binary.py
+# Time-series dataset (reanalysis-era5-land-timeseries):
+    # sites are snapped to the dataset grid and one request per (grid cell, variable) is made
+    # saved as <outputPath>/cell_<lat>_<lon>/{variable}.zip, then linked (or copied) to <outputPath>/<siteID>/
+    # so each site folder has the same one-zip-per-variable layout as ERA5_EC_pipeline_ts.py
+    # with --convert, each site's traces are then written by ERA5_to_binary.py, reading the zips without extracting them
+
+# Example call from command line:
+    # py ERA5_multi_site.py --sites C:/temp/sites.csv --outputPath C:/temp/ERA5 --dateRange 2020-01-01 2024-12-31
+    # py ERA5_multi_site.py --sites C:/temp/sites.csv --outputPath C:/temp/ERA5 --dateRange 2000-01-01 2024-12-31 --dataset reanalysis-era5-land --convert
+# Only this call's requests are run; --resume also runs the unfinished requests of earlier calls kept in <outputPath>/era5_request_queue.json
+
+import os
+import json
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+from ERA5_request_queue import requestQueue, cdsClient
+from ERA5_download_check import downloadManifest
+
+# Grid spacing of each dataset in degrees
+resolutions = {
+    'reanalysis-era5-land':0.1,
+    'reanalysis-era5-single-levels':0.25,
+    'reanalysis-era5-land-timeseries':0.1,
+}
+
+default_variables = {
+    'reanalysis-era5-land':["2m_dewpoint_temperature","2m_temperature","surface_solar_radiation_downwards",
+                            "total_precipitation","10m_u_component_of_wind","10m_v_component_of_wind"],
+    'reanalysis-era5-single-levels':["2m_dewpoint_temperature","2m_temperature","surface_solar_radiation_downwards",
+                            "total_precipitation","10m_u_component_of_wind","10m_v_component_of_wind"],
+    'reanalysis-era5-land-timeseries':["2m_dewpoint_temperature","2m_temperature","surface_solar_radiation_downwards",
+                            "surface_pressure","total_precipitation"],
+}
+
+defaultArgs = {
+    'sites':'',
+    'outputPath':'',
+    'dateRange':['2020-01-01','2020-12-31'],
+    'dataset':'reanalysis-era5-land-timeseries',
+    'variables':[],
+    'maxCells':10,
+    'maxInFlight':8,
+    'convert':False,
+    'database':'None',
+    'resume':False,
+}
+
+def read_sites(path):
+    sites = pd.read_csv(path)
+    missing = [c for c in ['ID','lat','lon'] if c not in sites.columns]
+    if missing:
+        raise ValueError(f"{path} is missing column(s): {missing}")
+    return(sites)
+
+def snap(values,resolution):
+    # Nearest grid point, rounded to avoid floating point noise in folder names and requests
+    return(np.round(np.round(np.asarray(values,dtype=float)/resolution)*resolution,4))
+
+def group_sites(sites,resolution,maxCells):
+    # Bucket sites into tiles of maxCells x maxCells grid cells; each tile with sites becomes one box
+    # Returns a list of (area [N, W, S, E], site IDs), padded by one grid cell as in ERA5_EC_pipeline.py
+    tile = resolution*maxCells
+    keys = list(zip(np.floor(sites['lat'].values/tile).astype(int),np.floor(sites['lon'].values/tile).astype(int)))
+    boxes = []
+    for key in sorted(set(keys)):
+        group = sites.loc[[k == key for k in keys]]
+        lat = snap(group['lat'],resolution)
+        lon = snap(group['lon'],resolution)
+        area = [float(np.round(v,4)) for v in [lat.max()+resolution,lon.min()-resolution,lat.min()-resolution,lon.max()+resolution]]
+        boxes.append((area,list(group['ID'])))
+    return(boxes)
+
+def group_cells(sites,resolution):
+    # One entry per unique grid cell: ((lat, lon), site IDs)
+    lat = snap(sites['lat'],resolution)
+    lon = snap(sites['lon'],resolution)
+    cells = {}
+    for ID,la,lo in zip(sites['ID'],lat,lon):
+        cells.setdefault((float(la),float(lo)),[]).append(ID)
+    return(sorted(cells.items()))
+
+def area_request(dataset,variable,year,months,area):
+    request = {
+        "variable":variable,
+        "year":str(year),
+        "month":[str(m) for m in months],
+        "day":[f"{d:02d}" for d in range(1,32)],
+        "time":[f"{h:02d}:00" for h in range(24)],
+        "data_format":"netcdf",
+        "download_format":"unarchived",
+        "area":area,
+    }
+    if dataset == 'reanalysis-era5-single-levels':
+        request["product_type"] = "reanalysis"
+    return(request)
+
+def timeseries_request(variable,lat,lon,dateRange):
+    return({
+        "variable":variable,
+        "location":{"longitude":lon,"latitude":lat},
+        "date":f"{dateRange[0]}/{dateRange[1]}",
+        "data_format":"netcdf",
+    })
+
+def fan_out_files(src,dest):
+    # Hard link where possible (no extra disk space), otherwise copy
+    os.makedirs(os.path.dirname(dest),exist_ok=True)
+    if os.path.isfile(dest):
+        if os.path.samefile(src,dest):
+            return
+        os.remove(dest)
+    try:
+        os.link(src,dest)
+    except OSError:
+        shutil.copy2(src,dest)
+
+def download(client=None,**kwargs):
+    # client defaults to the CDS, pass an ERA5_request_queue.fakeClient to test without it
+    kwargs = defaultArgs | kwargs
+    sites = read_sites(kwargs['sites'])
+    dataset = kwargs['dataset']
+    resolution = resolutions[dataset]
+    variables = kwargs['variables'] if kwargs['variables'] else default_variables[dataset]
+    out_pth = kwargs['outputPath']
+    start,end = [pd.Timestamp(d) for d in kwargs['dateRange']]
+
+    manifest = downloadManifest(out_pth)
+    queue = requestQueue(client if client is not None else cdsClient(),os.path.join(out_pth,'era5_request_queue.json'),maxInFlight=kwargs['maxInFlight'],manifest=manifest)
+    layout = {'dataset':dataset,'groups':{}}
+
+    if dataset.endswith('timeseries'):
+        for (lat,lon),IDs in group_cells(sites,resolution):
+            folder = f"cell_{lat}_{lon}"
+            layout['groups'][folder] = IDs
+            for variable in variables:
+                request = timeseries_request(variable,lat,lon,[start.strftime('%Y-%m-%d'),end.strftime('%Y-%m-%d')])
+                target = os.path.join(out_pth,folder,f"{variable}.zip")
+                if not manifest.is_complete(target,dataset,request):
+                    queue.add(f"{folder}/{variable}.zip",dataset,request,target)
+    else:
+        years = list(range(start.year,end.year+1))
+        for area,IDs in group_sites(sites,resolution,kwargs['maxCells']):
+            # Named by the north-west corner, so a box keeps its folder when the site list changes elsewhere
+            folder = f"box_{area[0]}_{area[1]}"
+            layout['groups'][folder] = IDs
+            for variable in variables:
+                for year in years:
+                    first_month = start.month if year == start.year else 1
+                    last_month = end.month if year == end.year else 12
+                    request = area_request(dataset,variable,year,range(first_month,last_month+1),area)
+                    target = os.path.join(out_pth,folder,f"{variable}_{year}.nc")
+                    if not manifest.is_complete(target,dataset,request):
+                        queue.add(f"{folder}/{variable}_{year}.nc",dataset,request,target)
+
+    print(f"{len(sites)} sites in {len(layout['groups'])} shared request groups")
+    os.makedirs(out_pth,exist_ok=True)
+    with open(os.path.join(out_pth,'site_groups.json'),'w') as f:
+        json.dump(layout,f,indent=1)
+    queue.run(resume=kwargs['resume'])
+    fan_out(sites,layout,out_pth,variables,kwargs)
+    return(layout)
+
+def fan_out(sites,layout,out_pth,variables,kwargs):
+    sites = sites.set_index('ID')
+    for folder,IDs in layout['groups'].items():
+        for ID in IDs:
+            inputPath = os.path.join(out_pth,folder)
+            if layout['dataset'].endswith('timeseries'):
+                inputPath = os.path.join(out_pth,str(ID))
+                for variable in variables:
+                    src = os.path.join(out_pth,folder,f"{variable}.zip")
+                    if os.path.isfile(src):
+                        fan_out_files(src,os.path.join(inputPath,f"{variable}.zip"))
+            if kwargs['convert']:
+                import ERA5_to_binary as e2b
+                site = sites.loc[ID]
+                e2b.convert(
+                    siteID=str(ID),inputPath=inputPath,
+                    database=None if kwargs['database'] == 'None' else kwargs['database'],
+                    lat=float(site['lat']),lon=float(site['lon']),
+                    GMT_offset=float(site['GMT_offset']) if 'GMT_offset' in site.index else None,
+                    dataset=layout['dataset'],variables=variables)
+
+# If called from command line ...
+if __name__ == '__main__':
+
+    CLI=argparse.ArgumentParser()
+
+    for key,val in defaultArgs.items():
+        if type(val) == bool:
+            CLI.add_argument(f"--{key}",action='store_true')
+        elif type(val) == list:
+            CLI.add_argument(f"--{key}",nargs='+',type=str,default=val)
+        else:
+            CLI.add_argument(f"--{key}",nargs="?",type=type(val),default=val)
+
+    # parse the command line
+    args = CLI.parse_args()
+    download(**vars(args))
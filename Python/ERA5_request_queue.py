@@ -0,0 +1,251 @@
+# Concurrent, resumable queue of CDS API (ERA5) requests
+# Intended to be called by the ERA5 scripts, e.g.:
+    # queue = requestQueue(cdsClient(),'path/to/era5_queue.json',maxInFlight=8)
+    # queue.add('2m_temperature_2024.nc','reanalysis-era5-land',request,'path/to/2m_temperature_2024.nc')
+    # queue.run()
+    # queue.run(resume=True) also runs the unfinished jobs left in the state file by earlier runs (e.g., other sites or dates)
+# All requests are submitted up front (up to maxInFlight queued/running at once) and polled together,
+#   so the CDS queue waits overlap instead of adding up
+# The job state is saved to a json file after every change, so an interrupted run resumes
+#   by re-attaching to the requests it already submitted instead of submitting them again
+# By default run() only handles the jobs added by this run, other jobs in the state file are left as they are
+# The client is pluggable: cdsClient wraps cdsapi, fakeClient is a local stand-in for testing without the CDS
+# With a downloadManifest (see ERA5_download_check.py), downloads are validated and renamed into place atomically
+
+import os
+import json
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Job states
+PENDING = 'pending'
+SUBMITTED = 'submitted'
+DOWNLOADED = 'downloaded'
+FAILED = 'failed'
+
+# Map the states reported by the different versions of the CDS API to queued/running/completed/failed
+remoteStates = {
+    'queued':'queued',
+    'accepted':'queued',
+    'running':'running',
+    'completed':'completed',
+    'successful':'completed',
+    'failed':'failed',
+    'rejected':'failed',
+    'dismissed':'failed',
+    'deleted':'failed',
+}
+
+class cdsClient():
+    # Thin adapter over cdsapi, works with the legacy client and the ecmwf-datastores backed client
+    # Credentials are read from ~/.cdsapirc as usual
+    def __init__(self,**kwargs):
+        import cdsapi
+        self.client = cdsapi.Client(wait_until_complete=False,delete=False,**kwargs)
+
+    def submit(self,dataset,request):
+        return(self.client.retrieve(dataset,request))
+
+    def request_id(self,handle):
+        if hasattr(handle,'reply'):
+            return(handle.reply['request_id'])
+        return(handle.request_id)
+
+    def attach(self,request_id):
+        # Re-connect to a request submitted by an earlier run
+        if hasattr(self.client,'client') and hasattr(self.client.client,'get_remote'):
+            return(self.client.client.get_remote(request_id))
+        import cdsapi
+        handle = cdsapi.api.Result(self.client,{'request_id':request_id,'state':'queued'})
+        handle.update()
+        return(handle)
+
+    def status(self,handle):
+        if hasattr(handle,'reply'):
+            handle.update()
+            state = handle.reply['state']
+        else:
+            state = handle.status
+        return(remoteStates.get(state,'queued'))
+
+    def download(self,handle,target):
+        handle.download(target)
+
+class fakeClient():
+    # Local stand-in for the CDS: requests are "processed" after a random delay and downloads are written by writer(request,target)
+    # failRate sets the fraction of requests that fail, to exercise error handling
+    def __init__(self,delay=(0.1,0.5),failRate=0,writer=None,seed=None):
+        self.delay = delay
+        self.failRate = failRate
+        self.writer = writer
+        self.rng = random.Random(seed)
+        self.jobs = {}
+        self.submitted = []
+        self.lock = threading.Lock()
+
+    def submit(self,dataset,request):
+        with self.lock:
+            request_id = f"fake-{len(self.jobs)+1}"
+            self.jobs[request_id] = {
+                'dataset':dataset,
+                'request':request,
+                'ready':time.monotonic()+self.rng.uniform(*self.delay),
+                'fail':self.rng.random()<self.failRate,
+            }
+            self.submitted.append(request_id)
+        return(request_id)
+
+    def request_id(self,handle):
+        return(handle)
+
+    def attach(self,request_id):
+        if request_id not in self.jobs:
+            raise KeyError(f"Unknown request {request_id}")
+        return(request_id)
+
+    def status(self,handle):
+        job = self.jobs[handle]
+        if time.monotonic() < job['ready']:
+            return('queued')
+        return('failed' if job['fail'] else 'completed')
+
+    def download(self,handle,target):
+        job = self.jobs[handle]
+        if self.writer is not None:
+            self.writer(job['request'],target)
+        else:
+            with open(target,'w') as f:
+                json.dump({'dataset':job['dataset'],'request':job['request']},f)
+
+class requestQueue():
+    def __init__(self,client,stateFile,maxInFlight=4,pollInterval=30,maxDownloads=None,manifest=None,verbose=True):
+        self.client = client
+        self.manifest = manifest
+        self.stateFile = stateFile
+        self.maxInFlight = maxInFlight
+        self.pollInterval = pollInterval
+        self.maxDownloads = maxDownloads if maxDownloads is not None else maxInFlight
+        self.verbose = verbose
+        self.handles = {}
+        self.lock = threading.Lock()
+        # Keys of the jobs added by this run, the only ones run() handles unless resume=True
+        self.added = set()
+        self.selected = set()
+        if os.path.isfile(stateFile):
+            with open(stateFile) as f:
+                self.jobs = json.load(f)
+        else:
+            self.jobs = {}
+
+    def log(self,msg):
+        if self.verbose:
+            print(msg)
+
+    def save(self):
+        # Write to a temporary file first so an interruption can't leave a truncated state file
+        with self.lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.stateFile)),exist_ok=True)
+            tmp = self.stateFile+'.tmp'
+            with open(tmp,'w') as f:
+                json.dump(self.jobs,f,indent=1)
+            os.replace(tmp,self.stateFile)
+
+    def add(self,key,dataset,request,target):
+        job = {'dataset':dataset,'request':request,'target':str(target)}
+        self.added.add(key)
+        old = self.jobs.get(key)
+        # Keep the saved state unless the request itself has changed
+        # A job added again after it was downloaded is fetched again (e.g., the file is missing or damaged)
+        if old is not None and all(old.get(k) == v for k,v in job.items()):
+            if old['state'] == DOWNLOADED:
+                old['state'] = PENDING
+            return
+        job.update({'state':PENDING,'request_id':None,'error':None})
+        self.jobs[key] = job
+
+    def set_state(self,key,state,**kwargs):
+        with self.lock:
+            self.jobs[key]['state'] = state
+            self.jobs[key].update(kwargs)
+        self.save()
+
+    def in_flight(self):
+        return([k for k,j in self.jobs.items() if j['state'] == SUBMITTED and k in self.selected])
+
+    def resume(self):
+        for key in self.in_flight():
+            try:
+                self.handles[key] = self.client.attach(self.jobs[key]['request_id'])
+                self.log(f"Resumed request {self.jobs[key]['request_id']} for {key}")
+            except Exception as e:
+                self.log(f"Could not resume request for {key} ({e}), it will be resubmitted")
+                self.set_state(key,PENDING,request_id=None)
+
+    def submit(self):
+        pending = [k for k,j in self.jobs.items() if j['state'] == PENDING and k in self.selected]
+        for key in pending[:max(self.maxInFlight-len(self.in_flight()),0)]:
+            job = self.jobs[key]
+            try:
+                handle = self.client.submit(job['dataset'],job['request'])
+                self.handles[key] = handle
+                self.set_state(key,SUBMITTED,request_id=self.client.request_id(handle))
+                self.log(f"Submitted request for {key}")
+            except Exception as e:
+                self.set_state(key,FAILED,error=f"submit: {e}")
+                self.log(f"Failed to submit request for {key}: {e}")
+
+    def download(self,key):
+        job = self.jobs[key]
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(job['target'])),exist_ok=True)
+            if self.manifest is not None:
+                fetch = lambda tmp: self.client.download(self.handles[key],tmp)
+                self.manifest.download(fetch,job['target'],job['dataset'],job['request'])
+            else:
+                self.client.download(self.handles[key],job['target'])
+            self.set_state(key,DOWNLOADED,error=None)
+            self.log(f"Finished download for {key}")
+        except Exception as e:
+            self.set_state(key,FAILED,error=f"download: {e}")
+            self.log(f"Failed to download {key}: {e}")
+
+    def run(self,resume=False):
+        # Returns the job dict; failed jobs are kept with their error and retried on the next run
+        # Only the jobs added by this run are handled, resume=True also handles the unfinished jobs of earlier runs
+        self.selected = set(self.jobs) if resume else set(self.added)
+        stale = [k for k,j in self.jobs.items() if k not in self.selected and j['state'] != DOWNLOADED]
+        if stale:
+            self.log(f"{len(stale)} unfinished requests of earlier runs are left in {self.stateFile}, use resume=True (--resume) to run them")
+        for key,job in self.jobs.items():
+            if job['state'] == FAILED and key in self.selected:
+                job['state'] = PENDING
+        self.save()
+        self.resume()
+        downloading = {}
+        with ThreadPoolExecutor(max_workers=self.maxDownloads) as pool:
+            while True:
+                self.submit()
+                for key in self.in_flight():
+                    if key in downloading:
+                        continue
+                    try:
+                        state = self.client.status(self.handles[key])
+                    except Exception as e:
+                        self.log(f"Could not get status of {key}: {e}")
+                        continue
+                    if state == 'completed':
+                        downloading[key] = pool.submit(self.download,key)
+                    elif state == 'failed':
+                        self.set_state(key,FAILED,error='request failed on the server')
+                        self.log(f"No data found for {key} or API error")
+                for key in [k for k,f in downloading.items() if f.done()]:
+                    downloading.pop(key)
+                remaining = [k for k,j in self.jobs.items() if j['state'] in [PENDING,SUBMITTED] and k in self.selected]
+                if not remaining:
+                    break
+                time.sleep(self.pollInterval)
+        failed = [k for k in self.selected if self.jobs[k]['state'] == FAILED]
+        self.log(f"{len(self.selected)-len(failed)}/{len(self.selected)} requests complete")
+        return(self.jobs)
@@ -0,0 +1,266 @@
+# Convert downloaded ERA5 NetCDF files ({variable}_{year}.nc from ERA5_EC_pipeline.py) to Biomet database traces
+# or, with --dataset reanalysis-era5-land-timeseries, the {variable}.zip files from ERA5_EC_pipeline_ts.py (read without unzipping)
+# Python counterpart of db_ERA5_compile.m: same trace names (ERA5 short names), units and output folder
+# Written to handle decades of data: files are opened lazily (chunked by time if dask is installed)
+#   and only the grid cells around the site are ever read into memory
+
+# Basic call from command line (lat, lon and time zone are read from the site's _config.yml):
+    # py ERA5_to_binary.py --siteID DSM --inputPath C:/temp/MatlabTemp/DSM
+# Or specify them explicitly and write to a database stage instead of the default ERA5/siteID folder:
+    # py ERA5_to_binary.py --siteID DSM --inputPath C:/temp/ERA5 --lat 45.1 --lon -110.1 --GMT_offset -7 --stage Met/ERA5
+# Can also call from other python scripts:
+    # import ERA5_to_binary as e2b
+    # e2b.convert(siteID='DSM',inputPath='C:/temp/ERA5')
+
+import os
+import sys
+import glob
+import argparse
+import importlib.util
+import numpy as np
+import pandas as pd
+import readConfig as rCfg
+import traceArchive as ta
+
+# Variables reported as accumulations, in ERA5-Land these accumulate from 00 UTC (reset at 01 UTC)
+accumulated = ['ssrd','strd','ssr','str','tp','sf','e','ro','pev','slhf','sshf']
+# Energy fluxes averaged over the preceding hour, spread evenly across both half-hours
+energy = ['ssrd','strd','ssr','str','slhf','sshf']
+
+# Unit conversions applied after de-accumulation, names follow db_ERA5_compile.m
+def convert_units(shortName,values):
+    if shortName in ['t2m','d2m','skt','mx2t','mn2t']:
+        return(values-273.15) # K to °C
+    if shortName in ['sp','msl']:
+        return(values/1000) # Pa to kPa
+    if shortName in energy:
+        return(values/3600) # J m-2 per hour to W m-2
+    if shortName in ['tp','sf','e','ro','pev']:
+        return(values*1000) # m per hour to mm per hour
+    return(values)
+
+def variable_names():
+    # Full name (as used in the file names) to short name (as used inside the files)
+    names = pd.read_csv(os.path.join(rCfg.moduleDir,'ERA5 variables.csv'))
+    return(dict(zip(names['Full_name'],names['Short_name'])))
+
+def site_metadata(database,siteID):
+    # lat, lon and GMT offset (standard time) from the site's _config.yml, as in db_ERA5_compile.m
+    path_yml = os.path.join(database,'Calculation_Procedures','TraceAnalysis_ini',siteID,f'{siteID}_config.yml')
+    if not os.path.isfile(path_yml):
+        sys.exit(f"Could not find: {path_yml}, specify lat, lon and GMT_offset instead")
+    meta = rCfg.load_yaml(path_yml).get('Metadata',{})
+    if not all(k in meta for k in ['lat','long','TimeZoneHour']):
+        sys.exit('Missing metadata. Check that lat, long, and TimeZoneHour are specified in the _config.yml file.')
+    return(meta['lat'],meta['long'],meta['TimeZoneHour'])
+
+def axis_weights(coords,x,method):
+    # Indices and weights of the grid points used to estimate x along one axis
+    coords = np.asarray(coords,dtype=float)
+    if method == 'nearest' or coords.size == 1:
+        return([int(np.argmin(np.abs(coords-x)))],np.array([1.0]))
+    order = np.argsort(coords)
+    c = coords[order]
+    if x <= c[0]:
+        return([int(order[0])],np.array([1.0]))
+    if x >= c[-1]:
+        return([int(order[-1])],np.array([1.0]))
+    k = int(np.searchsorted(c,x))
+    w = (x-c[k-1])/(c[k]-c[k-1])
+    return([int(order[k-1]),int(order[k])],np.array([1-w,w]))
+
+def point_series(da,lat,lon,method='linear'):
+    # Hourly series at lat/lon from a (time, latitude, longitude) DataArray
+    # Bilinear weights are re-normalized over valid cells, so coastal sites don't pick up NaN sea cells in ERA5-Land
+    time_name = 'valid_time' if 'valid_time' in da.dims else 'time'
+    # Collapse extra dimensions (e.g., "number" or "expver" in merged ERA5/ERA5T files)
+    for dim in [d for d in da.dims if d not in [time_name,'latitude','longitude']]:
+        da = da.mean(dim,skipna=True)
+    ilat,wlat = axis_weights(da['latitude'].values,lat,method)
+    ilon,wlon = axis_weights(da['longitude'].values,lon,method)
+    # Only this small block is read from disk
+    block = da.isel(latitude=ilat,longitude=ilon).transpose(time_name,'latitude','longitude').values.astype(float)
+    weights = np.outer(wlat,wlon)[np.newaxis,:,:]
+    valid = ~np.isnan(block)
+    total = (weights*valid).sum(axis=(1,2))
+    with np.errstate(invalid='ignore',divide='ignore'):
+        values = (np.where(valid,block,0)*weights).sum(axis=(1,2))/total
+    return(da[time_name].values.astype('datetime64[ns]'),values)
+
+def deaccumulate(times,values,dataset):
+    # ERA5-Land accumulations run from 00 UTC, so each hour is the difference from the previous hour,
+    # except at 01 UTC where the accumulation restarts. ERA5 single levels are already hourly totals.
+    if dataset != 'reanalysis-era5-land':
+        return(values)
+    hourly = np.diff(values,prepend=np.nan)
+    step = np.diff(times,prepend=times[:1]-np.timedelta64(1,'h'))
+    hourly[step != np.timedelta64(1,'h')] = np.nan
+    reset = (times.astype('datetime64[h]').astype(np.int64) % 24) == 1
+    hourly[reset] = values[reset]
+    hourly[hourly<0] = 0
+    return(hourly)
+
+def half_hourly(times,values,grid,shortName):
+    # Map hourly values to the half-hourly grid (period end times)
+    # Instantaneous values are linearly interpolated; hourly totals and averages are assigned to both half-hours of their hour
+    t = times.astype('datetime64[m]').astype(np.int64)
+    g = grid.astype('datetime64[m]').astype(np.int64)
+    ok = ~np.isnan(values)
+    if shortName in accumulated:
+        hour_end = -(-g//60)*60
+        i = np.searchsorted(t,hour_end)
+        found = (i < t.size)
+        i[~found] = 0
+        found &= (t[i] == hour_end)
+        out = np.where(found,values[i],np.nan)
+        if shortName not in energy:
+            out = out/2 # e.g. mm per hour to mm per half-hour
+        return(out)
+    out = np.interp(g,t[ok],values[ok],left=np.nan,right=np.nan) if ok.sum() > 1 else np.full(g.shape,np.nan)
+    # Don't interpolate across gaps in the hourly data
+    gap = np.interp(g,t,(~ok).astype(float),left=1,right=1) > 0
+    out[gap] = np.nan
+    return(out)
+
+def year_grid(years,config):
+    # Period end times of the full years, in local standard time
+    resolution = pd.Timedelta(config['dbase_metadata']['timestamp']['resolution'])
+    return(pd.date_range(start=pd.Timestamp(f'{min(years)}-01-01')+resolution,end=f'{max(years)+1}-01-01',freq=resolution).values)
+
+def write_years(grid,traces,dout_template,config):
+    # Write one file per trace per year; existing values are replaced only where new data is available
+    ts = config['dbase_metadata']['timestamp']
+    tv = ((grid-np.datetime64('1970-01-01'))/np.timedelta64(1,ts['base_unit'])+ts['base']).astype(ts['dtype'])
+    # The last period of each year ends at 00:00 on Jan 1 of the following year
+    years = (grid-np.timedelta64(1,'m')).astype('datetime64[Y]').astype(int)+1970
+    written = []
+    for year in np.unique(years):
+        idx = years == year
+        dout = dout_template.format(year=year)
+        ta.unpack_to_write(dout)
+        os.makedirs(dout,exist_ok=True)
+        tv[idx].tofile(os.path.join(dout,ts['name']))
+        for name,values in traces.items():
+            new = values[idx].astype(config['dbase_metadata']['traces']['dtype'])
+            fn = os.path.join(dout,name)
+            if ta.exists(fn):
+                old = ta.read(fn,config['dbase_metadata']['traces']['dtype'])
+                if old.shape == new.shape:
+                    new = np.where(np.isnan(new),old,new)
+            new.tofile(fn)
+        written.append(dout)
+    return(written)
+
+def open_variable(files,chunks):
+    import xarray as xr
+    if chunks and importlib.util.find_spec('dask') is not None:
+        opened = [xr.open_dataset(f,chunks={}) for f in files]
+        opened = [ds.chunk({('valid_time' if 'valid_time' in ds.dims else 'time'):chunks}) for ds in opened]
+    else:
+        # Without dask, xarray still reads lazily and only loads the indexed block
+        opened = [xr.open_dataset(f) for f in files]
+    return(opened)
+
+def data_variable(ds):
+    skip = ['number','expver','latitude','longitude','valid_time','time']
+    return([v for v in ds.data_vars if v not in skip][0])
+
+def read_gridded(inputPath,variables,lat,lon,method,chunks):
+    # Hourly point series from {variable}_{year}.nc files: {trace name: (shortName, times, values)}
+    names = variable_names()
+    raw = {}
+    for variable in variables:
+        files = sorted(f for f in glob.glob(os.path.join(inputPath,f'{variable}_*.nc'))
+                       if os.path.basename(f)[len(variable)+1:-3].isnumeric())
+        if not files:
+            continue
+        print(f'Reading {variable} from {len(files)} file(s)')
+        times,values = [],[]
+        for ds in open_variable(files,chunks):
+            with ds:
+                shortName = data_variable(ds)
+                t,v = point_series(ds[shortName],lat,lon,method)
+            times.append(t)
+            values.append(v)
+        times = np.concatenate(times)
+        values = np.concatenate(values)
+        order = np.argsort(times,kind='stable')
+        times,values = times[order],values[order]
+        keep = np.concatenate([[True],np.diff(times) > np.timedelta64(0)])
+        raw[names.get(variable,shortName)] = (shortName,times[keep],values[keep])
+    return(raw)
+
+def read_timeseries(inputPath,variables):
+    # Hourly point series streamed from the {variable}.zip files of the time-series dataset
+    import ERA5_zip_reader as ezr
+    files = [os.path.join(inputPath,f'{variable}.zip') for variable in variables]
+    files = [f for f in files if os.path.isfile(f)]
+    if files:
+        print(f'Reading {len(files)} zip file(s)')
+    times,data = ezr.read_zips(files)
+    return({shortName:(shortName,times,values) for shortName,values in data.items()})
+
+def convert(siteID,inputPath,database=None,lat=None,lon=None,GMT_offset=None,
+            dataset='reanalysis-era5-land',stage=None,method='linear',chunks=24*366,variables=None):
+    config = rCfg.set_user_configuration()
+    if database is None:
+        database = config['rootDir']['database']
+    timeseries = dataset.endswith('timeseries')
+    if GMT_offset is None or (not timeseries and (lat is None or lon is None)):
+        meta = site_metadata(database,siteID)
+        lat = meta[0] if lat is None else lat
+        lon = meta[1] if lon is None else lon
+        GMT_offset = meta[2] if GMT_offset is None else GMT_offset
+    # Same layout as db_ERA5_compile.m unless a stage within the site folder is requested
+    if stage is None:
+        dout_template = os.path.join(database,'{year}','ERA5',siteID)
+    else:
+        stage = config['stage'].get(stage,stage)
+        dout_template = os.path.join(database,'{year}',siteID,stage)
+
+    if variables is None:
+        variables = variable_names().keys()
+    if timeseries:
+        raw = read_timeseries(inputPath,variables)
+    else:
+        raw = read_gridded(inputPath,variables,lat,lon,method,chunks)
+    if not raw:
+        sys.exit(f'No ERA5 files found in {inputPath}')
+
+    traces = {}
+    for name,(shortName,times,values) in raw.items():
+        if shortName in accumulated:
+            values = deaccumulate(times,values,dataset)
+        traces[name] = (shortName,times,convert_units(shortName,values))
+    hourly_times = np.concatenate([t for _,t,_ in traces.values()])
+
+    # UTC to local standard time, then onto the half-hourly grid of every year with data
+    offset = np.timedelta64(int(round(GMT_offset*60)),'m')
+    local = hourly_times+offset
+    years = range(int(str(local.min().astype('datetime64[Y]'))),int(str((local.max()-np.timedelta64(1,'m')).astype('datetime64[Y]')))+1)
+    grid = year_grid(years,config)
+    half = {name:half_hourly(t+offset,v,grid,shortName) for name,(shortName,t,v) in traces.items()}
+    written = write_years(grid,half,dout_template,config)
+    for dout in written:
+        print(f'See output: {dout}')
+    return(written)
+
+# If called from command line ...
+if __name__ == '__main__':
+
+    CLI=argparse.ArgumentParser()
+
+    CLI.add_argument("--siteID",nargs="?",type=str,required=True)
+    CLI.add_argument("--inputPath",nargs="?",type=str,required=True)
+    CLI.add_argument("--database",nargs="?",type=str,default=None)
+    CLI.add_argument("--lat",nargs="?",type=float,default=None)
+    CLI.add_argument("--lon",nargs="?",type=float,default=None)
+    CLI.add_argument("--GMT_offset",nargs="?",type=float,default=None)
+    CLI.add_argument("--dataset",nargs="?",type=str,default='reanalysis-era5-land')
+    CLI.add_argument("--stage",nargs="?",type=str,default=None)
+    CLI.add_argument("--method",nargs="?",type=str,choices=['linear','nearest'],default='linear')
+    CLI.add_argument("--variables",nargs='+',type=str,default=None)
+
+    # Parse the args and make the call
+    args = CLI.parse_args()
+    convert(**vars(args))
@@ -0,0 +1,80 @@
+# Read ERA5 time-series downloads (one .zip per variable from ERA5_EC_pipeline_ts.py) without extracting them
+# NetCDF and CSV members are streamed straight out of the archives and all variables
+#   are merged onto a single hourly time index in one pass
+# Intended to be called by other scripts, e.g.:
+    # import ERA5_zip_reader as ezr
+    # times, data = ezr.read_zips(['C:/temp/ERA5/2m_temperature.zip','C:/temp/ERA5/total_precipitation.zip'])
+    # data['t2m'] is then a float64 array aligned with times (datetime64[ns], UTC)
+
+import io
+import glob
+import zipfile
+import numpy as np
+import pandas as pd
+
+coordinates = ['valid_time','time','latitude','longitude','number','expver']
+
+def read_netcdf_member(z,name):
+    # NetCDF members are read into memory, never written to disk
+    import xarray as xr
+    buffer = z.read(name)
+    try:
+        ds = xr.open_dataset(io.BytesIO(buffer),engine='h5netcdf')
+    except (ImportError,ValueError,OSError):
+        # netCDF4 can open a file held in memory directly
+        import netCDF4
+        ds = xr.open_dataset(xr.backends.NetCDF4DataStore(netCDF4.Dataset(name,memory=buffer)))
+    with ds:
+        time_name = 'valid_time' if 'valid_time' in ds.coords else 'time'
+        times = ds[time_name].values.astype('datetime64[ns]')
+        series = {}
+        for var in ds.data_vars:
+            if var in coordinates:
+                continue
+            da = ds[var]
+            for dim in [d for d in da.dims if d != time_name]:
+                da = da.mean(dim,skipna=True)
+            series[var] = (times,da.values.astype(float))
+    return(series)
+
+def read_csv_member(z,name):
+    with z.open(name) as f:
+        df = pd.read_csv(f)
+    time_name = 'valid_time' if 'valid_time' in df.columns else 'time'
+    times = pd.to_datetime(df[time_name]).values.astype('datetime64[ns]')
+    return({c:(times,pd.to_numeric(df[c],errors='coerce').values.astype(float))
+            for c in df.columns if c not in coordinates})
+
+readers = {
+    '.nc':read_netcdf_member,
+    '.csv':read_csv_member,
+}
+
+def read_zip(path):
+    # All variables in one archive: {shortName: (times, values)}
+    series = {}
+    with zipfile.ZipFile(path) as z:
+        for name in z.namelist():
+            ext = '.'+name.rsplit('.',1)[-1].lower() if '.' in name else ''
+            if ext in readers:
+                series.update(readers[ext](z,name))
+    return(series)
+
+def merge(series):
+    # Align every variable on the union of their time stamps with vectorized lookups
+    times = np.unique(np.concatenate([t for t,v in series.values()])) if series else np.array([],dtype='datetime64[ns]')
+    data = {}
+    for var,(t,v) in series.items():
+        out = np.full(times.shape,np.nan)
+        out[np.searchsorted(times,t)] = v
+        data[var] = out
+    return(times,data)
+
+def read_zips(paths):
+    # paths can be a list of zip files or a folder containing them
+    if isinstance(paths,str):
+        paths = sorted(glob.glob(f"{paths}/*.zip"))
+    series = {}
+    for path in paths:
+        series.update(read_zip(path))
+    return(merge(series))
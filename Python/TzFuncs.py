@@ -1,4 +1,3 @@
-from tzfpy import get_tz
 from datetime import *
 import pandas as pd
 import argparse
@@ -24,6 +23,8 @@ class Tzfuncs():
 
     def AssumeTZ(self,lon,lat):
         print(f'Timezone not provided, estimating for {lon}, {lat}')
+        # imported here, only needed when the timezone is estimated
+        from tzfpy import get_tz
         self.Time_Zone = pytz.timezone(get_tz(lon,lat))
         print(f'Assumed timezone is: {self.Time_Zone}')
 
@@ -0,0 +1,304 @@
+# Reproducible benchmarks of the read/write paths over a synthetic Biomet database
+# Written to track whether a change to the python tools helps or hurts performance
+
+# Basic call from command line (builds the synthetic data on the first call, then re-uses it):
+    # py benchmarkDatabase.py --root C:/temp/biomet_benchmark
+# Larger database, only some of the benchmarks:
+    # py benchmarkDatabase.py --root C:/temp/biomet_benchmark --years 10 --sites 5 --traces 100 --benchmarks makeCSV read_database_traces
+# Compare the stored results across commits:
+    # py benchmarkDatabase.py --root C:/temp/biomet_benchmark --compare
+# Results are appended to <root>/benchmark_results.jsonl, tagged with the git commit of Biomet.net
+# The synthetic tree is generated from a fixed seed, so results from different commits are comparable
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import numpy as np
+import pandas as pd
+from pathlib import Path
+import readConfig as rCfg
+from datetime import datetime
+
+defaultArgs = {
+    'root':'',
+    'years':2,
+    'firstYear':2022,
+    'sites':2,
+    'traces':20,
+    'loggerDays':30,
+    'ghgFiles':500,
+    'repeat':3,
+    'benchmarks':[],
+    'rebuild':False,
+    'compare':False,
+}
+
+# Traces used by the csv_from_binary.yml template, so the template tasks can run on the synthetic data
+templateTraces = ['LW_IN_1_1_1','PA_1_1_1','PPFD_IN_1_1_1','RH_1_1_1','SW_IN_1_1_1','TA_1_1_1','canopy_height','TS_1_1_1','TS_1_2_1']
+
+def site_names(n):
+    return([f"SITE{i+1}" for i in range(n)])
+
+def trace_names(n):
+    return(templateTraces+[f"TRACE_{i:03d}" for i in range(max(n-len(templateTraces),0))])
+
+def ml_traces():
+    # Flux traces read by methaneGapfillML with the default configuration
+    ml_config = rCfg.load_yaml('config_files/ML_Gapfill_default.yml')
+    return(sorted({Path(f['trace']).name for f in ml_config['fluxes'].values() if f is not None}))
+
+def clean_tv(year,config):
+    # The analytic time vector of one year: period end timestamps as a matlab datenum
+    ts = config['dbase_metadata']['timestamp']
+    index = pd.date_range(start=f'{year}01010030',end=f'{year+1}01010001',freq=ts['resolution'])
+    datenum = (index-pd.Timestamp('1970-01-01'))/pd.Timedelta(1,unit=ts['base_unit'])+ts['base']
+    return(index,np.asarray(datenum,dtype=ts['dtype']))
+
+def make_database(root,years,sites,traces,config,seed=42):
+    # Database/YYYY/Site/Stage/trace for every stage alias in config.yml
+    rng = np.random.default_rng(seed)
+    database = os.path.join(root,'Database')
+    names = trace_names(traces)
+    extra = ml_traces()
+    for year in years:
+        index,tv = clean_tv(year,config)
+        # Smooth diurnal signal with noise and ~10% gaps, so the data compresses and aggregates like real traces
+        diurnal = np.sin(2*np.pi*(index.hour+index.minute/60)/24).values
+        for site in sites:
+            for stage in config['stage'].values():
+                dout = os.path.join(database,str(year),site,stage)
+                os.makedirs(dout,exist_ok=True)
+                tv.tofile(os.path.join(dout,config['dbase_metadata']['timestamp']['name']))
+                stageTraces = names+extra if stage.endswith('ThirdStage') else names
+                for i,name in enumerate(stageTraces):
+                    trace = (10*(i%7+1)*diurnal+rng.normal(0,1,tv.shape[0])).astype(config['dbase_metadata']['traces']['dtype'])
+                    trace[rng.random(tv.shape[0])<0.1] = np.nan
+                    trace.tofile(os.path.join(dout,name))
+    return(database)
+
+def make_logger_files(root,sites,days,firstYear,seed=42):
+    # Campbell TOA5 .dat files (one per site per day) and one comma delimited .csv per site
+    rng = np.random.default_rng(seed)
+    dIn = os.path.join(root,'Datadump')
+    files = {'dat':[],'csv':[]}
+    for site in sites:
+        os.makedirs(os.path.join(dIn,site),exist_ok=True)
+        index = pd.date_range(start=f'{firstYear}01010030',periods=days*48,freq='30min')
+        data = pd.DataFrame(rng.normal(0,1,(index.shape[0],10)),index=index,columns=[f'Var_{i}' for i in range(10)]).round(4)
+        for day,df in data.groupby(data.index.floor('D')):
+            fn = os.path.join(dIn,site,f"TOA5_{site}.MET_{day.strftime('%Y_%m_%d_%H%M')}.dat")
+            with open(fn,'w') as f:
+                f.write(f'"TOA5","{site}","CR1000X","1234","CR1000X.Std.05","CPU:{site}.CR1X","1234","MET"\n')
+                f.write(','.join(['"TIMESTAMP"','"RECORD"']+[f'"{c}"' for c in df.columns])+'\n')
+                f.write(','.join(['"TS"','"RN"']+['"unit"' for c in df.columns])+'\n')
+                f.write(','.join(['""','""']+['"Avg"' for c in df.columns])+'\n')
+                for i,(t,row) in enumerate(df.iterrows()):
+                    f.write(','.join([f'"{t.strftime("%Y-%m-%d %H:%M:%S")}"',str(i)]+[str(v) for v in row.values])+'\n')
+            files['dat'].append(fn)
+        fn = os.path.join(dIn,site,f"{site}_Flux.csv")
+        csv = data.copy()
+        csv.insert(0,'TIMESTAMP',csv.index.strftime('%Y-%m-%d %H:%M'))
+        csv.columns = pd.MultiIndex.from_tuples([('TIMESTAMP','yyyy-mm-dd HH:MM')]+[(c,'unit') for c in data.columns])
+        csv.to_csv(fn,index=False)
+        files['csv'].append(fn)
+    return(files)
+
+def make_ghg_files(root,sites,nFiles,firstYear,seed=42):
+    # Raw files named like LI-COR .ghg files, filled with random bytes
+    rng = np.random.default_rng(seed)
+    dIn = os.path.join(root,'Raw')
+    for site in sites:
+        for i,t in enumerate(pd.date_range(start=f'{firstYear}01010000',periods=nFiles,freq='30min')):
+            dout = os.path.join(dIn,site,t.strftime('%Y%m%d'))
+            os.makedirs(dout,exist_ok=True)
+            with open(os.path.join(dout,f"{t.strftime('%Y-%m-%dT%H%M%S')}_AIU-{site}.ghg"),'wb') as f:
+                f.write(rng.bytes(4096))
+    return(dIn)
+
+def build(args,config):
+    info_file = os.path.join(args.root,'synthetic.json')
+    params = {k:getattr(args,k) for k in ['years','firstYear','sites','traces','loggerDays','ghgFiles']}
+    if os.path.isfile(info_file) and not args.rebuild:
+        with open(info_file) as f:
+            info = json.load(f)
+        if info['params'] == params:
+            return(info)
+    if os.path.isdir(args.root):
+        for d in ['Database','Datadump','Raw','outputs','copies']:
+            shutil.rmtree(os.path.join(args.root,d),ignore_errors=True)
+    print('Generating synthetic data in',args.root)
+    years = list(range(args.firstYear,args.firstYear+args.years))
+    sites = site_names(args.sites)
+    info = {
+        'params':params,
+        'years':years,
+        'sites':sites,
+        'database':make_database(args.root,years,sites,args.traces,config),
+        'loggerFiles':make_logger_files(args.root,sites,args.loggerDays,args.firstYear),
+        'raw':make_ghg_files(args.root,sites,args.ghgFiles,args.firstYear),
+    }
+    with open(info_file,'w') as f:
+        json.dump(info,f,indent=2)
+    return(info)
+
+# Each benchmark takes the synthetic data info and returns a callable to be timed
+def bench_makeCSV(args,info,config):
+    import csvFromBinary as cfb
+    tasks = os.path.join(args.root,'csv_task.yml')
+    traces = {t:{'units':'unit','output_name':t} for t in trace_names(args.traces)}
+    task = {'bench':{'stage':'Third','traces':traces,'formatting':{
+        'units_in_header':True,'na_value':-9999,
+        'time_vectors':{'timestamp':{'output_name':'TIMESTAMP','fmt':'%Y-%m-%d %H%M','units':'yyyy-mm-dd HHMM'}}}}}
+    with open(tasks,'w') as f:
+        json.dump(task,f)
+    dateRange = [f"{info['years'][0]}-01-01 00:30",f"{info['years'][-1]}-12-31 23:59"]
+    # update='all' so every repeat times the export, not the skip of unchanged outputs
+    def run():
+        for site in info['sites']:
+            cfb.makeCSV(siteID=site,dateRange=dateRange,database=info['database']+'/',
+                        outputPath=os.path.join(args.root,'outputs'),tasks=[tasks],update='all')
+    return(run)
+
+def bench_writeTraces(args,info,config):
+    import binaryFromText as bft
+    meta = {'header':[0,1],'parse_dates':[0]}
+    database = os.path.join(args.root,'outputs','Database_writeTraces')
+    def run():
+        for site,fn in zip(info['sites'],info['loggerFiles']['csv']):
+            bft.writeTraces(site,fn,json.loads(json.dumps(meta)),database=database,stage='Flux',mode='replace',verbose=False)
+    return(run)
+
+def bench_writeBinaryTraces(args,info,config):
+    import textFileToBinary as tfb
+    tasks = os.path.join(args.root,'dat_task.yml')
+    task = {}
+    for site in info['sites']:
+        task[f'{site}_met_dat'] = {
+            'site':{'ID':site},'stage':'Met',
+            'fileList':[f for f in info['loggerFiles']['dat'] if f"TOA5_{site}." in f],
+            'formatting':{'header':[1,2,3],'autoDate':'TIMESTAMP'},
+            'exclude':['RECORD']}
+    with open(tasks,'w') as f:
+        json.dump(task,f)
+    database = os.path.join(args.root,'outputs','Database_writeBinaryTraces')
+    return(lambda: tfb.writeBinaryTraces([tasks],database=database))
+
+def bench_copyFiles(args,info,config):
+    import dataDump
+    def run():
+        dOut = os.path.join(args.root,'copies')
+        shutil.rmtree(dOut,ignore_errors=True)
+        for site in info['sites']:
+            dataDump.copyFiles(dIn=os.path.join(info['raw'],site),dOut=os.path.join(dOut,site),fileFormat='ghg',byYear=True,reset=True)
+    return(run)
+
+def bench_Tzfuncs(args,info,config):
+    import TzFuncs
+    index = pd.date_range(start=f"{info['years'][0]}01010030",end=f"{info['years'][-1]+1}01010001",freq='30min')
+    return(lambda: TzFuncs.Tzfuncs(Time_Zone='America/Vancouver',DST=True,Dates=index))
+
+def bench_read_database_traces(args,info,config):
+    import methaneGapfillML as mgml
+    ml_config = rCfg.load_yaml('config_files/ML_Gapfill_default.yml')
+    flux_config = ml_config['fluxes']['fch4']
+    flux_config['preds_trace'] = [f'SecondStage/{t}' for t in templateTraces]
+    def run():
+        for site in info['sites']:
+            ml_config['site'] = site
+            mgml.read_database_traces(Path(info['database']),ml_config,'fch4',flux_config)
+    return(run)
+
+def bench_cli_startup(args,info,config):
+    # Wall time of "biomet.py --help" and "biomet.py <command> --help" for every command, each in a new process
+    import biomet
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),'biomet.py')
+    calls = [[]]+[[command] for command in biomet.commands]
+    def run():
+        for call in calls:
+            subprocess.run([sys.executable,script]+call+['--help'],capture_output=True)
+    return(run)
+
+benchmarks = {
+    'makeCSV':bench_makeCSV,
+    'writeTraces':bench_writeTraces,
+    'writeBinaryTraces':bench_writeBinaryTraces,
+    'copyFiles':bench_copyFiles,
+    'Tzfuncs':bench_Tzfuncs,
+    'read_database_traces':bench_read_database_traces,
+    'cli_startup':bench_cli_startup,
+}
+
+def git_commit():
+    try:
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        commit = subprocess.run(['git','rev-parse','--short','HEAD'],cwd=cwd,capture_output=True,text=True).stdout.strip()
+        dirty = subprocess.run(['git','status','--porcelain','--untracked-files=no'],cwd=cwd,capture_output=True,text=True).stdout.strip()
+        return(commit+('-dirty' if dirty else '') if commit else 'unknown')
+    except OSError:
+        return('unknown')
+
+def run_benchmarks(**kwargs):
+    args = argparse.Namespace(**(defaultArgs|kwargs))
+    if args.root == '':
+        sys.exit('Specify a --root folder for the synthetic database')
+    config = rCfg.set_user_configuration()
+    info = build(args,config)
+    selected = args.benchmarks if args.benchmarks else list(benchmarks.keys())
+    commit = git_commit()
+    results = []
+    for name in selected:
+        record = {'commit':commit,'date':datetime.now().isoformat(timespec='seconds'),'benchmark':name,
+                  'params':info['params'],'python':platform.python_version(),'machine':platform.node()}
+        try:
+            run = benchmarks[name](args,info,config)
+            times = []
+            for i in range(args.repeat):
+                t0 = time.perf_counter()
+                run()
+                times.append(time.perf_counter()-t0)
+            record.update({'status':'ok','times_s':times,'min_s':min(times),'median_s':float(np.median(times))})
+        except (ImportError,ModuleNotFoundError) as e:
+            record.update({'status':f'skipped: {e}'})
+        except Exception as e:
+            record.update({'status':f'failed: {type(e).__name__}: {e}'})
+        print(f"{name}: {record.get('min_s',record['status'])}")
+        results.append(record)
+    with open(os.path.join(args.root,'benchmark_results.jsonl'),'a') as f:
+        for record in results:
+            f.write(json.dumps(record)+'\n')
+    return(results)
+
+def compare(root):
+    # Table of the best (min) time of each benchmark by commit, in the order commits were benchmarked
+    with open(os.path.join(root,'benchmark_results.jsonl')) as f:
+        df = pd.DataFrame([json.loads(line) for line in f])
+    df = df.loc[df['status']=='ok']
+    order = df.drop_duplicates('commit')['commit']
+    table = df.pivot_table(index='commit',columns='benchmark',values='min_s',aggfunc='min').reindex(order)
+    print(table.round(3).to_string())
+    return(table)
+
+# If called from command line ...
+if __name__ == '__main__':
+
+    CLI=argparse.ArgumentParser()
+
+    for key,val in defaultArgs.items():
+        if type(val) == bool:
+            CLI.add_argument(f"--{key}",action='store_true')
+        elif type(val) == list:
+            CLI.add_argument(f"--{key}",nargs='+',type=str,default=val)
+        else:
+            CLI.add_argument(f"--{key}",nargs="?",type=type(val),default=val)
+
+    # parse the command line
+    args = CLI.parse_args()
+    if args.compare:
+        compare(args.root)
+    else:
+        run_benchmarks(**vars(args))
@@ -9,11 +9,14 @@ import argparse
 import numpy as np
 import pandas as pd
 import readConfig as rCfg
+import runMetrics as rm
+import traceArchive as ta
 from datetime import datetime,date
 
 numerics = ['int16', 'int32', 'int64', 'float16', 'float32', 'float64']
 
 class writeTraces():
+    @rm.timed('writeTraces')
     def __init__(self,siteID,inputFile,inputFileMetaData,**kwargs):
         # Default arguments
         defaultKwargs = {
@@ -38,6 +41,7 @@ class writeTraces():
             key = tuple(['TIMESTAMP']+['' for i in range(len(inputFileMetaData['header'])-1)])
             inputFileMetaData['parse_dates'] = {key:val}
         df = pd.read_csv(inputFile,**inputFileMetaData)
+        rm.count_read(inputFile)
         df.columns = df.columns.get_level_values(0)   
         df.index = df['TIMESTAMP']
         if self.kwargs['writeCols'] is not None:
@@ -69,6 +73,8 @@ class writeTraces():
         
     def write(self):
         db = f"{self.config['rootDir']['database']}/{self.Year.index.year[0]}/{self.siteID}/{self.kwargs['stage']}/"
+        # Existing traces are updated in place, so an archived folder is unpacked first (see traceArchive.py)
+        ta.unpack_to_write(db)
         if self.kwargs['mode'].lower() == 'overwrite' and os.path.isdir(db):
             print(f'Overwriting all contents of {db}')
             shutil.rmtree(db)
@@ -84,8 +90,10 @@ class writeTraces():
             fvar = self.Year[traceName].astype(dt).values
             traceName = self.charRep(traceName)
             tracePath = f"{db}{traceName}"
-            if os.path.isfile(tracePath):
-                trace = np.fromfile(tracePath,dt)
+            # Existing values may be in the folder's archive (see traceArchive.py)
+            if ta.exists(tracePath):
+                trace = ta.read(tracePath,dt)
+                rm.count_read(nBytes=trace.nbytes)
                 if self.kwargs['verbose'] == True:
                     print(f'{tracePath} exists, {self.kwargs["mode"]} existing file')
             else:
@@ -100,6 +108,7 @@ class writeTraces():
             elif self.kwargs['mode'] == 'replace' or self.kwargs['mode'] == 'overwrite':
                 trace = fvar
             trace.tofile(tracePath)
+            rm.count_written(nBytes=trace.nbytes)
             
     def charRep(self,traceName):
         # Based on renameFields in fr_read_generic_data_file by @znesic, except:
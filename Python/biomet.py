@@ -0,0 +1,76 @@
+# Single entry point for the Biomet.net python tools
+# Each subcommand runs one tool, with that tool's usual command line arguments:
+    # export    csvFromBinary.py      write csv files from the binary database
+    # ingest    textFileToBinary.py   write binary traces from text files, using the task files in config_files
+    # copy      dataDump.py           copy and sort raw data files
+    # tz        TzFuncs.py            time zone conversions
+    # gapfill   methaneGapfillML.py   ML gap-filling of the ThirdStage fluxes
+    # era5      ERA5_multi_site.py    download (and convert) ERA5 data for a list of sites
+    # pyramid   tracePyramid.py       build or update the daily/weekly/monthly aggregates of a site's traces
+    # archive   traceArchive.py       pack completed years into compressed archives, or unpack them for the matlab tools
+    # clean1    firstStageCleaning.py first stage cleaning with the FirstStage ini files (range and dependency filters)
+    # pipeline  pipelineRunner.py     run the steps of a pipeline (e.g., the nightly processing) whose inputs changed
+# Example calls from command line:
+    # py biomet.py export --siteID BB --dateRange "2024-01-01 00:00" "2024-12-31 23:59"
+    # py biomet.py gapfill --help
+    # py biomet.py --service gapfill --site BB --year 2024 --db_path C:/Database --mode gapfill
+# Tools are only imported once their subcommand runs, so this script itself starts in milliseconds
+    # --import-time prints how long the tool took to import
+    # benchmarkDatabase.py tracks the startup time of each subcommand (benchmark cli_startup)
+# A tool that needs a package that isn't installed (e.g., xarray for era5) exits with a message naming the package
+# --service runs the tool in the Biomet python service if it is running (see biometService.py)
+
+import os
+import sys
+import time
+import argparse
+import importlib
+
+start = time.perf_counter()
+
+commands = {
+    'export':'csvFromBinary',
+    'ingest':'textFileToBinary',
+    'copy':'dataDump',
+    'tz':'TzFuncs',
+    'gapfill':'methaneGapfillML',
+    'era5':'ERA5_multi_site',
+    'pyramid':'tracePyramid',
+    'archive':'traceArchive',
+    'clean1':'firstStageCleaning',
+    'pipeline':'pipelineRunner',
+}
+
+def run(command,args=[],service=False,import_time=False):
+    # Runs a subcommand and returns its exit code
+    import biometService as bs
+    module = commands[command]
+    if service:
+        return(bs.run_script(os.path.join(bs.moduleDir,f"{module}.py"),args))
+    if import_time:
+        t = time.perf_counter()
+        try:
+            importlib.import_module(module)
+        except ModuleNotFoundError as e:
+            sys.stderr.write(bs.missing_package(e))
+            return(1)
+        print(f"Started in {t-start:.3f} s, imported {module} in {time.perf_counter()-t:.3f} s",file=sys.stderr)
+    reply = bs.execute({'kind':'run','script':os.path.join(bs.moduleDir,f"{module}.py"),'args':list(args)},capture=False)
+    if reply['error']:
+        sys.stderr.write(reply['error'])
+    return(reply['exit_code'])
+
+# If called from command line ...
+if __name__ == '__main__':
+
+    CLI=argparse.ArgumentParser(
+        description='Biomet.net python tools. Run "biomet.py <command> --help" for the arguments of a command.',
+        epilog='commands: '+', '.join(f"{c} ({m}.py)" for c,m in commands.items()),
+        )
+    CLI.add_argument("--service",action='store_true',help='run the command in the Biomet python service if it is running')
+    CLI.add_argument("--import-time",action='store_true',help='print the time taken to import the tool')
+    CLI.add_argument("command",choices=list(commands.keys()))
+    CLI.add_argument("args",nargs=argparse.REMAINDER,help='arguments passed on to the tool')
+
+    args = CLI.parse_args()
+    sys.exit(run(args.command,args.args,args.service,args.import_time))
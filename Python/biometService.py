@@ -0,0 +1,338 @@
+# Long-lived local worker for the Biomet.net python tools, and the thin client used to call it
+# Each command line call of a tool pays for python startup, the imports of pandas/numpy/yaml/fluxgapfill
+#   and parsing the yaml configs; the service pays for these once and keeps them in memory
+# Start it once (e.g., at login or from the task scheduler):
+    # py biometService.py serve --preload csvFromBinary binaryFromText methaneGapfillML
+# Then call the tools through the client with their usual command line arguments:
+    # py biometService.py run csvFromBinary.py --siteID BB --dateRange "2024-01-01 00:00" "2024-12-31 23:59"
+    # py biometService.py run methaneGapfillML.py --site BB --year 2024 --db_path C:/Database --mode gapfill
+# If the service is not running, the client runs the tool itself, so callers behave the same either way
+# Python callers can also call the tools' functions and get their return values back:
+    # import biometService as bs
+    # results = bs.call('csvFromBinary','makeCSV',siteID='BB',dateRange=['2024-01-01 00:00','2024-12-31 23:59'])
+# Other commands: py biometService.py status | stop
+# The service listens on a unix socket (a named pipe on Windows) only reachable from this machine
+    # the socket is in a folder only the user can access (<tmp>/biomet_service_<user>/) and is itself only accessible by the user
+    # clients authenticate with a random key, created when the service first starts and kept in ~/.biomet/service_key (mode 600),
+    #   so only the user who started the service can run jobs in it (it runs any tool or function it is sent)
+    # set BIOMET_SERVICE_ADDRESS and BIOMET_SERVICE_KEY to override the default address and authentication key
+# Jobs run one at a time (jobLock), in the working directory of the caller, and their printed output is returned to the client
+# Tools with a cli(argv) entry point (csvFromBinary, methaneGapfillML, methaneGapfillCampaign) are imported once and called with the job's arguments,
+#   so their module state (e.g., caches) is kept from one job to the next; other scripts are run from scratch (runpy) with sys.argv set
+# Only standard library modules are imported here, so the client starts quickly
+
+import io
+import os
+import sys
+import time
+import runpy
+import getpass
+import secrets
+import argparse
+import tempfile
+import importlib
+import threading
+import traceback
+import contextlib
+from multiprocessing.connection import Listener, Client, AuthenticationError
+
+moduleDir = os.path.dirname(os.path.abspath(__file__))
+keyFile = os.path.join(os.path.expanduser('~'),'.biomet','service_key')
+# The key of earlier versions, public in this file, is never accepted
+builtinKey = b'biomet.net'
+
+def private_dir(path):
+    # Creates a folder only this user can access, and refuses an existing one that other users can access
+    os.makedirs(path,mode=0o700,exist_ok=True)
+    if os.name == 'posix':
+        stat = os.stat(path)
+        if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+            raise PermissionError(f"{path} has to be owned by {getpass.getuser()} and not accessible to other users (chmod 700)")
+    return(path)
+
+def default_address():
+    if 'BIOMET_SERVICE_ADDRESS' in os.environ:
+        return(os.environ['BIOMET_SERVICE_ADDRESS'])
+    if sys.platform.startswith('win'):
+        return(rf"\\.\pipe\biomet_service_{getpass.getuser()}")
+    return(os.path.join(private_dir(os.path.join(tempfile.gettempdir(),f"biomet_service_{getpass.getuser()}")),'service.sock'))
+
+def authkey(create=False):
+    # Authentication key: BIOMET_SERVICE_KEY, or the random key in keyFile (created if create is True)
+    # Returns None if there is no key yet, i.e., the service was never started by this user
+    if 'BIOMET_SERVICE_KEY' in os.environ:
+        key = os.environ['BIOMET_SERVICE_KEY'].encode()
+    else:
+        try:
+            if os.name == 'posix' and os.stat(keyFile).st_mode & 0o077:
+                raise PermissionError(f"{keyFile} is accessible to other users, run: chmod 600 {keyFile}")
+            with open(keyFile,'rb') as f:
+                key = f.read().strip()
+        except FileNotFoundError:
+            if not create:
+                return(None)
+            private_dir(os.path.dirname(keyFile))
+            key = secrets.token_hex(32).encode()
+            try:
+                fd = os.open(keyFile,os.O_WRONLY|os.O_CREAT|os.O_EXCL,0o600)
+            except FileExistsError:
+                # Created by another service starting at the same time
+                return(authkey())
+            with os.fdopen(fd,'wb') as f:
+                f.write(key)
+    if not key or key == builtinKey:
+        raise ValueError(f"Refusing the built-in authentication key, unset BIOMET_SERVICE_KEY or delete {keyFile} to use a random key")
+    return(key)
+
+# pip packages of the imports whose names differ, for the message when one is missing
+pipPackages = {
+    'yaml':'PyYAML',
+    'sklearn':'scikit-learn',
+    'fluxgapfill':'git+https://github.com/mjfortier/methane-gapfill-ml.git',
+}
+
+def missing_package(e):
+    # Message for a ModuleNotFoundError raised by a tool, without the traceback
+    name = (e.name or '').split('.')[0]
+    return(f"The python package {name} is not installed, it can be installed with: pip install {pipPackages.get(name,name)} (see requirements.txt)\n")
+
+# Jobs change the working directory and redirect the output of the whole process, so only one runs at a time
+jobLock = threading.Lock()
+
+def resolve_script(script):
+    # Tools can be named relative to the caller's directory or to this folder, with or without .py
+    for candidate in [script,script+'.py',os.path.join(moduleDir,script),os.path.join(moduleDir,script+'.py')]:
+        if os.path.isfile(candidate):
+            return(os.path.abspath(candidate))
+    raise FileNotFoundError(f"Could not find the script {script}")
+
+def entry_point(script):
+    # cli(argv) of a tool in this folder, or None for scripts that have to be run with runpy
+    if os.path.dirname(script) != moduleDir:
+        return(None)
+    module = importlib.import_module(os.path.splitext(os.path.basename(script))[0])
+    return(getattr(module,'cli',None))
+
+def execute(job,capture=True):
+    # Runs a job in this process and returns the reply sent to the client
+        # {'kind':'run','script':...,'args':[...],'cwd':...} runs a script as if called from the command line
+        # {'kind':'call','module':...,'function':...,'args':[...],'kwargs':{...},'cwd':...} returns the function's result
+    reply = {'ok':True,'result':None,'exit_code':0,'error':None}
+    output = io.StringIO()
+    start = time.perf_counter()
+    redirect = [contextlib.redirect_stdout(output),contextlib.redirect_stderr(output)] if capture else []
+    jobLock.acquire()
+    cwd,argv = os.getcwd(),sys.argv
+    try:
+        os.chdir(job.get('cwd',cwd))
+        with contextlib.ExitStack() as stack:
+            for r in redirect:
+                stack.enter_context(r)
+            if job['kind'] == 'run':
+                script = resolve_script(job['script'])
+                cli = entry_point(script)
+                if cli is not None:
+                    cli(list(job.get('args',[])))
+                else:
+                    sys.argv = [script]+list(job.get('args',[]))
+                    runpy.run_path(script,run_name='__main__')
+            else:
+                module = importlib.import_module(job['module'])
+                reply['result'] = getattr(module,job['function'])(*job.get('args',[]),**job.get('kwargs',{}))
+    except SystemExit as e:
+        # Tools exit with a message (readConfig) or a status code
+        if isinstance(e.code,int) or e.code is None:
+            reply['exit_code'] = e.code or 0
+        else:
+            print(e.code,file=output if capture else sys.stderr)
+            reply['exit_code'] = 1
+        reply['ok'] = reply['exit_code'] == 0
+    except ModuleNotFoundError as e:
+        # A tool (or one of the packages it imports) needs a package that isn't installed
+        reply['ok'] = False
+        reply['exit_code'] = 1
+        reply['error'] = missing_package(e) if e.name else traceback.format_exc()
+    except Exception:
+        reply['ok'] = False
+        reply['exit_code'] = 1
+        reply['error'] = traceback.format_exc()
+    finally:
+        os.chdir(cwd)
+        sys.argv = argv
+        jobLock.release()
+    reply['output'] = output.getvalue()
+    reply['seconds'] = round(time.perf_counter()-start,3)
+    return(reply)
+
+class biometService():
+    def __init__(self,address=None,preload=[]):
+        self.address = address or default_address()
+        self.lock = threading.Lock()
+        self.running = True
+        self.started = time.time()
+        self.jobs = 0
+        for module in preload:
+            t = time.perf_counter()
+            importlib.import_module(module)
+            print(f"Loaded {module} in {time.perf_counter()-t:.2f} s")
+
+    def status(self):
+        return({
+            'address':self.address,
+            'pid':os.getpid(),
+            'uptime_s':round(time.time()-self.started,1),
+            'jobs':self.jobs,
+            'modules':sorted(m for m in sys.modules if os.path.dirname(getattr(sys.modules[m],'__file__',None) or '') == moduleDir),
+        })
+
+    def serve(self):
+        if ping(self.address) is not None:
+            sys.exit(f"A service is already listening on {self.address}")
+        self.key = authkey(create=True)
+        unixSocket = not self.address.startswith('\\\\')
+        if unixSocket and os.path.exists(self.address):
+            # Left behind by a service that didn't shut down cleanly
+            os.remove(self.address)
+        # The socket is created accessible to this user only
+        umask = os.umask(0o177) if unixSocket else None
+        try:
+            self.listener = Listener(self.address,authkey=self.key)
+        finally:
+            if umask is not None:
+                os.umask(umask)
+        if unixSocket:
+            os.chmod(self.address,0o600)
+        print(f"Biomet service listening on {self.address} (pid {os.getpid()})")
+        try:
+            while self.running:
+                try:
+                    conn = self.listener.accept()
+                except (OSError,EOFError,AuthenticationError) as e:
+                    if self.running:
+                        print(f"Rejected connection: {e}")
+                    continue
+                threading.Thread(target=self.handle,args=(conn,),daemon=True).start()
+        finally:
+            self.listener.close()
+            print('Biomet service stopped')
+
+    def handle(self,conn):
+        with conn:
+            while True:
+                try:
+                    job = conn.recv()
+                except (EOFError,OSError):
+                    return
+                if job['kind'] == 'ping':
+                    reply = {'ok':True,'result':self.status()}
+                elif job['kind'] == 'stop':
+                    reply = {'ok':True,'result':None}
+                    self.running = False
+                else:
+                    reply = execute(job)
+                    with self.lock:
+                        self.jobs += 1
+                try:
+                    conn.send(reply)
+                except Exception as e:
+                    # e.g., a result that can't be pickled
+                    conn.send(reply|{'ok':False,'result':None,'error':f"Could not send the result: {e}"})
+                if not self.running:
+                    # Wake up the accept() call so the service loop can exit
+                    with contextlib.suppress(OSError):
+                        Client(self.address,authkey=self.key).close()
+                    return
+
+def connect(address=None):
+    key = authkey()
+    if key is None:
+        return(None)
+    try:
+        return(Client(address or default_address(),authkey=key))
+    except (OSError,EOFError,AuthenticationError):
+        return(None)
+
+def request(job,address=None,fallback=True):
+    # Sends a job to the service, or runs it in this process if the service isn't running and fallback is True
+    job = {'cwd':os.getcwd()}|job
+    conn = connect(address)
+    if conn is None:
+        if not fallback:
+            raise ConnectionError(f"No biomet service is listening on {address or default_address()}")
+        return(execute(job,capture=False)|{'local':True})
+    with conn:
+        conn.send(job)
+        return(conn.recv()|{'local':False})
+
+def ping(address=None):
+    # Status of the service, or None if it isn't running
+    conn = connect(address)
+    if conn is None:
+        return(None)
+    with conn:
+        conn.send({'kind':'ping'})
+        return(conn.recv()['result'])
+
+def stop(address=None):
+    conn = connect(address)
+    if conn is None:
+        return(False)
+    with conn:
+        conn.send({'kind':'stop'})
+        conn.recv()
+    return(True)
+
+def run_script(script,args=[],address=None,fallback=True):
+    # Same as calling: py <script> <args>; returns the exit code
+    reply = request({'kind':'run','script':script,'args':list(args)},address,fallback)
+    if not reply['local']:
+        sys.stdout.write(reply['output'])
+    if reply['error']:
+        sys.stderr.write(reply['error'])
+    return(reply['exit_code'])
+
+def call(module,function,*args,address=None,fallback=True,**kwargs):
+    # Calls module.function(*args,**kwargs) in the service and returns its result
+    reply = request({'kind':'call','module':module,'function':function,'args':list(args),'kwargs':kwargs},address,fallback)
+    if not reply['local']:
+        sys.stdout.write(reply['output'])
+    if not reply['ok']:
+        raise RuntimeError(reply['error'] or f"{module}.{function} exited with code {reply['exit_code']}")
+    return(reply['result'])
+
+# If called from command line ...
+if __name__ == '__main__':
+
+    CLI=argparse.ArgumentParser()
+    CLI.add_argument("--address",nargs="?",type=str,default=None)
+    commands = CLI.add_subparsers(dest='command',required=True)
+
+    serve = commands.add_parser('serve',help='start the service')
+    serve.add_argument("--preload",nargs='+',type=str,default=[],help='modules to import at startup')
+
+    run = commands.add_parser('run',help='run a tool through the service (or locally if it is not running)')
+    run.add_argument("script",type=str)
+    run.add_argument("args",nargs=argparse.REMAINDER)
+    run.add_argument("--local",action='store_true',help='run locally even if the service is running')
+
+    commands.add_parser('status',help='show the status of the service')
+    commands.add_parser('stop',help='stop the service')
+
+    args = CLI.parse_args()
+    # The tools are imported from this folder
+    sys.path.insert(0,moduleDir)
+
+    if args.command == 'serve':
+        biometService(args.address,args.preload).serve()
+    elif args.command == 'run':
+        if args.local:
+            sys.exit(execute({'kind':'run','script':args.script,'args':args.args},capture=False)['exit_code'])
+        sys.exit(run_script(args.script,args.args,args.address))
+    elif args.command == 'status':
+        status = ping(args.address)
+        if status is None:
+            sys.exit(f"No biomet service is listening on {args.address or default_address()}")
+        for key,val in status.items():
+            print(f"{key}: {val}")
+    elif args.command == 'stop':
+        print('Service stopped' if stop(args.address) else 'No service was running')
@@ -10,17 +10,27 @@
     # cfb.makeCSV(siteID="BBS",dateRange=["2023-06-01 00:00","2024-05-31 23:59"],tasks=["config_files/csv_tasks_template.yml"])
 # Setup the config files for your environment accordingly before running
 
+# Outputs are only regenerated when needed (update argument):
+    # changed (default): skip an output if its source traces (size and mtime), task and date range are unchanged since it was written
+    # all: regenerate every output
+    # append: append the rows after the last exported row to {siteID}_{task}.csv (e.g., a data portal feed growing each day)
+    #   trailing rows without data are held back until data arrives; rows already exported are not rewritten
+    #   the file is rewritten if the task changed or the file was modified since the last export (or for resampled tasks)
+    # py csvFromBinary.py --siteID BBS --dateRange "2020-01-01 00:00" "2030-12-31 23:59" --update append
+# The manifest of each output is kept in outputPath/.manifest/<file name>.json
+
 import os
 import sys
 import json
+import hashlib
 import argparse
 import numpy as np
 import pandas as pd
 import readConfig as rCfg
+import runMetrics as rm
+import traceArchive as ta
 from datetime import datetime,date
 
-os.chdir(os.path.split(__file__)[0])
-
 template = 'config_files/csv_from_binary.yml'
 defaultDateRange = [date(datetime.now().year,1,1),datetime.now()]
 
@@ -32,11 +42,13 @@ defaultArgs = {
     'outputPath':'None',
     'tasks':[template],
     'stage':'None',
-    'nameTimeStamp':True
+    'nameTimeStamp':True,
+    'update':'changed',
     }
 
 # Create the csv
 # args with "None" value provide option to overwrite default
+@rm.timed('makeCSV')
 def makeCSV(**kwargs):
     # Apply defaults where not defined
     kwargs = defaultArgs | kwargs
@@ -55,11 +67,10 @@ def makeCSV(**kwargs):
     else: root = kwargs['database']
 
     Range_index = pd.DatetimeIndex(kwargs['dateRange'])
+    resolution = pd.Timedelta(config['dbase_metadata']['timestamp']['resolution'])
 
     print(f'Generating requested files tasks for {siteID} over:', f"{Range_index.strftime(date_format='%Y-%m-%d %H:%M').values}") 
     
-    # Years to process
-    Years = range(Range_index.year.min(),Range_index.year.max()+1)
     results = {}
     for name,task in config['tasks'].items():
 
@@ -67,6 +78,45 @@ def makeCSV(**kwargs):
             task['stage']=config['stage'][kwargs['stage']]
         elif task['stage'] in config['stage'].keys():
             task['stage']=config['stage'][task['stage']]
+
+        # Format filename, append mode always writes to the same file
+        dates = Range_index.strftime('%Y%m%d%H%M')
+        if kwargs['nameTimeStamp'] == True and kwargs['update'] != 'append':
+            fn = f"{siteID}_{name}_{dates[0]}_{dates[1]}"
+        else:
+            fn = f"{siteID}_{name}"
+        dout = f"{outputPath}/{fn}.csv"
+        manifestPath = os.path.join(outputPath,'.manifest',f"{fn}.json")
+        manifest = read_manifest(manifestPath) if kwargs['update'] != 'all' else {}
+        # The output wasn't modified since it was last written
+        current = os.path.isfile(dout) and manifest.get('output') == file_stat(dout)
+        append = kwargs['update'] == 'append' and 'resample' not in task['formatting']
+        taskHash = task_hash(task,siteID,root,None if append else kwargs['dateRange'])
+        sources = source_stats(root,taskYears(Range_index,resolution),siteID,task,config)
+        if kwargs['update'] == 'changed' and current and manifest.get('task') == taskHash and manifest.get('sources') == sources:
+            print(f'Unchanged since last export: {dout}')
+            results[name]=dout
+            continue
+        taskRange = Range_index
+        append = append and current and manifest.get('task') == taskHash and 'last' in manifest
+        if append:
+            # Only the rows after the last exported row
+            taskRange = pd.DatetimeIndex([max(Range_index.min(),pd.Timestamp(manifest['last'])+resolution),Range_index.max()])
+            if taskRange[0] > taskRange[1]:
+                print(f'No new rows to append to: {dout}')
+                results[name]=dout
+                continue
+        # Years to process, only those in the database
+        Years = [YYYY for YYYY in taskYears(taskRange,resolution)
+                 if ta.exists(f"{root}{YYYY}/{siteID}/{task['stage']}/{config['dbase_metadata']['timestamp']['name']}")]
+        if not Years and append:
+            # The database ends at or before the last exported row
+            print(f'No new rows to append to: {dout}')
+            results[name]=dout
+            continue
+        if not Years:
+            print(f"No data for {siteID}/{task['stage']} between {taskRange.min()} and {taskRange.max()}, skipping: {dout}")
+            continue
         # Create a dict of traces
         traces={}
         # Create a list of column header - unit tuples
@@ -75,13 +125,16 @@ def makeCSV(**kwargs):
         # Create a blank dataframe
         df = pd.DataFrame()
         file = f"{siteID}/{task['stage']}/{config['dbase_metadata']['timestamp']['name']}"
-        tv = np.concatenate(
-            [np.fromfile(f"{root}{YYYY}/{file}",config['dbase_metadata']['timestamp']['dtype']) for YYYY in Years],
-            axis=0)
+        with rm.stage('makeCSV.read',task=name):
+            tv = [ta.read(f"{root}{YYYY}/{file}",config['dbase_metadata']['timestamp']['dtype']) for YYYY in Years]
+            rm.count_read(nBytes=sum(t.nbytes for t in tv),nFiles=len(Years))
+            # Rows of each year within the requested range, only these are read (or decompressed if archived) from the traces
+            rows = [yearRows(t,taskRange,config) for t in tv]
+            tv = np.concatenate([t[r] for t,r in zip(tv,rows)],axis=0)
         
-        DT = pd.to_datetime(tv-config['dbase_metadata']['timestamp']['base'],unit=config['dbase_metadata']['timestamp']['base_unit']).round('S')
+        DT = pd.to_datetime(tv-config['dbase_metadata']['timestamp']['base'],unit=config['dbase_metadata']['timestamp']['base_unit']).round('s')
         differences = DT.to_series().diff()
-        expected_difference = pd.Timedelta(config['dbase_metadata']['timestamp']['resolution'])
+        expected_difference = resolution
         anomalies = ((differences != expected_difference)&(pd.isnull(differences) == False))
         if anomalies.sum()>1:
             ipt = input(f'Warning: timestamp file {file} appears to be corrupted.  Attempt to coerce Y/N')
@@ -103,8 +156,10 @@ def makeCSV(**kwargs):
             # if exists (over full period) output
             try:
                 file = f"{siteID}/{task['stage']}/{trace_name}"
-                trace = [np.fromfile(f"{root}{YYYY}/{file}",config['dbase_metadata']['traces']['dtype']) for YYYY in Years]
-                traces[trace_name]=np.concatenate(trace,axis=0)
+                with rm.stage('makeCSV.read',task=name):
+                    trace = [ta.read(f"{root}{YYYY}/{file}",config['dbase_metadata']['traces']['dtype'],rows=r) for YYYY,r in zip(Years,rows)]
+                    traces[trace_name]=np.concatenate(trace,axis=0)
+                    rm.count_read(nBytes=traces[trace_name].nbytes,nFiles=len(Years))
             # give NaN if traces does not exist
             except:
                 print(f"{trace_name} missing, outputting NaNs")
@@ -114,7 +169,16 @@ def makeCSV(**kwargs):
         # dump traces to dataframe
         df = pd.DataFrame(data=traces,index=DT)
         # limit to requested timeframe
-        df = df.loc[((df.index>=Range_index.min())&(df.index<= Range_index.max()))]
+        df = df.loc[((df.index>=taskRange.min())&(df.index<= taskRange.max()))]
+        if kwargs['update'] == 'append':
+            # Hold back trailing rows without data (e.g., the rest of the year), they are exported once data arrives
+            hasData = np.flatnonzero(df[list(task['traces'].keys())].notna().any(axis=1).values)
+            df = df.iloc[:hasData[-1]+1] if hasData.size else df.iloc[:0]
+            if df.empty:
+                print(f'No new rows to append to: {dout}')
+                results[name]=dout
+                continue
+        last = df.index.max()
         # Apply optional resampling 
         # Add units to header (preferred) or exclude (dangerous)
         if task['formatting']['units_in_header'] == True:
@@ -144,24 +208,70 @@ def makeCSV(**kwargs):
         else:
             df = df.fillna(task['formatting']['na_value'])
 
-        # Format filename and save output
-        dates = Range_index.strftime('%Y%m%d%H%M')
-        if kwargs['nameTimeStamp'] == True:
-            fn = f"{siteID}_{name}_{dates[0]}_{dates[1]}"
-        else:
-            fn = f"{siteID}_{name}"
+        # Save output
         if os.path.isdir(outputPath) == False:
             os.makedirs(outputPath)
-        dout = f"{outputPath}/{fn}.csv"
-        df.to_csv(dout,index=False)
+        with rm.stage('makeCSV.write',task=name):
+            if append:
+                df.to_csv(dout,index=False,header=False,mode='a')
+            else:
+                df.to_csv(dout,index=False)
+            rm.count_written(dout)
+        write_manifest(manifestPath,{'task':taskHash,'sources':sources,'last':last.isoformat(),'output':file_stat(dout)})
 
-        print(f'See output: {dout}')
+        if append:
+            print(f'Appended {df.shape[0]} rows to: {dout}')
+        else:
+            print(f'See output: {dout}')
         results[name]=dout
     return(results)
 
-# If called from command line ...
-if __name__ == '__main__':
-    
+# Size and mtime of a file (in the database: of the year file, archived or not)
+def file_stat(path):
+    try:
+        return(ta.file_stat(path))
+    except FileNotFoundError:
+        return(None)
+
+# Size and mtime of the timestamps and traces read by a task, in the years of the database
+def source_stats(root,Years,siteID,task,config):
+    names = [config['dbase_metadata']['timestamp']['name']]+list(task['traces'].keys())
+    Years = [YYYY for YYYY in Years if file_stat(f"{root}{YYYY}/{siteID}/{task['stage']}/{names[0]}") is not None]
+    return({f"{YYYY}/{nm}":file_stat(f"{root}{YYYY}/{siteID}/{task['stage']}/{nm}") for YYYY in Years for nm in names})
+
+# Hash of everything defining an output other than the source data
+def task_hash(task,siteID,root,dateRange):
+    definition = {'task':task,'siteID':siteID,'database':root,'dateRange':dateRange}
+    return(hashlib.blake2b(json.dumps(definition,sort_keys=True,default=str).encode(),digest_size=16).hexdigest())
+
+def read_manifest(path):
+    try:
+        with open(path) as f:
+            return(json.load(f))
+    except (FileNotFoundError,json.JSONDecodeError):
+        return({})
+
+def write_manifest(path,manifest):
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    with open(path+'.tmp','w') as f:
+        json.dump(manifest,f)
+    os.replace(path+'.tmp',path)
+
+# Slice of a year's timestamps within the requested range
+# Year files holding the timestamps of Range_index: timestamps mark the end of each period,
+# so Jan 1 00:00 is the last row of the previous year's file
+def taskYears(Range_index,resolution):
+    return(range((Range_index.min()-resolution).year,(Range_index.max()-resolution).year+1))
+
+def yearRows(tv,Range_index,config):
+    DT = pd.to_datetime(tv-config['dbase_metadata']['timestamp']['base'],unit=config['dbase_metadata']['timestamp']['base_unit']).round('s')
+    inRange = np.flatnonzero((DT>=Range_index.min())&(DT<=Range_index.max()))
+    if inRange.size == 0:
+        return(slice(0,0))
+    return(slice(inRange[0],inRange[-1]+1))
+
+def cli(argv=None):
+    # Command line entry point, also called by biometService.py with the job's arguments
     CLI=argparse.ArgumentParser()
     
     dictArgs = []
@@ -179,8 +289,12 @@ if __name__ == '__main__':
         CLI.add_argument(f"--{key}",nargs=nargs,type=dt,default=val)
 
     # parse the command line
-    args = CLI.parse_args()
+    args = CLI.parse_args(argv)
     kwargs = vars(args)
     for d in dictArgs:
         kwargs[d] = json.loads(kwargs[d])
-    makeCSV(**kwargs)
\ No newline at end of file
+    makeCSV(**kwargs)
+
+# If called from command line ...
+if __name__ == '__main__':
+    cli()
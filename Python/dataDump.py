@@ -2,11 +2,11 @@
 from progressBar import progressbar
 from collections import defaultdict
 import readConfig as rCfg
+import runMetrics as rm
 import pandas as pd
 import subprocess
 import argparse
 import datetime
-import psutil
 import shutil
 import json
 import sys
@@ -27,10 +27,13 @@ defaultArgs = {
 }
 
 def set_high_priority():
+    # imported here, only this function needs it
+    import psutil
     p = psutil.Process(os.getpid())
     p.nice(psutil.HIGH_PRIORITY_CLASS)
 
 class copyFiles():
+    @rm.timed('copyFiles')
     def __init__(self,dIn=None,**kwargs):
         self.dIn=dIn
         # Apply defaults where not defined
@@ -95,10 +98,14 @@ class copyFiles():
                 if self.dOut !='':
                     pb = progressbar(len(source),f'copying: {dir.replace(self.dIn,"")}')
                     for s,p,f in zip(source,dpath,filename):
+                        nBytes = 0
                         if s not in self.fileInventory['source'] and p not in self.fileInventory['dpath']:
                             if self.overWrite == True or f not in self.fileInventory['filename']:
                                 self.pasteWithSubprocess(s,p)
-                        pb.step()
+                                nBytes = os.path.getsize(s)
+                                rm.count_read(nBytes=nBytes)
+                                rm.count_written(nBytes=nBytes)
+                        pb.step(nBytes=nBytes)
                     pb.close()
                 self.fileInventory=pd.concat([self.fileInventory,
                         pd.DataFrame(data={
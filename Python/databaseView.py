@@ -0,0 +1,131 @@
+# Lazy xarray view of the binary database, over many sites and years
+# open_database returns an xarray.Dataset with dimensions (time, site) and one variable per trace
+    # nothing is read until values are used: indexing reads only the years (and rows) needed
+    # loose year files are memory mapped, archived years (see traceArchive.py) decompress only the chunks needed
+    # the time coordinate is the regular timestamp grid (end of each period): Jan 1 00:30 to Jan 1 00:00 of the next year
+    # a trace that is missing for a site and year (or doesn't match the grid) is NaN
+# With dask installed, chunks='year' gives one chunk per year file and site, so network-wide computations
+#   (e.g., climatologies, correlations between sites) run out-of-core and in parallel
+#   dask is not in requirements.txt and the chunked path (chunks='year' or other chunks) is untested
+# Without dask, the dataset is still lazy, and computations load the selected values into memory
+
+# Example calls from python:
+    # import databaseView as dv
+    # ds = dv.open_database(sites=['BB','BB2','DSM'],stage='Third',years=range(2015,2025),traces=['FC','TA_1_1_1'])
+    # ds['TA_1_1_1'].sel(time='2020-07').mean('time').values
+    # ds = dv.open_database(sites=['BB','BB2'],chunks='year')
+    # climatology = ds['FC'].groupby('time.dayofyear').mean().compute()
+
+import os
+import importlib.util
+import numpy as np
+import pandas as pd
+import xarray as xr
+from xarray.core import indexing
+import readConfig as rCfg
+import traceArchive as ta
+
+def year_grid(year,resolution):
+    # Timestamps of a year file
+    resolution = pd.Timedelta(resolution)
+    return(pd.date_range(pd.Timestamp(year,1,1)+resolution,pd.Timestamp(year+1,1,1),freq=resolution))
+
+class yearFiles():
+    # The year files of one trace for a list of sites, with their positions on the time grid
+    def __init__(self,config,sites,stage,years,trace,dtype):
+        self.config = config
+        self.sites = sites
+        self.stage = config['stage'].get(stage,stage)
+        self.years = years
+        self.trace = trace
+        self.dtype = np.dtype(dtype)
+        self.lengths = [len(year_grid(y,config['dbase_metadata']['timestamp']['resolution'])) for y in years]
+        self.offsets = np.concatenate([[0],np.cumsum(self.lengths)])
+
+    def path(self,site,year):
+        return(os.path.join(self.config['rootDir']['database'],str(year),site,self.stage,self.trace))
+
+    def read(self,site,i,first,last):
+        # Rows first:last of the i-th year file of a site, NaN if missing or not matching the grid
+        path = self.path(site,self.years[i])
+        try:
+            size = ta.file_stat(path)[0]
+        except FileNotFoundError:
+            size = None
+        if size != self.lengths[i]*self.dtype.itemsize:
+            return(np.full(last-first,np.nan,dtype=self.dtype))
+        if os.path.isfile(path):
+            return(np.memmap(path,dtype=self.dtype,mode='r')[first:last])
+        return(ta.read(path,self.dtype,slice(first,last)))
+
+class traceArray(xr.backends.BackendArray):
+    # (time, site) array of one trace, read on indexing
+    def __init__(self,files):
+        self.files = files
+        self.shape = (int(files.offsets[-1]),len(files.sites))
+        self.dtype = files.dtype
+
+    def __getitem__(self,key):
+        return(indexing.explicit_indexing_adapter(key,self.shape,indexing.IndexingSupport.BASIC,self.raw_indexing))
+
+    def raw_indexing(self,key):
+        # key is a tuple of ints or slices
+        rows = np.arange(self.shape[0])[key[0]]
+        sites = np.arange(self.shape[1])[key[1]]
+        rows_,sites_ = np.atleast_1d(rows),np.atleast_1d(sites)
+        out = np.full((rows_.size,sites_.size),np.nan,dtype=self.dtype)
+        if rows_.size:
+            lo,hi = rows_.min(),rows_.max()+1
+            offsets = self.files.offsets
+            for j,s in enumerate(sites_):
+                block = np.empty(hi-lo,dtype=self.dtype)
+                # Only the year files overlapping lo:hi
+                for i in range(np.searchsorted(offsets,lo,side='right')-1,np.searchsorted(offsets,hi,side='left')):
+                    first,last = max(lo,offsets[i]),min(hi,offsets[i+1])
+                    block[first-lo:last-lo] = self.files.read(self.files.sites[s],i,first-offsets[i],last-offsets[i])
+                out[:,j] = block[rows_-lo]
+        return(out.reshape(np.shape(rows)+np.shape(sites)))
+
+def available(config,stage,sites=None,years=None):
+    # Sites and years with the stage's timestamps, and the union of their traces
+    root = config['rootDir']['database']
+    stage = config['stage'].get(stage,stage)
+    ts = config['dbase_metadata']['timestamp']['name']
+    years = sorted(int(y) for y in years) if years else sorted(int(y) for y in os.listdir(root) if y.isnumeric())
+    found,traces = set(),set()
+    for year in years:
+        folder = os.path.join(root,str(year))
+        for site in (sites or (sorted(os.listdir(folder)) if os.path.isdir(folder) else [])):
+            names = ta.listdir(os.path.join(folder,site,stage))
+            if ts in names:
+                found.add(site)
+                traces.update(n for n in names if n != ts and '.' not in n)
+    return(list(sites or sorted(found)),years,sorted(traces))
+
+def open_database(sites=None,stage='Third',years=None,traces=None,database=None,chunks=None):
+    # Lazy xarray.Dataset of the traces of a stage, dimensions (time, site)
+    # sites, years and traces default to all found in the database
+    # chunks='year' (needs dask, untested) chunks each variable by year file and site; other values are passed to Dataset.chunk
+    config = rCfg.set_user_configuration()
+    if database is not None:
+        config['rootDir']['database'] = database
+    sites,years,found = available(config,stage,sites,years)
+    traces = traces or found
+    resolution = config['dbase_metadata']['timestamp']['resolution']
+    time = pd.DatetimeIndex(np.concatenate([year_grid(y,resolution).values for y in years]) if years else [],name='time')
+    data = {}
+    for trace in traces:
+        files = yearFiles(config,sites,stage,years,trace,config['dbase_metadata']['traces']['dtype'])
+        data[trace] = xr.Variable(('time','site'),indexing.LazilyIndexedArray(traceArray(files)))
+    ds = xr.Dataset(data,coords={'time':time,'site':sites},
+                    attrs={'database':config['rootDir']['database'],'stage':config['stage'].get(stage,stage),
+                           'timestamp':'end of period','resolution':resolution})
+    if chunks:
+        if importlib.util.find_spec('dask') is None:
+            print('dask is not installed, returning the dataset without chunks (still read lazily)')
+        elif chunks == 'year':
+            lengths = tuple(len(year_grid(y,resolution)) for y in years)
+            ds = ds.chunk({'time':lengths,'site':1})
+        else:
+            ds = ds.chunk(chunks)
+    return(ds)
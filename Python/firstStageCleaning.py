@@ -0,0 +1,467 @@
+# First stage cleaning of the binary database with the TRACEANALYSIS_FIRSTSTAGE ini files, without matlab
+# Reads Calculation_Procedures/TraceAnalysis_ini/SiteID/SiteID_FirstStage.ini the same way as read_ini_file.m
+#   (#include, #if ... #endif, globalVars, inputFileName_dates, Overwrite) and applies, as in clean_traces.m:
+    # zeroPt (0 by default), minMax (1x2 or 12x2 monthly limits) and clamped_minMax
+    # NaN-ing of points after the last valid point of the current year
+    # dependent: points removed from a trace (and any NaN in it) are removed from its dependents,
+    #   including dependents of dependents (tags from tags_Standard.m and SiteID_CustomTags.m are expanded)
+    # interpolation of short gaps (interpLength) when globalVars.other.singlePointInterpolation is set
+# Each rule runs once on a 2D array of all the site's traces (traces x time); dependencies are resolved in topological order
+# Traces are written like fr_automated_cleaning.m stage 1: Database/YYYY/SiteID/<measurementType>/Clean/<variableName>
+# Not supported here (left to the matlab cleaning):
+    # Evaluate/postEvaluate, calibrations, runningFilter and threshold_const: these traces are not written,
+    #   nor are their dependents, as their removed points aren't known
+    # manual cleaning (SiteID_YYYY_FirstStage.mat): site-years that have one are skipped unless --ignoreManual is set
+
+# Example calls from command line:
+    # py firstStageCleaning.py --siteID BB BB2 DSM --years 2024 2025 --workers 4
+    # py firstStageCleaning.py --siteID BB --years 2025 --database C:/Database --output D:/Database
+# From python:
+    # import firstStageCleaning as fsc
+    # report = fsc.cleanSiteYear('BB',2025)
+
+import os
+import re
+import math
+import argparse
+import graphlib
+import numpy as np
+import readConfig as rCfg
+import traceArchive as ta
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+# Fields that need matlab to evaluate
+unsupported = ['runningFilter','threshold_const','currentCalibration','loggedCalibration','hhourCalibration','postEvaluate','Evaluate']
+
+# Folders of the measurement types, as in trace_export.m
+measurementFolders = {'cl':'Climate','berms':'Climate','fl':'Flux','pr':'Profile','ch':'Chambers'}
+
+tagFiles = [os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','matlab','Micromet','tags_Standard.m')]
+
+defaultArgs = {
+    'siteID':['BB'],
+    'years':[str(datetime.now().year)],
+    'database':'None',
+    'output':'None',
+    'workers':1,
+}
+
+def datenum(year,month=1,day=1,hour=0,minute=0,second=0):
+    # Matlab datenum (days since year 0); months and days past their range roll over as in matlab
+    year,month = int(year)+(int(month)-1)//12,(int(month)-1)%12+1
+    t = datetime(year,month,1)+timedelta(days=day-1,hours=hour,minutes=minute,seconds=second)
+    return((t-datetime(1970,1,1)).total_seconds()/86400+719529)
+
+matlabNames = {'__builtins__':{},'datenum':datenum,'NaN':math.nan,'nan':math.nan,'Inf':math.inf,'inf':math.inf,
+               'pi':math.pi,'true':True,'false':False,'abs':abs,'min':min,'max':max}
+
+def splitTopLevel(text,separators):
+    # Splits text on the separators that aren't inside quotes or brackets
+    parts,depth,quote,current = [],0,False,''
+    for c in text:
+        if c == "'":
+            quote = not quote
+        elif not quote and c in '([{':
+            depth += 1
+        elif not quote and c in ')]}':
+            depth -= 1
+        if not quote and depth == 0 and c in separators:
+            parts.append(current)
+            current = ''
+        else:
+            current += c
+    parts.append(current)
+    return([p.strip() for p in parts if p.strip()])
+
+def matlabValue(text):
+    # Python value of a matlab literal: 'string', {cell}, [matrix] or a numeric expression
+    text = text.strip().rstrip(';').strip()
+    string = re.fullmatch(r"'((?:[^']|'')*)'",text)
+    if string:
+        return(string.group(1).replace("''","'"))
+    if text.startswith('{') and text.endswith('}'):
+        return([matlabValue(e) for e in splitTopLevel(text[1:-1],', ;')])
+    if text.startswith('[') and text.endswith(']'):
+        rows = [[matlabValue(e) for e in splitTopLevel(row,', \t')] for row in splitTopLevel(text[1:-1],';\n')]
+        if any(isinstance(e,str) for row in rows for e in row):
+            # ['abc' 'def'] is a concatenated string
+            return(''.join(str(e) for row in rows for e in row))
+        if not rows:
+            return(np.empty((0,0)))
+        return(np.array(rows,dtype=float))
+    expression = text.replace('^','**').replace('~=','!=')
+    return(eval(expression,matlabNames))
+
+def matlabCondition(text,variables):
+    # Value of a matlab condition (#if lines), e.g. yearIn<2014 | yearIn > 2015
+    expression = text.replace('~=','!=').replace('&&',' and ').replace('||',' or ')
+    expression = expression.replace('&',' and ').replace('|',' or ').replace('~',' not ')
+    return(bool(eval(expression,matlabNames|variables)))
+
+def stripComment(line):
+    # Removes a % comment that isn't inside quotes
+    quote = False
+    for i,c in enumerate(line):
+        if c == "'":
+            quote = not quote
+        elif c == '%' and not quote:
+            return(line[:i].strip())
+    return(line.strip())
+
+def setField(target,name,value):
+    # target['a']['b'] = value for name = 'a.b'
+    keys = name.split('.')
+    for key in keys[:-1]:
+        target = target.setdefault(key,{})
+    target[keys[-1]] = value
+
+def findInclude(name,iniPath):
+    # Search order of read_ini_file.m: as given, the TraceAnalysis_ini folder, the folder of the ini file
+    folder = os.path.dirname(iniPath)
+    for candidate in [name,os.path.join(os.path.dirname(folder),name),os.path.join(folder,name)]:
+        if os.path.isfile(candidate):
+            return(candidate)
+    raise FileNotFoundError(f"The #include file: {name} does not exist ({iniPath})")
+
+def parseIniFile(iniPath,year,variables):
+    # Traces ([Trace] ... [End] blocks) of an ini file and its #include files
+    # variables holds the assignments outside the blocks (SiteID, Timezone, globalVars, ...)
+    traces = []
+    skip,nestedIF = False,0
+    with open(iniPath) as f:
+        lines = f.read().splitlines()
+    i = 0
+    while i < len(lines):
+        line = lines[i].strip()
+        i += 1
+        if re.match(r'#endif',line,re.I):
+            if nestedIF < 1:
+                raise ValueError(f"#ENDIF found without #IF ({iniPath} line {i})")
+            skip,nestedIF = False,nestedIF-1
+        elif re.match(r'#if(\s+|\()',line,re.I):
+            if nestedIF > 0:
+                raise ValueError(f"Nested #IF statements are not allowed ({iniPath} line {i})")
+            nestedIF += 1
+            skip = not matlabCondition(stripComment(line[3:]),{'yearIn':year})
+        elif not line or line.startswith('%') or skip:
+            continue
+        elif re.match(r'#include ',line,re.I):
+            traces += parseIniFile(findInclude(line[9:].strip(),iniPath),year,variables)
+        elif line.startswith('[Trace]'):
+            trace = {'iniFileName':iniPath,'iniFileLineNum':i}
+            evaluate = 0
+            while not lines[i].strip().startswith('[End]'):
+                line = stripComment(lines[i])
+                i += 1
+                if '=' not in line:
+                    continue
+                name,value = [s.strip() for s in line.split('=',1)]
+                # A quoted value can continue over several lines, which are joined by commas
+                while value.count("'") % 2 == 1 and not lines[i].strip().startswith('[End]'):
+                    value += ','+stripComment(lines[i]).lstrip(',')
+                    i += 1
+                if name.startswith('Evaluate'):
+                    evaluate += 1
+                    trace[f"Evaluate{evaluate}"] = value
+                    continue
+                try:
+                    trace[name] = matlabValue(value)
+                except Exception as e:
+                    raise ValueError(f"Error in {iniPath} line {i}: {line} ({e})")
+            i += 1
+            for field in ['variableName','title','units','inputFileName','measurementType','minMax']:
+                if field not in trace:
+                    raise ValueError(f"Missing required field {field} in the trace on line {trace['iniFileLineNum']} of {iniPath}")
+            traces.append(trace)
+        elif line[0].isalpha() and '=' in line:
+            name,value = [s.strip() for s in stripComment(line).split('=',1)]
+            try:
+                setField(variables,name,matlabValue(value))
+            except Exception:
+                # e.g. settings of the other stages
+                setField(variables,name,value)
+    if nestedIF > 0:
+        raise ValueError(f"Found #IF without #ENDIF ({iniPath})")
+    return(traces)
+
+def yearGrid(year):
+    # Half-hourly datenums of a year (end times), as tvYear in read_ini_file.m
+    return(datenum(year,1,1,0,30)+np.arange(17568 if year % 4 == 0 and (year % 100 != 0 or year % 400 == 0) else 17520)/48)
+
+def inYear(trace,year):
+    dates = trace.get('inputFileName_dates')
+    if dates is None or np.size(dates) == 0:
+        return(True)
+    tv = yearGrid(year)
+    return(any(((tv > d[0]) & (tv <= d[1])).any() for d in np.atleast_2d(dates)))
+
+def readIniFile(iniPath,year):
+    # Traces of a first stage ini file that exist in year, with the global variables applied
+    variables = {'Timezone':0}
+    traces = parseIniFile(iniPath,year,variables)
+    globalVars = variables.get('globalVars',{})
+    for trace in traces:
+        instrument = globalVars.get('Instrument',{}).get(trace.get('instrumentType',''),{})
+        if instrument.get('Enable') == 1:
+            trace.update({k:v for k,v in instrument.items() if k != 'Enable'})
+        for key,value in globalVars.get('Trace',{}).get(trace['variableName'],{}).items():
+            if key == 'Evaluate':
+                for old in [k for k in trace if k.startswith('Evaluate')]:
+                    del trace[old]
+                key = 'Evaluate1'
+            trace[key] = value
+        trace['globalVars'] = {'other':globalVars.get('other',{})}
+    traces = [t for t in traces if inYear(t,year)]
+    # Duplicates: a later trace replaces (Overwrite = 1) or moves (Overwrite = 2) the original if its Overwrite is 0
+    unique = {}
+    for trace in traces:
+        name = trace['variableName']
+        overwrite = trace.get('Overwrite',0)
+        if name not in unique:
+            unique[name] = trace
+        elif overwrite >= 1 and unique[name].get('Overwrite',0) == 0:
+            if overwrite == 2:
+                del unique[name]
+            unique[name] = trace
+        else:
+            print(f"Ignoring the duplicate trace {name} on line {trace['iniFileLineNum']} of {trace['iniFileName']}")
+    return(list(unique.values()),variables)
+
+def readTags(files):
+    # tag_Name -> comma separated trace names, from matlab files like tags_Standard.m
+    tags = {}
+    for file in files:
+        if os.path.isfile(file):
+            with open(file) as f:
+                text = '\n'.join(stripComment(line) for line in f.read().splitlines())
+            for name,body in re.findall(r'\.(tag_\w+)\s*=\s*\[(.*?)\]\s*;',text,re.S):
+                tags[name] = ''.join(s.replace("''","'") for s in re.findall(r"'((?:[^']|'')*)'",body))
+    return(tags)
+
+def dependents(trace,names,tags):
+    # Names of the traces listed in the dependent field, with the tags expanded
+    listed = [d.strip() for d in str(trace.get('dependent','')).replace(' ','').split(',')]
+    found,seen = set(),set()
+    while listed:
+        name = listed.pop()
+        if not name or name in seen:
+            continue
+        seen.add(name)
+        if name.lower() == 'tag_all':
+            return(set(names))
+        if name.startswith('tag_'):
+            if name in tags:
+                listed += tags[name].split(',')
+            else:
+                print(f"Tag: {name} does not exist in standard or custom tags")
+        elif name in names:
+            found.add(name)
+    return(found)
+
+def inputFolder(root,year,siteID,measurementType):
+    return(os.path.join(root,str(year),siteID,measurementFolders.get(measurementType.lower(),measurementType)))
+
+def readInput(trace,root,year,siteID):
+    # (timeVector, data) of a trace, from one or more input files (inputFileName_dates)
+    folder = inputFolder(root,year,siteID,trace['measurementType'])
+    tv = ta.read(os.path.join(folder,'clean_tv'),np.float64)
+    names = trace['inputFileName']
+    names = [names] if isinstance(names,str) else names
+    if len(names) == 1 and np.size(trace.get('inputFileName_dates',[])) == 0:
+        return(tv,ta.read(os.path.join(folder,names[0]),np.float32).astype(np.float64))
+    dates = np.atleast_2d(trace['inputFileName_dates'])
+    data = np.full(tv.size,np.nan)
+    for name,(first,last) in zip(names,dates):
+        ind = (tv > first) & (tv <= last)
+        if ind.any():
+            data[ind] = ta.read(os.path.join(folder,name),np.float32)[ind]
+    return(tv,data)
+
+def monthlyLimits(trace,field,default):
+    # (12,2) array of the limits of each month
+    limits = trace.get(field)
+    if limits is None or np.size(limits) == 0:
+        return(np.tile(default,(12,1)))
+    limits = np.atleast_2d(np.asarray(limits,dtype=float))
+    if limits.shape not in [(1,2),(12,2)]:
+        raise ValueError(f"{field} of {trace['variableName']} has to be 1x2 or 12x2")
+    return(np.tile(limits,(12//limits.shape[0],1)))
+
+def interpolateGaps(row,length):
+    # Linear interpolation over runs of up to length NaNs (nearest value at the ends), as ta_interp_points.m
+    missing = np.isnan(row)
+    if not missing.any() or missing.all():
+        return(row)
+    index = np.arange(row.size)
+    filled = np.interp(index,index[~missing],row[~missing])
+    # Length of the run of NaNs each point belongs to
+    edges = np.flatnonzero(np.diff(np.concatenate([[0],missing.astype(np.int8),[0]])))
+    runs = np.zeros(row.size,dtype=int)
+    for start,stop in zip(edges[::2],edges[1::2]):
+        runs[start:stop] = stop-start
+    return(np.where(missing & (runs <= length),filled,row))
+
+def cleanTraces(traces,data,tv,year,timezone,tags,interpolate):
+    # First stage rules on data (traces x time, modified in place); returns the number of points removed by each rule
+    n = len(traces)
+    names = [t['variableName'] for t in traces]
+    counts = {'zeroPt':0,'minMax':0,'clamped':0,'pastCurrentDate':0,'dependent':0,'interpolated':0}
+    # Points past the last valid point of the current year (the point after it is kept)
+    if year == datetime.now().year:
+        past = tv-datenum(year,1,0)-timezone/24 < datetime.now().timetuple().tm_yday
+        valid = past[None,:] & ~np.isnan(data)
+        last = np.where(valid.any(axis=1),data.shape[1]-1-np.argmax(valid[:,::-1],axis=1),np.flatnonzero(past)[-1:].max(initial=-2))
+        future = np.arange(data.shape[1])[None,:] >= (last+2)[:,None]
+        counts['pastCurrentDate'] = int((future & ~np.isnan(data)).sum())
+        data[future] = np.nan
+    # zeroPt: points equal to zeroPt (0 unless set, no test if set to [])
+    zeroPt = np.array([np.nan if 'zeroPt' in t and np.size(t['zeroPt']) == 0 else float(np.squeeze(t.get('zeroPt',0))) for t in traces])
+    zero = data == zeroPt[:,None]
+    counts['zeroPt'] = int(zero.sum())
+    data[zero] = np.nan
+    # minMax, monthly limits by the month of the period (end time - 1 s)
+    month = np.array([(datetime(1970,1,1)+timedelta(days=float(t)-719529-1/86400)).month-1 for t in tv])
+    limits = np.stack([monthlyLimits(t,'minMax',[-np.inf,np.inf]) for t in traces])
+    outside = (data < limits[:,month,0]) | (data > limits[:,month,1])
+    counts['minMax'] = int(outside.sum())
+    data[outside] = np.nan
+    # clamped_minMax
+    clamps = np.array([monthlyLimits(t,'clamped_minMax',[-np.inf,np.inf])[0] for t in traces])
+    clamped = (data < clamps[:,:1]) | (data > clamps[:,1:])
+    counts['clamped'] = int(clamped.sum())
+    np.clip(data,clamps[:,:1],clamps[:,1:],out=data)
+    # Points removed from (or missing in) each trace, passed on to its dependents
+    own = np.isnan(data)
+    parents = {i:set() for i in range(n)}
+    position = {name:i for i,name in enumerate(names)}
+    for i,t in enumerate(traces):
+        for d in dependents(t,names,tags):
+            if position[d] != i:
+                parents[position[d]].add(i)
+    try:
+        order = list(graphlib.TopologicalSorter(parents).static_order())
+    except graphlib.CycleError:
+        # Circular dependencies: repeat the passes until nothing changes
+        order = list(range(n))
+    received = np.zeros_like(own)
+    changed = True
+    while changed:
+        changed = False
+        for i in order:
+            for p in parents[i]:
+                new = (own[p] | received[p]) & ~received[i]
+                if new.any():
+                    received[i] |= new
+                    changed = True
+    depend = received & ~own
+    counts['dependent'] = int(depend.sum())
+    data[depend] = np.nan
+    # Interpolation, as clean_traces.m: any interp_flag other than 'no_interp'
+    if interpolate:
+        for i,t in enumerate(traces):
+            length = t.get('interpLength')
+            length = 1 if length is None or np.size(length) == 0 else int(np.squeeze(length))
+            before = np.isnan(data[i]).sum()
+            data[i] = interpolateGaps(data[i],length)
+            counts['interpolated'] += int(before-np.isnan(data[i]).sum())
+    return(counts,parents)
+
+def cleanSiteYear(siteID,year,database=None,output=None,ignoreManual=False):
+    # Runs the first stage cleaning of one site and year; returns a report
+    config = rCfg.set_user_configuration()
+    root = database if database is not None else config['rootDir']['database']
+    output = output if output is not None else root
+    year = int(year)
+    iniFolder = os.path.join(root,'Calculation_Procedures','TraceAnalysis_ini',siteID)
+    report = {'siteID':siteID,'year':year,'written':[],'skipped':{},'counts':{}}
+    if not ignoreManual and os.path.isfile(os.path.join(iniFolder,f"{siteID}_{year}_FirstStage.mat")):
+        report['skipped'][siteID] = 'has manual cleaning (FirstStage.mat), use the matlab cleaning or --ignoreManual'
+        return(report)
+    traces,variables = readIniFile(os.path.join(iniFolder,f"{siteID}_FirstStage.ini"),year)
+    tags = readTags(tagFiles+[os.path.join(iniFolder,'Derived_Variables',f"{siteID}_CustomTags.m")])
+
+    # Read the input traces, grouped by their time vectors (e.g., 30 min and hourly folders)
+    groups = {}
+    for trace in traces:
+        try:
+            tv,values = readInput(trace,root,year,siteID)
+        except (FileNotFoundError,IndexError) as e:
+            report['skipped'][trace['variableName']] = f"read error: {e}"
+            continue
+        if values.size != tv.size:
+            report['skipped'][trace['variableName']] = f"{values.size} values for {tv.size} timestamps"
+            continue
+        group = groups.setdefault(tv.size,{'tv':tv,'traces':[],'data':[],'timeVectors':[]})
+        group['traces'].append(trace)
+        group['timeVectors'].append(tv)
+        group['data'].append(values)
+
+    interpFlag = variables.get('globalVars',{}).get('other',{}).get('singlePointInterpolation','no_interp')
+    for group in groups.values():
+        data = np.vstack(group['data'])
+        counts,parents = cleanTraces(group['traces'],data,group['tv'],year,variables.get('Timezone',0),tags,interpFlag != 'no_interp')
+        report['counts'] = {k:report['counts'].get(k,0)+v for k,v in counts.items()}
+        # Traces with rules that need matlab, and everything depending on them, aren't written
+        blocked = {i for i,t in enumerate(group['traces']) if [f for f in t if any(f.startswith(u) for u in unsupported)]}
+        size = 0
+        while len(blocked) > size:
+            size = len(blocked)
+            blocked |= {i for i,p in parents.items() if p & blocked}
+        for i,trace in enumerate(group['traces']):
+            name = trace['variableName']
+            if i in blocked:
+                fields = [f for f in trace if any(f.startswith(u) for u in unsupported)]
+                report['skipped'][name] = f"needs matlab ({', '.join(fields)})" if fields else 'depends on a trace that needs matlab'
+                continue
+            folder = os.path.join(inputFolder(output,year,siteID,trace['measurementType']),'Clean')
+            ta.unpack_to_write(folder)
+            os.makedirs(folder,exist_ok=True)
+            data[i].astype(np.float32).tofile(os.path.join(folder,name))
+            group['timeVectors'][i].astype(np.float64).tofile(os.path.join(folder,'clean_tv'))
+            report['written'].append(name)
+    print(f"{siteID} {year}: {len(report['written'])} traces cleaned, {len(report['skipped'])} skipped")
+    return(report)
+
+def run(sites,years,database=None,output=None,workers=1,ignoreManual=False):
+    # Cleans each site and year, in parallel processes if workers > 1; returns the reports
+    import firstStageCleaning as fsc
+    jobs = [(site,int(year)) for site in sites for year in years]
+    reports = []
+    if workers <= 1:
+        for site,year in jobs:
+            try:
+                reports.append(fsc.cleanSiteYear(site,year,database,output,ignoreManual))
+            except Exception as e:
+                reports.append({'siteID':site,'year':year,'error':f"{type(e).__name__}: {e}"})
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {job:pool.submit(fsc.cleanSiteYear,*job,database,output,ignoreManual) for job in jobs}
+            for (site,year),future in futures.items():
+                try:
+                    reports.append(future.result())
+                except Exception as e:
+                    reports.append({'siteID':site,'year':year,'error':f"{type(e).__name__}: {e}"})
+    for r in reports:
+        if 'error' in r:
+            print(f"{r['siteID']} {r['year']} failed: {r['error']}")
+        for name,reason in r.get('skipped',{}).items():
+            print(f"  {r['siteID']} {r['year']} {name}: {reason}")
+    return(reports)
+
+# If called from command line ...
+if __name__ == '__main__':
+
+    CLI=argparse.ArgumentParser()
+
+    for key,val in defaultArgs.items():
+        if type(val) == list:
+            CLI.add_argument(f"--{key}",nargs='+',type=str,default=val)
+        else:
+            CLI.add_argument(f"--{key}",nargs="?",type=type(val),default=val)
+    CLI.add_argument("--ignoreManual",action='store_true',help='clean site-years that have manual cleaning (FirstStage.mat) without it')
+
+    # parse the command line
+    args = CLI.parse_args()
+    run(args.siteID,args.years,None if args.database == 'None' else args.database,
+        None if args.output == 'None' else args.output,args.workers,args.ignoreManual)
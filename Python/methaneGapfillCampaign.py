@@ -0,0 +1,93 @@
+# Run methaneGapfillML.py for many sites and years in one process
+# Python startup, imports and the default configuration are paid for once, and for each site:
+    # the database is read once (trace arrays are shared by all fluxes through a memory-bounded cache)
+    # each model is applied to all requested years together, with one fluxgapfill.gapfill call per flux and model
+    # the models themselves are not kept in memory: fluxgapfill.gapfill loads each model's ensemble from disk on every call,
+    #   and a cache of loaded ensembles shared by the sites' runs is left as a follow-up
+    # every requested year's ThirdStage_ML traces are written
+# A failing site is reported and the campaign moves on to the next one
+# Per-site timing and errors are printed at the end and saved to <db_path>/methane_gapfill_ml/campaign_<YYYYmmddTHHMMSS>.json
+
+# Example calls from command line:
+    # py methaneGapfillCampaign.py --sites BB BB2 DSM --years 2023 2024 --db_path C:/Database --mode gapfill
+    # py methaneGapfillCampaign.py --sites BB BB2 --years 2024 --db_path C:/Database --mode full --workers 8 --cache_mb 2048
+
+import os
+import json
+import time
+import argparse
+import traceback
+from pathlib import Path
+from datetime import datetime
+import methaneGapfillML as mgml
+
+
+def run_site(site, years, db_path, mode, workers=1, threads=0):
+    """Gap-fills the requested years of one site, returns its report entry."""
+    args = argparse.Namespace(site=site, year=years, db_path=db_path, mode=mode, workers=workers, threads=threads)
+    start = time.perf_counter()
+    try:
+        mgml.main(args)
+        report = {'site': site, 'status': 'ok', 'error': None}
+    except Exception as e:
+        traceback.print_exc()
+        report = {'site': site, 'status': 'failed', 'error': f'{type(e).__name__}: {e}'}
+    finally:
+        # the next site reads different traces
+        mgml.clear_trace_cache()
+    report['seconds'] = round(time.perf_counter() - start, 1)
+    return report
+
+
+def run_campaign(sites, years, db_path, mode, workers=1, threads=0, cache_mb=mgml.TRACE_CACHE_MB):
+    mgml.set_trace_cache_size(cache_mb)
+    years = [str(year) for year in years]
+    reports = []
+    for site in sites:
+        print(f"\n{'='*5} {site} {', '.join(years)} {'='*5}")
+        reports.append(run_site(site, years, db_path, mode, workers, threads))
+
+    print(f"\n{'site':<12}{'status':<10}{'seconds':>10}  error")
+    for report in reports:
+        print(f"{report['site']:<12}{report['status']:<10}{report['seconds']:>10}  {report['error'] or ''}")
+
+    campaign = {
+        'years': years,
+        'mode': mode,
+        'finished': datetime.now().isoformat(timespec='seconds'),
+        'sites': reports,
+    }
+    report_path = Path(db_path) / 'methane_gapfill_ml' / f"campaign_{datetime.now().strftime('%Y%m%dT%H%M%S')}.json"
+    os.makedirs(report_path.parent, exist_ok=True)
+    with open(report_path, 'w') as f:
+        json.dump(campaign, f, indent=1)
+    print(f'Report written to {report_path}')
+    return campaign
+
+
+def parse_args(argv=None):
+    """Command line arguments, from sys.argv if argv is None."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sites', type=str, nargs='+', required=True)
+    parser.add_argument('--years', type=str, nargs='+', required=True)
+    parser.add_argument('--db_path', type=str, required=True)
+    parser.add_argument('--mode', type=str, choices=['full', 'gapfill'], required=True)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes used to train and test the (flux, model) pairs in parallel')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='threads per worker (default: cores / workers)')
+    parser.add_argument('--cache_mb', type=float, default=mgml.TRACE_CACHE_MB,
+                        help='memory limit of the cache of trace arrays shared by the fluxes of a site')
+    return parser.parse_args(argv)
+
+
+def cli(argv=None):
+    """Command line entry point, also called by biometService.py (see methaneGapfillML.cli)."""
+    args = parse_args(argv)
+    campaign = run_campaign(args.sites, args.years, args.db_path, args.mode, args.workers, args.threads, args.cache_mb)
+    if any(report['status'] != 'ok' for report in campaign['sites']):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -5,16 +5,23 @@ import shutil
 import hashlib
 import argparse
 import subprocess
-import fluxgapfill
+import threading
+import contextlib
+import multiprocessing
 import numpy as np
 import pandas as pd
+import runMetrics as rm
+import traceArchive as ta
 from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 import warnings
 warnings.filterwarnings('ignore', category=UserWarning, module='sklearn')
 import pickle
+import importlib.metadata
+from datetime import datetime
 
-os.chdir(os.path.split(__file__)[0])
-DEFAULT_CONFIG_FILE = Path('./config_files/ML_Gapfill_default.yml')
+DEFAULT_CONFIG_FILE = Path(__file__).resolve().parent / 'config_files' / 'ML_Gapfill_default.yml'
 
 # Aliases
 PREPROCESS = 1
@@ -23,15 +30,36 @@ TEST = 3
 GAPFILL = 4
 
 TIMESTAMP_COLUMNS = ['TIMESTAMP_START', 'TIMESTAMP_END']
-
-
+FINGERPRINT_CACHE = 'fingerprints.json'
+MODEL_INFO = 'model_info.json'
+# Threads used to read the yearly traces
+READ_WORKERS = 8
+# Memory limit of the in-process cache of trace arrays
+TRACE_CACHE_MB = 512
+# Versions recorded with each trained model
+MODEL_PACKAGES = ['fluxgapfill', 'numpy', 'pandas', 'scikit-learn', 'xgboost']
+
+# Thread pool sizes read by OpenMP (xgboost), BLAS (numpy), and joblib (sklearn n_jobs=-1)
+THREAD_ENV_VARS = [
+    'OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS', 'LOKY_MAX_CPU_COUNT',
+]
+
+
+@rm.timed('methaneGapfillML')
 def main(args):
     # so you don't have to install pyyaml manually
     import_pyyaml() 
+    import_fluxgapfill()
 
     db_path = Path(args.db_path)
     config = create_config(args)
+    # Shared by all fluxes of the site, so unchanged trace files are only stat'ed
+    fingerprint_cache_path = db_path / 'methane_gapfill_ml' / args.site / FINGERPRINT_CACHE
+    fingerprint_cache = read_fingerprint_cache(fingerprint_cache_path)
 
+    # Read and preprocess every flux first, so the training of all fluxes can share one worker pool
+    runs = {}
     for flux_name, flux_config in config['fluxes'].items():
         # to overwrite the default by ignoring some fluxes, leave the flux config empty
         # e.g. fluxes:
@@ -45,64 +73,53 @@ def main(args):
 
         flux_label = flux_name.upper()
         print(f"\n{'-'*5} {flux_name.upper()} {'-'*5}")
-        dfs_by_year = read_database_traces(db_path, config, flux_name, flux_config)
+        with rm.stage('gapfill.read', flux=flux_name):
+            dfs_by_year = read_database_traces(db_path, config, flux_name, flux_config)
         if not dfs_by_year:
             raise RuntimeError(
                 f'No readable yearly data found for flux "{flux_name}" '
                 f'using trace "{flux_config["trace"]}".'
             )
         site_path = get_site_path(db_path, args.site, flux_name)
-        stages_to_run = get_stages_to_run(
-            site_path, dfs_by_year, flux_config, flux_label, config['mode']
-        )
-        df_all = pd.concat(list(dfs_by_year.values()), axis=0).sort_index()
-
-        if PREPROCESS in stages_to_run:
-            setup_and_preprocess(site_path, dfs_by_year, flux_config, flux_label)
-
-        if TRAIN in stages_to_run:
-            predictors = [str(Path(p).stem) for p in flux_config['preds_trace']]
-            fluxgapfill.train(
-                site_path, df_all, flux_config['models'], predictors,
-                target=flux_label
+        # The fingerprints of the training data decide what to rerun in full mode, gapfill mode only uses the trained models
+        run_info = None
+        if config['mode'] == 'full':
+            run_info = build_run_info(
+                fingerprint_years(db_path, dfs_by_year, config, flux_config, fingerprint_cache), flux_config
             )
-
-        if TEST in stages_to_run:
-            fluxgapfill.test(site_path, df_all, flux_config['models'], target=flux_label)
-
-        ml_dir = db_path / args.year / args.site / 'Clean' / 'ThirdStage_ML' / flux_name
-        os.makedirs(ml_dir, exist_ok=True)
-
-        # Copy timestamp into this flux's output directory
-        timestamp_source = db_path / args.year / args.site / 'Clean' / 'ThirdStage' / config['dbase_metadata']['timestamp']['name']
-        try:
-            shutil.copy(timestamp_source, ml_dir)
-        except FileNotFoundError as e:
-            print(f"Could not copy timestamp file: {e}")
-
-        for model in flux_config['models']:
-            dtype = config['dbase_metadata']['traces']['dtype']
-            df_gapfilled = fluxgapfill.gapfill(
-                site_path, dfs_by_year[args.year], [model],
-                target=flux_label, output_prefix=flux_label
-            )
-            flux_f = df_gapfilled[f'{flux_label}_F'].values.astype(config['dbase_metadata']['traces']['dtype'])
-            flux_f_u = df_gapfilled[f'{flux_label}_F_UNCERTAINTY'].values.astype(config['dbase_metadata']['traces']['dtype'])
-
-            # Pure model output (all timesteps, model-predicted) - no _F_ in the name
-            flux_f.tofile(ml_dir / f'{flux_label}_ML_{model.upper()}')
-            flux_f_u.tofile(ml_dir / f'{flux_label}_ML_{model.upper()}_UNCERTAINTY')
-
-            # Gapfilled output: measured values with gaps filled by the model prediction
-            
-            raw_df = dfs_by_year[args.year]
-            flux_measured = raw_df[flux_label].values.astype(dtype)
-            is_gap = np.isnan(flux_measured)
-            flux_filled = np.where(is_gap, flux_f, flux_measured)
-
-            flux_filled.tofile(ml_dir / f'{flux_label}_F_ML_{model.upper()}')
-
-        print(f"{'-'*(len(flux_name)+12)}")
+        run_plan = get_stages_to_run(
+            site_path, run_info, flux_config, flux_label, config['mode']
+        )
+        # The training frame, only built for the stages that use it
+        df_all = None
+        if {PREPROCESS, TRAIN, TEST} & set(run_plan['stages']):
+            df_all = fluxgapfill_frame(stack_years(dfs_by_year))
+
+        if PREPROCESS in run_plan['stages']:
+            with rm.stage('gapfill.preprocess', flux=flux_name, years=len(dfs_by_year)):
+                setup_and_preprocess(site_path, df_all, run_info, flux_config, flux_label)
+
+        runs[flux_name] = {
+            'flux_label': flux_label,
+            'flux_config': flux_config,
+            'site_path': site_path,
+            'stages': run_plan['stages'],
+            'train_models': run_plan['train_models'],
+            'test_models': run_plan['test_models'],
+            'run_info': run_info,
+            'df_all': df_all,
+            'dfs_by_year': dfs_by_year,
+            'predictors': [str(Path(p).stem) for p in flux_config['preds_trace']],
+        }
+
+    if config['mode'] == 'full':
+        write_fingerprint_cache(fingerprint_cache_path, fingerprint_cache)
+    run_training_jobs(runs, getattr(args, 'workers', 1), getattr(args, 'threads', 0))
+
+    years = requested_years(args)
+    for flux_name, run in runs.items():
+        print(f"\n{'-'*5} {flux_name.upper()} gap-filling {', '.join(years)} {'-'*5}")
+        gapfill_stacked_years(db_path, args.site, years, flux_name, run, config)
 
 
 def import_pyyaml():
@@ -115,6 +132,13 @@ def import_pyyaml():
         import yaml
 
 
+def import_fluxgapfill():
+    # fluxgapfill loads sklearn and xgboost, so it is only imported once a run starts
+    # (not to parse --help, or when this module is imported by another tool)
+    global fluxgapfill
+    import fluxgapfill
+
+
 def deep_merge(base, override):
     """Recursively merges override into base and returns base."""
     for key, value in override.items():
@@ -127,8 +151,51 @@ def deep_merge(base, override):
     return base
 
 
-def hash_df_columns(df, columns):
-    return hashlib.sha256(df[columns].to_json().encode('utf-8')).hexdigest()
+def file_fingerprint(path, cache, key) -> str:
+    """blake2b digest of a file's raw bytes, reused from cache while its size and mtime are unchanged."""
+    if not os.path.isfile(path):
+        # Archived (see traceArchive.py), the archive keeps the digest of the original file
+        return ta.find(path)[2]['digest']
+    stat = os.stat(path)
+    entry = cache.get(key)
+    if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        return entry['digest']
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            digest.update(block)
+    cache[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': digest.hexdigest()}
+    return cache[key]['digest']
+
+
+def fingerprint_years(db_path, years, config, flux_config, cache) -> dict:
+    """Fingerprints the timestamp and flux trace files that preprocessing depends on, for each year."""
+    fingerprints = {}
+    for year in years:
+        paths = trace_paths(db_path, year, config, flux_config)
+        digest = hashlib.blake2b(digest_size=16)
+        for path in [paths['timestamp'], paths['flux']]:
+            key = path.relative_to(db_path).as_posix()
+            digest.update(file_fingerprint(path, cache, key).encode())
+        fingerprints[year] = digest.hexdigest()
+    return fingerprints
+
+
+def read_fingerprint_cache(path) -> dict:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_fingerprint_cache(path, cache):
+    # Written to a temporary file first, so an interrupted run can't leave a truncated cache
+    os.makedirs(path.parent, exist_ok=True)
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp, path)
 
 
 def build_preprocess_signature(flux_config):
@@ -139,14 +206,10 @@ def build_preprocess_signature(flux_config):
     }
 
 
-def build_run_info(dfs_by_year, flux_config, flux_label):
-    preprocess_columns = TIMESTAMP_COLUMNS + [flux_label]
+def build_run_info(fingerprints, flux_config):
     return {
         'preprocess_config': build_preprocess_signature(flux_config),
-        'preprocess_hashes': {
-            year: hash_df_columns(df, preprocess_columns)
-            for year, df in dfs_by_year.items()
-        },
+        'preprocess_hashes': fingerprints,
     }
 
 
@@ -156,31 +219,80 @@ def write_run_info(site_path, run_info):
         json.dump(run_info, f)
 
 
+def data_fingerprint(run_info) -> str:
+    """Single digest of the preprocess config and per-year fingerprints a model was trained on."""
+    return hashlib.blake2b(json.dumps(run_info, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+def package_versions() -> dict:
+    versions = {}
+    for package in MODEL_PACKAGES:
+        try:
+            versions[package] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def write_model_info(site_path, model, predictors, run_info, flux_label):
+    """Writes the small metadata file checked instead of unpickling the trained models."""
+    model_info = {
+        'model': model,
+        'target': flux_label,
+        'predictors': list(predictors),
+        'data_fingerprint': data_fingerprint(run_info),
+        'split_method': run_info['preprocess_config']['split_method'],
+        'num_splits': run_info['preprocess_config']['num_splits'],
+        'versions': package_versions(),
+        'trained': datetime.now().isoformat(timespec='seconds'),
+    }
+    with open(site_path / 'models' / model / MODEL_INFO, 'w') as f:
+        json.dump(model_info, f, indent=1)
+
+
+def read_model_info(site_path, model) -> dict:
+    """Reads a model's metadata file, or {} if the model doesn't exist.
+    Models trained before the metadata file existed are unpickled once to create it."""
+    model_dir = site_path / 'models' / model
+    try:
+        with open(model_dir / MODEL_INFO, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+    pkl_path = model_dir / f'{model}0.pkl'
+    if not pkl_path.exists():
+        return {}
+    with open(pkl_path, 'rb') as f:
+        trained_model = pickle.load(f)
+    model_info = {'model': model, 'predictors': list(trained_model.predictors), 'data_fingerprint': None}
+    with open(model_dir / MODEL_INFO, 'w') as f:
+        json.dump(model_info, f, indent=1)
+    return model_info
+
+
 def get_site_path(db_path, site, flux_name):
     return db_path / 'methane_gapfill_ml' / site / flux_name
 
 
+def index_files(num_splits) -> list:
+    """The split indices fluxgapfill.preprocess writes to site_path/indices."""
+    return ['test.npy'] + [f'{name}{i}.npy' for i in range(num_splits) for name in ['train', 'val']]
+
+
 def has_complete_indices(site_path, num_splits):
-    if not (site_path / 'indices' / 'test.npy').exists():
-        return False
-    for i in range(num_splits):
-        if not (site_path / 'indices' / f'train{i}.npy').exists():
-            return False
-        if not (site_path / 'indices' / f'val{i}.npy').exists():
-            return False
-    return True
+    return all((site_path / 'indices' / name).exists() for name in index_files(num_splits))
 
 
 def create_config(args) -> dict:
+    # imported here so pyyaml can be installed by import_pyyaml() first
+    import readConfig as rCfg
     trace_analysis_ini_path = Path(args.db_path) / 'Calculation_Procedures' / 'TraceAnalysis_ini'
-    with open(DEFAULT_CONFIG_FILE, 'r') as f:
-        config = yaml.safe_load(f)
+    config = rCfg.load_yaml(DEFAULT_CONFIG_FILE)
     config['site'] = args.site
 
     site_config_path = trace_analysis_ini_path / args.site / f"{args.site}_ML_Gapfill.yml"
     if site_config_path.exists():
-        with open(site_config_path, 'r') as f:
-            site_config = yaml.safe_load(f)
+        site_config = rCfg.load_yaml(site_config_path)
         # remap 'traces' key to 'fluxes' to match internal structure
         if 'traces' in site_config:
             site_config['fluxes'] = site_config.pop('traces')
@@ -199,22 +311,67 @@ def create_config(args) -> dict:
     return config
 
 
-def setup_and_preprocess(site_path, dfs_by_year, flux_config, flux_label):
-    '''Creates the run directory and caches the config as JSON, then runs preprocess'''
-    if os.path.exists(site_path):
-        shutil.rmtree(site_path)
-    os.makedirs(site_path / 'indices')
-    write_run_info(site_path, build_run_info(dfs_by_year, flux_config, flux_label))
+def stack_years(dfs_by_year) -> pd.DataFrame:
+    """All years in chronological order, the row order the split indices refer to."""
+    return pd.concat([dfs_by_year[year] for year in sorted(dfs_by_year)], axis=0, ignore_index=True)
+
+
+def check_indices(site_path, target, num_splits):
+    """Checks the split indices written by fluxgapfill.preprocess: one file per split in site_path/indices,
+    each holding the positions (or a boolean mask) of rows of the preprocessed frame with a measured target."""
+    for name in index_files(num_splits):
+        path = site_path / 'indices' / name
+        if not path.exists():
+            raise FileNotFoundError(f'fluxgapfill.preprocess did not write {path}')
+        indices = np.load(path)
+        if indices.dtype == bool:
+            if indices.size != target.size:
+                raise ValueError(f'indices/{name}: mask of {indices.size} rows for {target.size} rows of data')
+            rows = indices
+        else:
+            if indices.size and (indices.min() < 0 or indices.max() >= target.size):
+                raise ValueError(f'indices/{name}: positions outside the {target.size} rows of data')
+            rows = indices.astype(np.int64)
+        if np.isnan(target[rows]).any():
+            raise ValueError(
+                f'indices/{name} selects rows without a measured target: the installed fluxgapfill '
+                'does not write the split indices this script expects (see requirements.txt)'
+            )
+
 
-    all_df = pd.concat(list(dfs_by_year.values()), axis=0).sort_index()
+def setup_and_preprocess(site_path, df_all, run_info, flux_config, flux_label):
+    '''Splits all years together with fluxgapfill.preprocess, checks the indices it wrote and caches the config as JSON.
+    The trained models are kept until they are retrained on the new splits.'''
+    target = df_all[flux_label].values.astype(float)
+    if np.isnan(target).all():
+        raise RuntimeError(f'No measured {flux_label} data to train on.')
+    # 'years' holds the per-year splits of earlier versions
+    for folder in ['indices', 'years']:
+        if os.path.exists(site_path / folder):
+            shutil.rmtree(site_path / folder)
+    os.makedirs(site_path / 'indices')
     fluxgapfill.preprocess(
-        site_path, all_df, target=flux_label,
+        site_path, df_all, target=flux_label,
         split_method=flux_config['split_method'], n_train=flux_config['num_splits']
     )
+    check_indices(site_path, target, flux_config['num_splits'])
+    write_run_info(site_path, run_info)
+
+
+def plan(first_stage, train=[], test=[]) -> dict:
+    """Stages to run from first_stage on, with the models to train and test."""
+    stages = [stage for stage in [PREPROCESS, TRAIN, TEST, GAPFILL] if stage >= first_stage]
+    return {
+        'stages': [stage for stage in stages if stage in [PREPROCESS, GAPFILL] or (train if stage == TRAIN else test)],
+        'train_models': list(train),
+        'test_models': list(test),
+    }
 
 
-def get_stages_to_run(site_path, dfs_by_year, flux_config, flux_label, mode) -> list:
-    current_run_info = build_run_info(dfs_by_year, flux_config, flux_label)
+def get_stages_to_run(site_path, current_run_info, flux_config, flux_label, mode) -> dict:
+    """Returns the run plan, see plan().
+    In full mode, the splits span all years: if the data of any year changed, every year is split again
+    and every model is retrained. Otherwise only the models that are incomplete or out of date are trained again."""
 
     if mode == 'gapfill':
         missing_models = [
@@ -231,74 +388,74 @@ def get_stages_to_run(site_path, dfs_by_year, flux_config, flux_label, mode) ->
         # Check predictors match trained model
         current_predictors = [str(Path(p).stem) for p in flux_config['preds_trace']]
         for model in flux_config['models']:
-            pkl_path = site_path / 'models' / model / f'{model}0.pkl'
-            if pkl_path.exists():
-                with open(pkl_path, 'rb') as f:
-                    trained_model = pickle.load(f)
-                saved_predictors = list(trained_model.predictors)
-                if saved_predictors != current_predictors:
-                    raise RuntimeError(
-                        f'Gapfill mode requested, but predictors have changed for "{flux_label}" '
-                        f'(model: {model}).\n'
-                        f'  Saved:   {saved_predictors}\n'
-                        f'  Current: {current_predictors}\n'
-                        f'Run train_ML_gapfill to retrain.'
-                    )
+            saved_predictors = read_model_info(site_path, model).get('predictors')
+            if saved_predictors is not None and saved_predictors != current_predictors:
+                raise RuntimeError(
+                    f'Gapfill mode requested, but predictors have changed for "{flux_label}" '
+                    f'(model: {model}).\n'
+                    f'  Saved:   {saved_predictors}\n'
+                    f'  Current: {current_predictors}\n'
+                    f'Run train_ML_gapfill to retrain.'
+                )
 
-        return [GAPFILL]
+        return plan(GAPFILL)
 
     elif mode == 'full': 
-        valid_stages = [PREPROCESS, TRAIN, TEST, GAPFILL]
-        # --- Preprocess ---
+        num_splits = flux_config['num_splits']
+        models = flux_config['models']
         try:
             with open(site_path / 'run_info.json', 'r') as f:
                 run_info = json.load(f)
-            assert run_info['preprocess_config'] == current_run_info['preprocess_config']
-            assert run_info['preprocess_hashes'] == current_run_info['preprocess_hashes']
-            assert has_complete_indices(site_path, flux_config['num_splits'])
-            valid_stages.remove(PREPROCESS)
-        except Exception as _:
+        except (FileNotFoundError, json.JSONDecodeError):
+            run_info = {}
+
+        # --- Preprocess ---
+        if run_info.get('preprocess_config') != current_run_info['preprocess_config']:
             if os.path.exists(site_path):
                 shutil.rmtree(site_path)
             print('Running pipeline from preprocess')
-            return valid_stages
+            return plan(PREPROCESS, train=models, test=models)
+
+        saved_hashes = run_info.get('preprocess_hashes', {})
+        current_hashes = current_run_info['preprocess_hashes']
+        changed_years = sorted(
+            year for year in set(saved_hashes) | set(current_hashes)
+            if saved_hashes.get(year) != current_hashes.get(year)
+        )
+        if changed_years or not has_complete_indices(site_path, num_splits):
+            # Every split spans all years, so new data in any year is a new split, and every model is retrained on it
+            print(f'Data changed in year(s) {", ".join(changed_years) or "none"}: '
+                  'running pipeline from preprocess and retraining all models')
+            return plan(PREPROCESS, train=models, test=models)
 
         # --- Train ---
-        try:
-            for model in flux_config['models']:
-                model_dir = site_path / 'models' / model
-                for i in range(flux_config['num_splits']):
-                    assert os.path.exists(model_dir / f'{model}{i}.pkl')
-                assert os.path.exists(model_dir / 'val_metrics.csv')
-
-                # Check predictors match by reading directly from the trained model
-                pkl_path = model_dir / f'{model}0.pkl'
-                if pkl_path.exists():
-                    with open(pkl_path, 'rb') as f:
-                        trained_model = pickle.load(f)
-                    saved_predictors = list(trained_model.predictors)
-                    current_predictors = [str(Path(p).stem) for p in flux_config['preds_trace']]
-                    assert saved_predictors == current_predictors, \
-                        f'Predictors changed for {model}: {saved_predictors} → {current_predictors}'
-
-            valid_stages.remove(TRAIN)
-        except Exception:
-            if os.path.exists(site_path):
-                shutil.rmtree(site_path)
-            print('Running pipeline from preprocess due to predictor/model mismatch')
-            return [PREPROCESS, TRAIN, TEST, GAPFILL]
+        # Only models that are incomplete, or were trained on other data or predictors
+        current_predictors = [str(Path(p).stem) for p in flux_config['preds_trace']]
+        train_models = []
+        for model in models:
+            model_info = read_model_info(site_path, model)
+            # models trained before the metadata file existed have no data fingerprint
+            if (
+                not is_train_run_complete(site_path, model, num_splits)
+                or model_info.get('predictors') != current_predictors
+                or model_info.get('data_fingerprint') not in [None, data_fingerprint(current_run_info)]
+            ):
+                train_models.append(model)
 
         # --- Test ---
-        try:
-            for model in flux_config['models']:
-                assert os.path.exists(site_path / 'models' / model / 'test_metrics.csv')
-                assert os.path.exists(site_path / 'models' / model / 'test_predictions.csv')
-            valid_stages.remove(TEST)
-        except Exception as _:
-            print('Running pipeline from test')
-            return valid_stages
-
-        return valid_stages
+        test_models = [
+            model for model in models
+            if model in train_models
+            or not os.path.exists(site_path / 'models' / model / 'test_metrics.csv')
+            or not os.path.exists(site_path / 'models' / model / 'test_predictions.csv')
+        ]
+        if train_models:
+            print(f'Running pipeline from train for model(s) {", ".join(train_models)}')
+            return plan(TRAIN, train=train_models, test=test_models)
+        if test_models:
+            print(f'Running pipeline from test for model(s) {", ".join(test_models)}')
+            return plan(TEST, test=test_models)
+        return plan(GAPFILL)
 
     else:
         raise ValueError(f"The mode {mode} is invalid. Please use either 'full' or 'gapfill'.")
@@ -322,63 +479,363 @@ def is_gapfill_run_complete(path, model, num_splits) -> bool:
     )
 
 
+def requested_years(args) -> list:
+    """--year can be a single year or a list of years."""
+    years = [args.year] if isinstance(args.year, (str, int)) else list(args.year)
+    return sorted(str(year) for year in years)
+
+
+def gapfill_stacked_years(db_path, site, years, flux_name, run, config):
+    """Gap-fills all requested years of one flux and writes the ThirdStage_ML traces.
+
+    The requested years are stacked into one frame and fluxgapfill.gapfill is called once
+    per model on it, instead of once per model and year. fluxgapfill.gapfill takes a raw
+    frame and builds the model's features itself, so the features are still built once
+    per model: its API has no way to predict several ensembles on one feature matrix.
+    For a single year this is the same as calling it year by year. The _ML_, _UNCERTAINTY
+    and _F_ML_ traces of every model are then written together, year by year.
+    """
+    flux_label = run['flux_label']
+    dfs_by_year = run['dfs_by_year']
+    dtype = config['dbase_metadata']['traces']['dtype']
+    missing = [year for year in years if year not in dfs_by_year]
+    if missing:
+        raise RuntimeError(f'No readable data for flux "{flux_name}" in year(s) {missing}.')
+
+    frames = [dfs_by_year[year] for year in years]
+    batch = fluxgapfill_frame(pd.concat(frames, axis=0, ignore_index=True))
+    bounds = np.cumsum([0] + [len(df) for df in frames])
+    measured = {year: df[flux_label].values.astype(dtype) for year, df in zip(years, frames)}
+    is_gap = {year: np.isnan(values) for year, values in measured.items()}
+
+    outputs = {year: {} for year in years}
+    for model in run['flux_config']['models']:
+        with rm.stage('gapfill.gapfill', flux=flux_name, model=model, years=len(years)):
+            df_gapfilled = fluxgapfill.gapfill(
+                run['site_path'], batch, [model],
+                target=flux_label, output_prefix=flux_label
+            )
+        flux_f = df_gapfilled[f'{flux_label}_F'].values.astype(dtype)
+        flux_f_u = df_gapfilled[f'{flux_label}_F_UNCERTAINTY'].values.astype(dtype)
+        for i, year in enumerate(years):
+            rows = slice(bounds[i], bounds[i + 1])
+            # Pure model output (all timesteps, model-predicted) - no _F_ in the name
+            outputs[year][f'{flux_label}_ML_{model.upper()}'] = flux_f[rows]
+            outputs[year][f'{flux_label}_ML_{model.upper()}_UNCERTAINTY'] = flux_f_u[rows]
+            # Gapfilled output: measured values with gaps filled by the model prediction
+            outputs[year][f'{flux_label}_F_ML_{model.upper()}'] = np.where(is_gap[year], flux_f[rows], measured[year])
+
+    for year in years:
+        ml_dir = db_path / year / site / 'Clean' / 'ThirdStage_ML' / flux_name
+        ta.unpack_to_write(str(ml_dir))
+        os.makedirs(ml_dir, exist_ok=True)
+
+        # Copy timestamp into this flux's output directory (ThirdStage may be archived)
+        timestamp = config['dbase_metadata']['timestamp']
+        try:
+            ta.read(db_path / year / site / 'Clean' / 'ThirdStage' / timestamp['name'], timestamp['dtype']).tofile(ml_dir / timestamp['name'])
+        except FileNotFoundError as e:
+            print(f"Could not copy timestamp file: {e}")
+
+        for trace_name, values in outputs[year].items():
+            values.tofile(ml_dir / trace_name)
+            rm.count_written(nBytes=values.nbytes)
+
+
+def limit_threads(threads):
+    """Caps the thread pools of numpy/sklearn/xgboost so parallel workers don't oversubscribe the cores.
+    Applied for the lifetime of the process, so only used as the worker initializer."""
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads)
+    try:
+        # installed with scikit-learn, also caps pools that were started before the environment was set
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(threads)
+    except ImportError:
+        pass
+
+
+def thread_limits(threads):
+    """Caps the thread pools of this process until the returned context exits."""
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return contextlib.nullcontext()
+    return threadpool_limits(threads)
+
+
+def run_training_job(stage, site_path, df_all, model, predictors, flux_label):
+    """Trains or tests one model of one flux. Runs in a worker process."""
+    import_fluxgapfill()
+    flux_name = flux_label.lower()
+    if stage == TRAIN:
+        with rm.stage('gapfill.train', flux=flux_name, model=model):
+            fluxgapfill.train(site_path, df_all, [model], predictors, target=flux_label)
+    else:
+        with rm.stage('gapfill.test', flux=flux_name, model=model):
+            fluxgapfill.test(site_path, df_all, [model], target=flux_label)
+
+
+def run_training_jobs(runs, workers=1, threads=0):
+    """Runs the train and test stages of every flux.
+
+    With one worker, each flux is trained and tested in this process as before.
+    With more, every (flux, model) pair is a separate job in a process pool, and each
+    model's test job is submitted as soon as its training finishes. Each worker is limited
+    to `threads` threads (default: cores / workers). fluxgapfill trains all splits of a model
+    in one call, so a (flux, model) pair is the smallest job that can be dispatched.
+    Artifacts are written to site_path/models/<model>/ either way.
+    """
+    if workers <= 1:
+        for flux_name, run in runs.items():
+            if TRAIN in run['stages']:
+                with rm.stage('gapfill.train', flux=flux_name):
+                    fluxgapfill.train(
+                        run['site_path'], run['df_all'], run['train_models'], run['predictors'],
+                        target=run['flux_label']
+                    )
+                for model in run['train_models']:
+                    write_model_info(run['site_path'], model, run['predictors'], run['run_info'], run['flux_label'])
+            if TEST in run['stages']:
+                with rm.stage('gapfill.test', flux=flux_name):
+                    fluxgapfill.test(run['site_path'], run['df_all'], run['test_models'], target=run['flux_label'])
+        return
+
+    jobs = [
+        (flux_name, model, stage)
+        for flux_name, run in runs.items()
+        for stage, models in [(TRAIN, run['train_models']), (TEST, run['test_models'])] if stage in run['stages']
+        for model in models
+    ]
+    if not jobs:
+        return
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    print(f'Running {len(jobs)} train/test jobs on {workers} workers with {threads} thread(s) each')
+
+    # Workers are spawned rather than forked, so they start with the thread limits in their environment
+    saved_env = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads)
+    # Workers look the job functions up by module name, which also works when this file was run as a script
+    # by another program (e.g. biometService.py), where __main__ is not this module
+    import methaneGapfillML as mgml
+    failures = []
+    try:
+        # This process is only capped while the pool runs, its limits are restored afterwards
+        with thread_limits(threads), ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=mgml.limit_threads, initargs=(threads,)
+        ) as pool:
+            def submit(flux_name, model, stage):
+                run = runs[flux_name]
+                return pool.submit(
+                    mgml.run_training_job, stage, run['site_path'], run['df_all'], model,
+                    run['predictors'], run['flux_label']
+                )
+
+            futures = {
+                submit(*job): job for job in jobs
+                # a test job waits for the training of its model
+                if not (job[2] == TEST and job[1] in runs[job[0]]['train_models'])
+            }
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    flux_name, model, stage = futures.pop(future)
+                    stage_name = 'Training' if stage == TRAIN else 'Testing'
+                    try:
+                        future.result()
+                    except Exception as e:
+                        failures.append(f'{stage_name} {flux_name}/{model}: {e}')
+                        print(f'{stage_name} {flux_name}/{model} failed: {e}')
+                        continue
+                    print(f'{stage_name} {flux_name}/{model} done')
+                    if stage == TRAIN:
+                        run = runs[flux_name]
+                        write_model_info(run['site_path'], model, run['predictors'], run['run_info'], run['flux_label'])
+                    if stage == TRAIN and model in runs[flux_name]['test_models']:
+                        futures[submit(flux_name, model, TEST)] = (flux_name, model, TEST)
+    finally:
+        for var, value in saved_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+    if failures:
+        raise RuntimeError('Some train/test jobs failed:\n  ' + '\n  '.join(failures))
+
+
+# least recently used first
+_trace_cache = OrderedDict()
+_trace_cache_bytes = 0
+_trace_cache_limit = TRACE_CACHE_MB * 1024**2
+_trace_cache_lock = threading.Lock()
+
+
 def read_database_traces(db_path, config, flux_name, flux_config) -> dict:
     """Reads binary data for a given site and returns a pandas DataFrame.
     Args:
         db_path (str): Path to the Database directory
         config (dict): Configuration dictionary (contains the site)
     """
+    # Check every year for missing traces up front, before reading anything
+    readable_years = []
+    for year in sorted(d for d in os.listdir(db_path) if d.isnumeric()):
+        paths = trace_paths(db_path, year, config, flux_config)
+        missing = [p for p in [paths['timestamp'], *paths['predictors'], paths['flux']] if not ta.exists(p)]
+        if missing:
+            print(f'Variables not found for year {year}. Skipping... missing: {[str(p) for p in missing]}')
+        else:
+            readable_years.append(year)
+
+    # np.fromfile releases the GIL, so the years can be read concurrently by threads
+    # the reads of the threads are counted in the stages active here
     dfs_by_year = {}
-    database_years = [d for d in os.listdir(db_path) if d.isnumeric()]
-    for year in database_years:
-        try:
-            dfs_by_year[year] = read_database_trace_by_year(db_path, year, config, flux_name, flux_config)
-        except FileNotFoundError as e:
-            print(f'Variables not found for year {year}. Skipping... but also: {e}')
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(READ_WORKERS, len(readable_years))),
+        initializer=rm.use_stages, initargs=(rm.current_stages(),)
+    ) as pool:
+        futures = {
+            year: pool.submit(read_database_trace_by_year, db_path, year, config, flux_name, flux_config)
+            for year in readable_years
+        }
+        for year, future in futures.items():
+            try:
+                dfs_by_year[year] = future.result()
+            except FileNotFoundError as e:
+                print(f'Variables not found for year {year}. Skipping... but also: {e}')
     return dfs_by_year
 
 
+def trace_paths(db_path, year, config, flux_config) -> dict:
+    """Paths of the timestamp, predictor and flux trace files for one year."""
+    clean_path = Path(db_path) / year / config['site'] / 'Clean'
+    return {
+        'timestamp': clean_path / 'SecondStage' / config['dbase_metadata']['timestamp']['name'],
+        'predictors': [clean_path / Path(trace) for trace in flux_config['preds_trace']],
+        'flux': clean_path / Path(flux_config['trace']),
+    }
+
+
+def set_trace_cache_size(megabytes):
+    """Sets the memory limit of the trace cache, evicting the least recently used traces if needed."""
+    global _trace_cache_limit
+    with _trace_cache_lock:
+        _trace_cache_limit = int(megabytes * 1024**2)
+        _evict_traces()
+
+
+def clear_trace_cache():
+    global _trace_cache_bytes
+    with _trace_cache_lock:
+        _trace_cache.clear()
+        _trace_cache_bytes = 0
+
+
+def _evict_traces():
+    global _trace_cache_bytes
+    while _trace_cache and _trace_cache_bytes > _trace_cache_limit:
+        _, values = _trace_cache.popitem(last=False)
+        _trace_cache_bytes -= values.nbytes
+
+
+def read_trace(path, dtype) -> np.ndarray:
+    """Reads a binary trace (or its archived copy), reusing the array while the file is unchanged (e.g. predictors shared by fluxes).
+    Cached arrays are read-only and the cache is limited to TRACE_CACHE_MB (see set_trace_cache_size)."""
+    global _trace_cache_bytes
+    size, mtime_ns = ta.file_stat(path)
+    key = (str(path), str(dtype), size, mtime_ns)
+    with _trace_cache_lock:
+        if key in _trace_cache:
+            _trace_cache.move_to_end(key)
+            return _trace_cache[key]
+    values = ta.read(path, dtype)
+    rm.count_read(nBytes=values.nbytes)
+    values.flags.writeable = False
+    with _trace_cache_lock:
+        if key in _trace_cache:
+            # Another thread read the same trace meanwhile, keep its copy so the bytes are only counted once
+            _trace_cache.move_to_end(key)
+            return _trace_cache[key]
+        _trace_cache[key] = values
+        _trace_cache_bytes += values.nbytes
+        _evict_traces()
+    return values
+
+
+def ameriflux_timestamps(times) -> np.ndarray:
+    """Converts datetime64 values to integer AmeriFlux timestamps (YYYYMMDDHHMM)."""
+    minutes = np.asarray(times).astype('datetime64[m]')
+    days = minutes.astype('datetime64[D]')
+    months = days.astype('datetime64[M]')
+    years = months.astype('datetime64[Y]')
+    minute_of_day = (minutes - days).astype(np.int64)
+    return (
+        (years.astype(np.int64) + 1970) * 10**8
+        + (months - years).astype(np.int64) * 10**6 + 10**6
+        + (days - months).astype(np.int64) * 10**4 + 10**4
+        + (minute_of_day // 60) * 100 + minute_of_day % 60
+    )
+
+
+def fluxgapfill_frame(df) -> pd.DataFrame:
+    """Returns df with the AmeriFlux timestamps as strings, the form fluxgapfill expects."""
+    return df.astype({column: str for column in TIMESTAMP_COLUMNS})
+
 
 def read_database_trace_by_year(db_path, year, config, flux_name, flux_config) -> pd.DataFrame:
     """
     Reads binary data for a given site and year, and returns a pandas DataFrame.
+    Timestamps are integer AmeriFlux timestamps, see fluxgapfill_frame() for the string form.
     Args:
         db_path (str): Path to the Database directory
         year (int): The year read in the Database
         config (dict): Configuration dictionary (contains the site)
     """
+    paths = trace_paths(db_path, year, config, flux_config)
 
     # Timestamps
     ts_cfg = config['dbase_metadata']['timestamp'] # for brevity
-    timestamp_raw = np.fromfile(db_path / year / config['site'] / 'Clean' / 'SecondStage' / ts_cfg['name'], dtype=ts_cfg['dtype'])
-    timestamp_end = pd.to_datetime(timestamp_raw - ts_cfg['base'], unit=ts_cfg['base_unit']).round('s')
-    timestamp_start = timestamp_end - pd.Timedelta(minutes=30)
-    timestamp_end_ameriflux = timestamp_end.strftime('%Y%m%d%H%M')
-    timestamp_start_ameriflux = timestamp_start.strftime('%Y%m%d%H%M')
-    df = pd.DataFrame({'TIMESTAMP_START': timestamp_start_ameriflux, 'TIMESTAMP_END': timestamp_end_ameriflux})
+    timestamp_raw = read_trace(paths['timestamp'], ts_cfg['dtype'])
+    timestamp_end = pd.to_datetime(timestamp_raw - ts_cfg['base'], unit=ts_cfg['base_unit']).round('s').values
+    timestamp_start = timestamp_end - np.timedelta64(30, 'm')
+    columns = {
+        'TIMESTAMP_START': ameriflux_timestamps(timestamp_start),
+        'TIMESTAMP_END': ameriflux_timestamps(timestamp_end),
+    }
 
     # Predictor traces
     trace_dtype = config['dbase_metadata']['traces']['dtype']
-    for trace in flux_config['preds_trace']:
-        trace_path = Path(trace)
-        trace_name = trace_path.stem
-        trace_values = np.fromfile(db_path / year / config['site'] / 'Clean' / trace_path, dtype=trace_dtype)
-        df[trace_name] = trace_values
+    for trace_path in paths['predictors']:
+        columns[trace_path.stem] = read_trace(trace_path, trace_dtype)
 
     # Target flux
-    flux_values = np.fromfile(db_path / year / config['site'] / 'Clean' / Path(flux_config['trace']), dtype=trace_dtype)
-    df[flux_name.upper()] = flux_values
-    return df 
+    columns[flux_name.upper()] = read_trace(paths['flux'], trace_dtype)
+    return pd.DataFrame(columns)
 
 
-if __name__ == "__main__":
+def parse_args(argv=None):
+    """Command line arguments, from sys.argv if argv is None."""
     parser = argparse.ArgumentParser()
     parser.add_argument('--site', type=str, required=True)
-    parser.add_argument('--year', type=str, required=True)
+    parser.add_argument('--year', type=str, nargs='+', required=True,
+                        help='year(s) to gap-fill, all are gap-filled in one pass')
     parser.add_argument('--db_path', type=str, required=True)
     parser.add_argument('--mode', type=str, choices=['full', 'gapfill'], required=True)
-    args = parser.parse_args()
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes used to train and test the (flux, model) pairs in parallel')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='threads per worker (default: cores / workers)')
+    return parser.parse_args(argv)
+
 
-    main(args)
+def cli(argv=None):
+    """Command line entry point. biometService.py calls it with the job's arguments, so this module,
+    and its caches, stay loaded from one job to the next."""
+    main(parse_args(argv))
+
+
+if __name__ == "__main__":
+    cli()
 
  
\ No newline at end of file
@@ -0,0 +1,265 @@
+# Runs a pipeline of the python tools (e.g., the nightly processing), redoing only the steps whose inputs changed
+# The steps are defined in a yaml file (see config_files/pipeline_template.yml), each with its input and output files
+    # a step is skipped if its outputs exist and its inputs (size and mtime of each file) and definition are unchanged
+    #   since it last succeeded; before its first recorded run, if no input is newer than its oldest output
+    # steps run once the steps they depend on are done (listed in after, or writing files that match their inputs)
+    #   steps that depend on each other in a cycle are an error, reported before anything runs
+    # independent steps, and the per-site repeats of a step, run concurrently in separate processes
+# The state of each step is kept in <database>/pipeline/<pipeline>_state.json
+# Each run writes a report (status, reason and duration of each step) to <database>/pipeline/<pipeline>_report_<YYYYmmddTHHMMSS>.json
+
+# Example calls from command line:
+    # py pipelineRunner.py --pipeline config_files/pipeline.yml --workers 4
+    # py pipelineRunner.py --pipeline config_files/pipeline.yml --steps export_csv --dryRun
+    # py pipelineRunner.py --pipeline config_files/pipeline.yml --force
+# From python:
+    # import pipelineRunner as pr
+    # report = pr.run('config_files/pipeline.yml',workers=4)
+
+import os
+import re
+import sys
+import json
+import time
+import glob
+import fnmatch
+import hashlib
+import argparse
+import graphlib
+import importlib
+import subprocess
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import readConfig as rCfg
+
+template = 'config_files/pipeline_template.yml'
+
+defaultArgs = {
+    'pipeline':template,
+    'steps':[],
+    'workers':1,
+}
+
+def fill(value,fields,name):
+    # Replaces {field} in the strings of value (including nested lists and dicts)
+    if isinstance(value,dict):
+        return({k:fill(v,fields,name) for k,v in value.items()})
+    if isinstance(value,list):
+        return([fill(v,fields,name) for v in value])
+    if not isinstance(value,str):
+        return(value)
+    def replace(match):
+        if match.group(1) not in fields:
+            raise KeyError(f"Unknown field {{{match.group(1)}}} in step {name}")
+        return(str(fields[match.group(1)]))
+    return(re.sub(r'\{(\w+)\}',replace,value))
+
+def expand(pipeline,config):
+    # One step per site and year of each pipeline step, with the fields filled in
+    now = datetime.now()
+    fields = dict(config['rootDir']) | {'currentYear':now.year,'today':now.strftime('%Y-%m-%d')}
+    steps = {}
+    for name,step in pipeline.items():
+        if 'call' not in step and 'command' not in step:
+            raise ValueError(f"Step {name} needs a call or a command")
+        for siteID in step.get('sites',[None]):
+            for year in step.get('years',[None]):
+                f = fields | ({'siteID':siteID} if siteID is not None else {})
+                f = f | ({'year':fill(str(year),f,name)} if year is not None else {})
+                key = name+''.join(f"[{v}]" for v in [siteID,f.get('year') if year is not None else None] if v is not None)
+                steps[key] = {k:fill(v,f,name) for k,v in step.items() if k not in ['sites','years','after']}
+                steps[key] |= {'name':name,'siteID':siteID,'year':f.get('year') if year is not None else None,'after':step.get('after',[])}
+    return(steps)
+
+def overlaps(output,input):
+    # True if the patterns can match the same file
+    return(output == input or fnmatch.fnmatch(output,input) or fnmatch.fnmatch(input,output))
+
+def dependencies(steps):
+    # Names of the steps that each step waits for
+    depends = {key:set() for key in steps}
+    for key,step in steps.items():
+        for other,o in steps.items():
+            if other == key:
+                continue
+            if o['name'] in step['after']:
+                # Repeats of the same site (and year) if there are any, otherwise all of them
+                same = [k for k,s in steps.items() if s['name'] == o['name'] and s['siteID'] == step['siteID'] and s['year'] in [step['year'],None]]
+                if other in same or not same:
+                    depends[key].add(other)
+            elif o['name'] != step['name'] and any(overlaps(rCfg.resolve_path(out),rCfg.resolve_path(inp)) for out in o.get('outputs',[]) for inp in step.get('inputs',[])):
+                depends[key].add(other)
+    return(depends)
+
+def check_cycles(depends):
+    # Raises an error naming the steps of a dependency cycle, which would otherwise wait forever
+    try:
+        graphlib.TopologicalSorter(depends).prepare()
+    except graphlib.CycleError as e:
+        raise ValueError(f"The pipeline steps depend on each other in a cycle: {' -> '.join(e.args[1])}")
+
+def files(patterns):
+    # Files matching the glob patterns (relative patterns are relative to the Biomet.net/Python folder)
+    found = set()
+    for pattern in patterns:
+        found.update(p for p in glob.glob(rCfg.resolve_path(pattern),recursive=True) if os.path.isfile(p))
+    return(sorted(found))
+
+def signature(paths):
+    # Size and mtime of each file
+    out = {}
+    for p in paths:
+        try:
+            stat = os.stat(p)
+            out[p] = [stat.st_size,stat.st_mtime_ns]
+        except FileNotFoundError:
+            pass
+    return(out)
+
+def definition(step):
+    return(hashlib.blake2b(json.dumps(step,sort_keys=True,default=str).encode(),digest_size=16).hexdigest())
+
+def up_to_date(step,state):
+    # (True if the step can be skipped, reason)
+    if not step.get('inputs'):
+        return(False,'no inputs declared')
+    outputs = [files([p]) for p in step.get('outputs',[])]
+    if not outputs or not all(outputs):
+        return(False,'missing outputs')
+    outputs = set(f for o in outputs for f in o)
+    inputs = signature([f for f in files(step['inputs']) if f not in outputs])
+    if not inputs:
+        return(False,'no input files found')
+    recorded = state.get('definition')
+    if recorded is None:
+        # Never run by the pipeline: compare the timestamps, as make does
+        newest = max(mtime for size,mtime in inputs.values())
+        oldest = min(os.stat(f).st_mtime_ns for f in outputs)
+        return((True,'outputs newer than inputs') if newest <= oldest else (False,'inputs newer than outputs'))
+    if recorded != definition(step):
+        return(False,'step definition changed')
+    changed = [f for f in set(inputs)|set(state.get('inputs',{})) if inputs.get(f) != state['inputs'].get(f)]
+    if changed:
+        return(False,f"{len(changed)} input files changed, e.g. {changed[0]}")
+    return(True,'inputs unchanged')
+
+def run_step(step):
+    # Runs one step, in a worker process; returns its duration
+    t = time.perf_counter()
+    if 'command' in step:
+        biomet = os.path.join(rCfg.moduleDir,'biomet.py')
+        result = subprocess.run([sys.executable,biomet,step['command']]+[str(a) for a in step.get('args',[])])
+        if result.returncode != 0:
+            raise RuntimeError(f"biomet.py {step['command']} exited with code {result.returncode}")
+    else:
+        module,name = step['call'].rsplit('.',1)
+        getattr(importlib.import_module(module),name)(**step.get('kwargs',{}))
+    return(time.perf_counter()-t)
+
+def read_state(path):
+    try:
+        with open(path) as f:
+            return(json.load(f))
+    except (FileNotFoundError,json.JSONDecodeError):
+        return({})
+
+def write_json(path,contents):
+    tmp = path+'.tmp'
+    with open(tmp,'w') as f:
+        json.dump(contents,f,indent=1)
+    os.replace(tmp,path)
+
+def run(pipeline=template,steps=[],workers=1,force=False,dryRun=False):
+    # Runs the pipeline (or the listed steps and the steps they depend on); returns the report
+    import pipelineRunner as pr
+    config = rCfg.set_user_configuration({'pipeline':pipeline})
+    expanded = expand(config['pipeline'],config)
+    depends = dependencies(expanded)
+    check_cycles(depends)
+    if steps:
+        # The requested steps and everything upstream of them
+        selected = {k for k,s in expanded.items() if s['name'] in steps or k in steps}
+        while True:
+            upstream = selected|{d for k in selected for d in depends[k]}
+            if upstream == selected:
+                break
+            selected = upstream
+        expanded = {k:s for k,s in expanded.items() if k in selected}
+    folder = os.path.join(config['rootDir']['database'],'pipeline')
+    os.makedirs(folder,exist_ok=True)
+    name = os.path.splitext(os.path.basename(pipeline))[0]
+    statePath = os.path.join(folder,f"{name}_state.json")
+    state = read_state(statePath)
+
+    report = {k:{'status':'waiting'} for k in expanded}
+    running = {}
+    started,start = datetime.now().isoformat(timespec='seconds'),time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max(workers,1)) as pool:
+        while True:
+            for key,step in expanded.items():
+                if report[key]['status'] != 'waiting':
+                    continue
+                upstream = [report[d]['status'] for d in depends[key] if d in report]
+                if any(s in ['failed','blocked'] for s in upstream):
+                    report[key] = {'status':'blocked','reason':'an upstream step failed'}
+                    continue
+                if not all(s in ['done','skipped','would run'] for s in upstream):
+                    continue
+                if 'would run' in upstream:
+                    report[key] = {'status':'would run','reason':'an upstream step would run'}
+                    continue
+                current,reason = (False,'forced') if force else up_to_date(step,state.get(key,{}))
+                if current:
+                    report[key] = {'status':'skipped','reason':reason}
+                elif dryRun:
+                    report[key] = {'status':'would run','reason':reason}
+                else:
+                    # Inputs are recorded before the run, so files changed while it runs are picked up next time
+                    outputs = set(files(step.get('outputs',[])))
+                    inputs = signature([f for f in files(step.get('inputs',[])) if f not in outputs])
+                    report[key] = {'status':'running','reason':reason}
+                    running[pool.submit(pr.run_step,step)] = (key,inputs)
+                    print(f"Running {key} ({reason})")
+            if not running:
+                break
+            finished,_ = wait(running,return_when=FIRST_COMPLETED)
+            for future in finished:
+                key,inputs = running.pop(future)
+                try:
+                    report[key]['seconds'] = round(future.result(),3)
+                    report[key]['status'] = 'done'
+                    state[key] = {'definition':definition(expanded[key]),'inputs':inputs,'finished':datetime.now().isoformat(timespec='seconds')}
+                    write_json(statePath,state)
+                except Exception as e:
+                    report[key] |= {'status':'failed','error':f"{type(e).__name__}: {e}"}
+                print(f"{key}: {report[key]['status']}")
+    for key,r in report.items():
+        if r['status'] == 'waiting':
+            # Not expected after check_cycles, but never report a step that didn't run as anything but failed
+            report[key] = {'status':'failed','error':'its upstream steps never finished'}
+
+    for key,r in report.items():
+        print(f"{key:<40} {r['status']:<10} {r.get('seconds',''):<10} {r.get('error',r.get('reason',''))}")
+    summary = {'pipeline':rCfg.resolve_path(pipeline),'started':started,
+               'seconds':round(time.perf_counter()-start,3),'steps':report}
+    if not dryRun:
+        write_json(os.path.join(folder,f"{name}_report_{datetime.now().strftime('%Y%m%dT%H%M%S')}.json"),summary)
+    return(summary)
+
+# If called from command line ...
+if __name__ == '__main__':
+
+    CLI=argparse.ArgumentParser()
+
+    for key,val in defaultArgs.items():
+        if type(val) == list:
+            CLI.add_argument(f"--{key}",nargs='+',type=str,default=val)
+        else:
+            CLI.add_argument(f"--{key}",nargs="?",type=type(val),default=val)
+    CLI.add_argument("--force",action='store_true',help='run every step, even if it is up to date')
+    CLI.add_argument("--dryRun",action='store_true',help='only report the steps that would run')
+
+    # parse the command line
+    args = CLI.parse_args()
+    report = run(args.pipeline,args.steps,args.workers,args.force,args.dryRun)
+    sys.exit(1 if any(r['status'] in ['failed','blocked'] for r in report['steps'].values()) else 0)
@@ -1,30 +1,92 @@
 import sys
+import time
+import threading
 ## Progress bar to update status of a run
+# Redraws are throttled to at most one every "interval" seconds, so calling step() once per item is cheap
+# When the output is not a terminal (e.g., cron logs or MATLAB system() calls)
+# a plain log line is written every "logInterval" seconds instead of redrawing the bar
 class progressbar():
-    def __init__(self,items,prefix='',size=60,out=sys.stdout):
+    def __init__(self,items,prefix='',size=60,out=sys.stdout,interval=0.2,logInterval=30):
         self.nItems = items
         self.out = out
         self.i = 0
+        self.nBytes = 0
         self.prefix=prefix
         self.size=size
+        self.isTTY = hasattr(out,'isatty') and out.isatty()
+        self.interval = interval if self.isTTY else logInterval
+        self.lock = threading.Lock()
+        self.t0 = time.monotonic()
+        self.lastShow = None
         self.show(0)
 
-    def show(self,j):
+    def rates(self,j):
+        elapsed = max(time.monotonic()-self.t0,1e-9)
+        itemRate = j/elapsed
+        byteRate = self.nBytes/elapsed
+        if itemRate > 0 and self.nItems > j:
+            eta = (self.nItems-j)/itemRate
+        else:
+            eta = 0
+        return(itemRate,byteRate,eta)
+
+    def stats(self,j):
+        itemRate,byteRate,eta = self.rates(j)
+        txt = f"{itemRate:.1f} it/s"
+        if self.nBytes > 0:
+            txt += f" {formatBytes(byteRate)}/s"
+        if j < self.nItems:
+            txt += f" ETA {formatSeconds(eta)}"
+        else:
+            txt += f" in {formatSeconds(time.monotonic()-self.t0)}"
+        return(txt)
+
+    def show(self,j,force=False):
+        now = time.monotonic()
+        if not force and self.lastShow is not None and now-self.lastShow < self.interval and j < self.nItems:
+            return
+        self.lastShow = now
         if self.nItems > 0:
-            x = int(self.size*j/self.nItems)
-            print(f"{self.prefix}[{u'█'*x}{('.'*(self.size-x))}] {j}/{self.nItems}", end='\r', file=self.out, flush=True)
+            if self.isTTY:
+                x = int(self.size*min(j,self.nItems)/self.nItems)
+                print(f"{self.prefix}[{u'█'*x}{('.'*(self.size-x))}] {j}/{self.nItems} {self.stats(j)}", end='\r', file=self.out, flush=True)
+            else:
+                print(f"{self.prefix} {j}/{self.nItems} ({100*j/self.nItems:.0f}%) {self.stats(j)}", file=self.out, flush=True)
 
-    def step(self,step_size=1):
-        self.i+=step_size
-        self.show(self.i)
+    # nBytes is optional, used to report throughput for file copies etc.
+    # Safe to call from multiple worker threads
+    def step(self,step_size=1,nBytes=0):
+        with self.lock:
+            self.i+=step_size
+            self.nBytes+=nBytes
+            self.show(self.i)
 
     def close(self):
-        print('\n')
+        with self.lock:
+            if self.i < self.nItems:
+                self.show(self.i,force=True)
+        if self.isTTY:
+            print('\n',file=self.out)
+
+def formatBytes(n):
+    for unit in ['B','kB','MB','GB']:
+        if abs(n) < 1024:
+            return(f"{n:.1f} {unit}")
+        n /= 1024
+    return(f"{n:.1f} TB")
+
+def formatSeconds(s):
+    m,s = divmod(int(s),60)
+    h,m = divmod(m,60)
+    if h > 0:
+        return(f"{h}:{m:02d}:{s:02d}")
+    return(f"{m:02d}:{s:02d}")
 
 if __name__ == '__main__':
     prefix = 'Test'
     nItems=10
     pb = progressbar(nItems,prefix)
     for i in range(nItems):
-        pb.step()
+        time.sleep(0.1)
+        pb.step(nBytes=1024)
     pb.close()
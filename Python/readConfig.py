@@ -4,47 +4,72 @@
 
 import os
 import sys
+import copy
 import yaml # Note: you need to install the "pyyaml" package, e.g., pip install pyyaml
 import argparse
+import threading
 
+# All relative paths are resolved against this directory, the working directory is never changed
+moduleDir = os.path.dirname(os.path.abspath(__file__))
+
+# Parsed yaml files keyed on absolute path, holding (mtime, size, contents)
+_yamlCache = {}
+_cacheLock = threading.Lock()
+
+def resolve_path(path):
+    # Relative paths are relative to the Biomet.net/Python folder, absolute paths are unchanged
+    return(os.path.normpath(os.path.join(moduleDir,path)))
+
+def load_yaml(path):
+    # Parse a yaml file, re-using the parsed contents until the file is modified
+    # A deep copy is returned so callers can modify their config without affecting the cache
+    path = resolve_path(path)
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns,stat.st_size)
+    with _cacheLock:
+        cached = _yamlCache.get(path)
+        if cached is None or cached[0] != key:
+            with open(path) as yml:
+                cached = (key,yaml.safe_load(yml))
+            _yamlCache[path] = cached
+        return(copy.deepcopy(cached[1]))
+
+def clear_cache():
+    with _cacheLock:
+        _yamlCache.clear()
 
 def set_user_configuration(auxilary={}):
-    wd = os.getcwd()
-    os.chdir(os.path.split(__file__)[0])
     # Parse the config settings
-    with open('config_files/config.yml') as yml:
-        config = yaml.safe_load(yml)
-        if os.path.isfile('config_files/user_path_definitions.yml'):
-            with open('config_files/user_path_definitions.yml') as yml:
-                config.update(yaml.safe_load(yml))
-        else:
-            with open('config_files/user_path_definitions_template.yml') as yml:
-                config.update(yaml.safe_load(yml))
-            print(f"WARNING: missing {'config_files/user_path_definitions.yml'}")
-            print("Proceeding with template paths from {'config_files/user_path_definitions_template.yml'}")
-            print("These are likely to cause issues, please create your own path definition file")
+    config = load_yaml('config_files/config.yml')
+    if os.path.isfile(resolve_path('config_files/user_path_definitions.yml')):
+        config.update(load_yaml('config_files/user_path_definitions.yml'))
+    else:
+        config.update(load_yaml('config_files/user_path_definitions_template.yml'))
+        print(f"WARNING: missing {'config_files/user_path_definitions.yml'}")
+        print("Proceeding with template paths from {'config_files/user_path_definitions_template.yml'}")
+        print("These are likely to cause issues, please create your own path definition file")
 
+    # A bare list (or string) of files is treated as a list of task files
+    if isinstance(auxilary,(str,list,tuple)):
+        auxilary = {'tasks':auxilary}
     # Import the user specified configurations (exit if they don't exist)
-    if auxilary != {}:
-        for key,value in auxilary.items():
-            config[key] = {}
-            if isinstance(value,str):value=[value]
-            for req in value:
-                if os.path.isfile(req):
-                    with open(req) as yml:
-                        config[key].update(yaml.safe_load(yml))
-                else:
-                    sys.exit(f"Missing {req}")
-            os.chdir(wd)
+    for key,value in auxilary.items():
+        config[key] = {}
+        if isinstance(value,str):value=[value]
+        for req in value:
+            if os.path.isfile(resolve_path(req)):
+                config[key].update(load_yaml(req))
+            else:
+                sys.exit(f"Missing {req}")
     return(config)
 
 # If called from command line ...
 if __name__ == '__main__':
-    
+
     CLI=argparse.ArgumentParser()
 
     CLI.add_argument(
-        "--tasks", 
+        "--tasks",
         nargs='+',
         type=str,
         default=[],
@@ -0,0 +1,151 @@
+# Lightweight timing and resource instrumentation for the python pipeline tools
+# Written to be called by other scripts, e.g.:
+    # import runMetrics as rm
+    # with rm.stage('makeCSV',siteID='BBS'):
+    #     rm.count_read(filePath)
+    # or decorate a function with @rm.timed('makeCSV')
+# Stages are per thread: threads started within a stage count in it only if started with rm.use_stages (see below)
+# Disabled by default, in which case every call is a no-op
+# Enable by setting the environment variable BIOMET_METRICS to an output folder, or calling rm.enable(folder)
+    # Each run writes one JSON-lines file: <folder>/<tool>_<YYYYmmddTHHMMSS>_<pid>.jsonl
+    # with one record per completed stage: wall & cpu time, bytes/files read & written, and peak RSS
+    # cpu_s well below wall_s indicates an I/O bound stage
+# Set BIOMET_PROFILE_STAGE to a stage name to also dump a cProfile .prof file for that stage
+    # inspect with e.g.: py -m pstats <file>.prof or snakeviz <file>.prof
+
+import os
+import sys
+import json
+import time
+import cProfile
+import functools
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+
+enabled = False
+outputFolder = None
+profileStage = os.environ.get('BIOMET_PROFILE_STAGE')
+runID = f"{os.path.splitext(os.path.basename(sys.argv[0]))[0].lstrip('-') or 'python'}_{datetime.now().strftime('%Y%m%dT%H%M%S')}_{os.getpid()}"
+
+_lock = threading.Lock()
+_local = threading.local()
+counterNames = ['bytes_read','bytes_written','files_read','files_written']
+
+def enable(folder):
+    global enabled, outputFolder
+    os.makedirs(folder,exist_ok=True)
+    outputFolder = folder
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def metrics_file():
+    return(os.path.join(outputFolder,f"{runID}.jsonl"))
+
+def peak_rss_mb():
+    # Peak resident memory of this process in MB (None if it can't be determined)
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is reported in bytes on macOS and in kB elsewhere
+        if sys.platform.startswith('darwin'):
+            return(peak/1024**2)
+        return(peak/1024)
+    except ImportError:
+        pass
+    try:
+        import psutil
+        mem = psutil.Process(os.getpid()).memory_info()
+        return(getattr(mem,'peak_wset',mem.rss)/1024**2)
+    except ImportError:
+        return(None)
+
+def _active():
+    if not hasattr(_local,'stack'):
+        _local.stack = []
+    return(_local.stack)
+
+def current_stages():
+    # The active stages of this thread, see use_stages
+    return(list(_active()))
+
+def use_stages(stages):
+    # Counts what this thread reads and writes in the given stages (of another thread)
+    # e.g., as the initializer of a thread pool: ThreadPoolExecutor(initializer=rm.use_stages,initargs=(rm.current_stages(),))
+    _local.stack = list(stages)
+
+def _add(counter,value):
+    with _lock:
+        for record in _active():
+            record[counter] += value
+
+def count_read(path=None,nBytes=None,nFiles=1):
+    # Record a file read within the active stage(s); give either a path (size is looked up) or a byte count
+    if not enabled:return
+    if nBytes is None:
+        nBytes = os.path.getsize(path) if path is not None and os.path.isfile(path) else 0
+    _add('bytes_read',nBytes)
+    _add('files_read',nFiles)
+
+def count_written(path=None,nBytes=None,nFiles=1):
+    if not enabled:return
+    if nBytes is None:
+        nBytes = os.path.getsize(path) if path is not None and os.path.isfile(path) else 0
+    _add('bytes_written',nBytes)
+    _add('files_written',nFiles)
+
+def write_record(record):
+    line = json.dumps(record,default=str)
+    with _lock:
+        with open(metrics_file(),'a') as f:
+            f.write(line+'\n')
+
+@contextmanager
+def stage(name,**info):
+    # Time a block of code, nested stages are reported separately and counters roll up to all active stages
+    if not enabled:
+        yield None
+        return
+    record = {'run':runID,'stage':name,'start':datetime.now().isoformat(timespec='seconds')}
+    record.update(info)
+    for c in counterNames:
+        record[c] = 0
+    stack = _active()
+    stack.append(record)
+    profiler = None
+    if profileStage == name:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    t0,c0 = time.perf_counter(),time.process_time()
+    status = 'ok'
+    try:
+        yield record
+    except BaseException as e:
+        status = type(e).__name__
+        raise
+    finally:
+        record['wall_s'] = round(time.perf_counter()-t0,4)
+        record['cpu_s'] = round(time.process_time()-c0,4)
+        record['peak_rss_mb'] = peak_rss_mb()
+        record['status'] = status
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(outputFolder,f"{runID}_{name}.prof"))
+        stack.remove(record)
+        write_record(record)
+
+def timed(name):
+    # Decorator form of stage(), e.g., @rm.timed('makeCSV')
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args,**kwargs):
+            with stage(name):
+                return(func(*args,**kwargs))
+        return(wrapper)
+    return(decorator)
+
+if os.environ.get('BIOMET_METRICS'):
+    enable(os.environ['BIOMET_METRICS'])
@@ -0,0 +1,89 @@
+# Checks the manifest (update='changed') and append (update='append') exports of csvFromBinary.py
+# Run from the Biomet.net/Python folder with: py -m pytest tests
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import csvFromBinary as cfb
+import readConfig as rCfg
+import benchmarkDatabase as bd
+
+site = 'SITE1'
+traces = ['TA_1_1_1','RH_1_1_1','SW_IN_1_1_1']
+# Longer than the database (2022 and 2023), the years without files are skipped
+everything = ['2020-01-01 00:00','2030-12-31 23:59']
+
+@pytest.fixture
+def database(tmp_path):
+    config = rCfg.set_user_configuration()
+    root = bd.make_database(str(tmp_path),[2022,2023],[site],len(bd.templateTraces),config)
+    task = {'feed':{'stage':'Third',
+                    'traces':{t:{'units':'unit','output_name':t} for t in traces},
+                    'formatting':{'units_in_header':True,'na_value':-9999,
+                                  'time_vectors':{'timestamp':{'output_name':'TIMESTAMP','fmt':'%Y-%m-%d %H%M','units':'yyyy-mm-dd HHMM'}}}}}
+    with open(tmp_path/'task.yml','w') as f:
+        yaml.safe_dump(task,f)
+    # the year folders are appended to the database path
+    return(root+'/',str(tmp_path/'task.yml'),config)
+
+def export(database,outputPath,dateRange=everything,update='append'):
+    root,task,_ = database
+    return(cfb.makeCSV(siteID=site,dateRange=dateRange,tasks=[task],database=root,outputPath=str(outputPath),
+                       update=update,nameTimeStamp=False)['feed'])
+
+def read(path):
+    return(pd.read_csv(path,header=[0,1]))
+
+def test_changed_skips_unchanged_sources(database,tmp_path,capsys):
+    dout = export(database,tmp_path/'out',update='changed')
+    export(database,tmp_path/'out',update='changed')
+    assert 'Unchanged since last export' in capsys.readouterr().out
+    # new data in a source trace
+    stage = database[2]['stage']['Third']
+    path = os.path.join(database[0],'2023',site,stage,'TA_1_1_1')
+    values = np.fromfile(path,np.float32)
+    values[:10] = 1
+    values.tofile(path)
+    os.utime(path,ns=(os.stat(path).st_mtime_ns+10**9,)*2)
+    export(database,tmp_path/'out',update='changed')
+    assert 'Unchanged since last export' not in capsys.readouterr().out
+    assert (read(dout)[('TA_1_1_1','unit')].values[17520:17530] == 1).all()
+
+def test_append_matches_full_export(database,tmp_path):
+    full = read(export(database,tmp_path/'full',update='all'))
+    feed = read(export(database,tmp_path/'feed'))
+    pd.testing.assert_frame_equal(feed,full)
+    timestamps = feed[('TIMESTAMP','yyyy-mm-dd HHMM')]
+    assert timestamps.is_unique
+    assert timestamps.iloc[0] == '2022-01-01 0030' and timestamps.iloc[-1] == '2024-01-01 0000'
+    assert (timestamps == '2023-01-01 0000').sum() == 1
+
+@pytest.mark.parametrize('first',['2022-12-31 23:30','2023-01-01 00:00','2023-03-15 12:00'])
+def test_append_resumes_after_the_last_row(database,tmp_path,capsys,first):
+    # Exported in two parts, split before, on and after the Jan 1 00:00 row of the 2022 file
+    full = read(export(database,tmp_path/'full',update='all'))
+    export(database,tmp_path/'feed',dateRange=[everything[0],first])
+    dout = export(database,tmp_path/'feed')
+    assert 'Appended' in capsys.readouterr().out
+    pd.testing.assert_frame_equal(read(dout),full)
+    export(database,tmp_path/'feed')
+    assert 'No new rows to append' in capsys.readouterr().out
+
+def test_append_holds_back_rows_without_data(database,tmp_path):
+    # The end of 2023 has no data yet, it is appended once it arrives
+    root,_,config = database
+    folder = os.path.join(root,'2023',site,config['stage']['Third'])
+    original = {t:np.fromfile(os.path.join(folder,t),np.float32) for t in traces}
+    for t,values in original.items():
+        np.where(np.arange(values.size) < 10000,values,np.nan).astype(np.float32).tofile(os.path.join(folder,t))
+    dout = export(database,tmp_path/'feed')
+    assert read(dout).shape[0] == 17520+10000
+    for t,values in original.items():
+        values.tofile(os.path.join(folder,t))
+    export(database,tmp_path/'feed')
+    pd.testing.assert_frame_equal(read(dout),read(export(database,tmp_path/'full',update='all')))
@@ -0,0 +1,111 @@
+# Checks the run planning of methaneGapfillML.py, and the split indices written by the installed fluxgapfill
+# Run from the Biomet.net/Python folder with: py -m pytest tests
+
+import os
+import sys
+import json
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import methaneGapfillML as mgml
+
+flux_config = {
+    'trace':'ThirdStage/FCH4',
+    'preds_trace':['SecondStage/TA_1_1_1','SecondStage/SW_IN_1_1_1'],
+    'split_method':'artificial',
+    'num_splits':2,
+    'models':['rf','xgb'],
+}
+predictors = ['TA_1_1_1','SW_IN_1_1_1']
+fingerprints = {'2022':'a','2023':'b'}
+
+def frame(years=['2022','2023'],seed=0):
+    # Half-hourly AmeriFlux-style frame with gaps in the target, as read_database_traces returns per year
+    rng = np.random.default_rng(seed)
+    dfs = {}
+    for year in years:
+        end = pd.date_range(f'{year}-01-01 00:30',f'{int(year)+1}-01-01 00:00',freq='30min').values
+        n = end.size
+        ta = 10*np.sin(np.arange(n)*2*np.pi/48)+rng.normal(0,1,n)
+        sw = np.clip(500*np.sin(np.arange(n)*2*np.pi/48),0,None)
+        fch4 = 20+0.5*ta+rng.normal(0,2,n)
+        # gaps of 1 to 20 half-hours, about a third of the data
+        for start in rng.choice(n,n//60,replace=False):
+            fch4[start:start+rng.integers(1,20)] = np.nan
+        dfs[year] = pd.DataFrame({
+            'TIMESTAMP_START':mgml.ameriflux_timestamps(end-np.timedelta64(30,'m')),
+            'TIMESTAMP_END':mgml.ameriflux_timestamps(end),
+            'TA_1_1_1':ta,'SW_IN_1_1_1':sw,'FCH4':fch4,
+        })
+    return(dfs)
+
+def trained_site(site_path,run_info):
+    # A site with complete splits and trained, tested models for run_info
+    mgml.write_run_info(site_path,run_info)
+    os.makedirs(site_path/'indices')
+    for name in mgml.index_files(flux_config['num_splits']):
+        np.save(site_path/'indices'/name,np.arange(3))
+    for model in flux_config['models']:
+        model_dir = site_path/'models'/model
+        os.makedirs(model_dir)
+        for name in [f'{model}{i}.pkl' for i in range(flux_config['num_splits'])]+['val_metrics.csv','test_metrics.csv','test_predictions.csv','scale.json']:
+            (model_dir/name).touch()
+        with open(model_dir/mgml.MODEL_INFO,'w') as f:
+            json.dump({'model':model,'predictors':predictors,'data_fingerprint':mgml.data_fingerprint(run_info)},f)
+
+def test_unchanged_data_only_gapfills(tmp_path):
+    run_info = mgml.build_run_info(fingerprints,flux_config)
+    trained_site(tmp_path,run_info)
+    assert mgml.get_stages_to_run(tmp_path,run_info,flux_config,'FCH4','full')['stages'] == [mgml.GAPFILL]
+
+@pytest.mark.parametrize('changed',[{'2023':'c'},{'2024':'d'}])
+def test_changed_year_splits_again_and_retrains_all_models(tmp_path,changed):
+    # The splits span all years, so new data in one year (or a new year) means new splits for every model
+    trained_site(tmp_path,mgml.build_run_info(fingerprints,flux_config))
+    run_plan = mgml.get_stages_to_run(tmp_path,mgml.build_run_info(fingerprints|changed,flux_config),flux_config,'FCH4','full')
+    assert run_plan['stages'] == [mgml.PREPROCESS,mgml.TRAIN,mgml.TEST,mgml.GAPFILL]
+    assert run_plan['train_models'] == flux_config['models']
+    # the trained models are kept until they are retrained
+    assert (tmp_path/'models'/'rf'/'rf0.pkl').exists()
+
+def test_changed_predictors_retrain_only_that_model(tmp_path):
+    run_info = mgml.build_run_info(fingerprints,flux_config)
+    trained_site(tmp_path,run_info)
+    with open(tmp_path/'models'/'xgb'/mgml.MODEL_INFO,'w') as f:
+        json.dump({'model':'xgb','predictors':predictors[:1],'data_fingerprint':mgml.data_fingerprint(run_info)},f)
+    run_plan = mgml.get_stages_to_run(tmp_path,run_info,flux_config,'FCH4','full')
+    assert run_plan['stages'] == [mgml.TRAIN,mgml.TEST,mgml.GAPFILL]
+    assert run_plan['train_models'] == ['xgb'] and run_plan['test_models'] == ['xgb']
+
+def test_check_indices(tmp_path):
+    target = np.array([1.0,np.nan,2.0,3.0])
+    os.makedirs(tmp_path/'indices')
+    for name in mgml.index_files(1):
+        np.save(tmp_path/'indices'/name,np.array([0,2]))
+    mgml.check_indices(tmp_path,target,1)
+    np.save(tmp_path/'indices'/'val0.npy',np.array([0,1]))
+    with pytest.raises(ValueError,match='without a measured target'):
+        mgml.check_indices(tmp_path,target,1)
+    np.save(tmp_path/'indices'/'val0.npy',np.array([True,False,True]))
+    with pytest.raises(ValueError,match='mask of 3 rows'):
+        mgml.check_indices(tmp_path,target,1)
+
+def test_preprocess_writes_the_expected_indices(tmp_path):
+    # Runs the installed fluxgapfill, which has to write the split indices check_indices expects
+    pytest.importorskip('fluxgapfill')
+    mgml.import_fluxgapfill()
+    df_all = mgml.fluxgapfill_frame(mgml.stack_years(frame()))
+    mgml.setup_and_preprocess(tmp_path,df_all,mgml.build_run_info(fingerprints,flux_config),flux_config,'FCH4')
+    assert mgml.has_complete_indices(tmp_path,flux_config['num_splits'])
+    target = df_all['FCH4'].values
+    test = np.load(tmp_path/'indices'/'test.npy')
+    for i in range(flux_config['num_splits']):
+        # the test rows are held out of every training and validation split
+        for name in [f'train{i}.npy',f'val{i}.npy']:
+            split = np.load(tmp_path/'indices'/name)
+            rows = np.flatnonzero(split) if split.dtype == bool else split
+            held_out = np.flatnonzero(test) if test.dtype == bool else test
+            assert not np.isin(rows,held_out).any()
+    assert mgml.get_stages_to_run(tmp_path,mgml.build_run_info(fingerprints,flux_config),flux_config,'FCH4','full')['stages'][0] == mgml.TRAIN
@@ -0,0 +1,84 @@
+# Checks that the files packed by traceArchive.py read back unchanged, in whole or in part
+# Run from the Biomet.net/Python folder with: py -m pytest tests
+
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import traceArchive as ta
+
+config = {'dbase_metadata':{'timestamp':{'name':'clean_tv','dtype':'float64'},'traces':{'dtype':'float32'}}}
+records = 17520
+chunkRecords = 1000
+
+def stage_folder(root):
+    # One year of half-hourly traces: smooth, mostly NaN, and a text file that isn't a trace
+    folder = os.path.join(root,'2022','SITE1','Clean','ThirdStage')
+    os.makedirs(folder)
+    rng = np.random.default_rng(0)
+    files = {
+        'clean_tv':738522+np.arange(1,records+1)/48,
+        'TA_1_1_1':(10*np.sin(np.arange(records)*2*np.pi/48)+rng.normal(0,1,records)).astype(np.float32),
+        'FCH4':np.full(records,np.nan,dtype=np.float32),
+    }
+    files['FCH4'][::7] = rng.normal(20,2,files['FCH4'][::7].size)
+    for name,values in files.items():
+        values.tofile(os.path.join(folder,name))
+    with open(os.path.join(folder,'notes.txt'),'w') as f:
+        f.write('not a trace')
+    return(folder,files)
+
+@pytest.mark.parametrize('codec',['zlib','zstd'])
+def test_round_trip(tmp_path,codec):
+    if codec != 'zlib':
+        pytest.importorskip('zstandard')
+    folder,files = stage_folder(str(tmp_path))
+    raw = {name:open(os.path.join(folder,name),'rb').read() for name in os.listdir(folder)}
+    mtimes = {name:os.stat(os.path.join(folder,name)).st_mtime_ns for name in raw}
+    index = ta.pack_folder(folder,config,codec=codec,chunkRecords=chunkRecords)
+    assert index['codec'] == codec
+    assert not os.path.exists(folder) and os.path.isfile(ta.archive_path(folder))
+    assert ta.listdir(folder) == sorted(raw)
+    for name,values in files.items():
+        np.testing.assert_array_equal(ta.read(os.path.join(folder,name),values.dtype),values)
+        assert ta.file_stat(os.path.join(folder,name)) == [values.nbytes,mtimes[name]]
+    ta.unpack_folder(folder)
+    assert not os.path.exists(ta.archive_path(folder))
+    for name,data in raw.items():
+        assert open(os.path.join(folder,name),'rb').read() == data
+        assert os.stat(os.path.join(folder,name)).st_mtime_ns == mtimes[name]
+
+@pytest.mark.parametrize('rows',[slice(0,1),slice(999,1001),slice(500,3500),slice(1000,2000),
+                                 slice(16999,None),slice(records-1,records+10),slice(5,5),slice(None,None)])
+def test_partial_rows(tmp_path,rows):
+    # Reads within a chunk, across chunk boundaries, on boundaries and past the end of the file
+    folder,files = stage_folder(str(tmp_path))
+    ta.pack_folder(folder,config,chunkRecords=chunkRecords)
+    for name,values in files.items():
+        np.testing.assert_array_equal(ta.read(os.path.join(folder,name),values.dtype,rows=rows),values[rows])
+
+def test_loose_file_takes_precedence(tmp_path):
+    folder,files = stage_folder(str(tmp_path))
+    ta.pack_folder(folder,config,chunkRecords=chunkRecords)
+    os.makedirs(folder)
+    new = np.arange(records,dtype=np.float32)
+    new.tofile(os.path.join(folder,'TA_1_1_1'))
+    np.testing.assert_array_equal(ta.read(os.path.join(folder,'TA_1_1_1'),np.float32,rows=slice(10,20)),new[10:20])
+    np.testing.assert_array_equal(ta.read(os.path.join(folder,'FCH4'),np.float32),files['FCH4'])
+    # and replaces the archived copy when the folder is packed again
+    ta.pack_folder(folder,config,chunkRecords=chunkRecords)
+    np.testing.assert_array_equal(ta.read(os.path.join(folder,'TA_1_1_1'),np.float32),new)
+    np.testing.assert_array_equal(ta.read(os.path.join(folder,'FCH4'),np.float32),files['FCH4'])
+
+def test_unpack_to_write(tmp_path):
+    folder,files = stage_folder(str(tmp_path))
+    ta.pack_folder(folder,config,chunkRecords=chunkRecords)
+    ta.unpack_to_write(folder)
+    assert not os.path.exists(ta.archive_path(folder))
+    assert sorted(os.listdir(folder)) == sorted(list(files)+['notes.txt'])
+    # folders without an archive are left as they are
+    ta.unpack_to_write(folder)
+    ta.unpack_to_write(os.path.join(str(tmp_path),'2023','SITE1','Clean','ThirdStage'))
+    assert not os.path.exists(os.path.join(str(tmp_path),'2023'))
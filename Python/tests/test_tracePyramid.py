@@ -0,0 +1,68 @@
+# Checks that the aggregates of tracePyramid.py give the same results as resampling the year files
+# Run from the Biomet.net/Python folder with: py -m pytest tests
+
+import os
+import sys
+import pandas as pd
+import pytest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tracePyramid as tp
+import traceQuery as tq
+import benchmarkDatabase as bd
+
+site,stage,traces = 'SITE1','Third',['TA_1_1_1','RH_1_1_1']
+
+@pytest.fixture(scope='module')
+def stores(tmp_path_factory):
+    # Two years of synthetic data with their aggregates, queried with and without them
+    root = str(tmp_path_factory.mktemp('pyramid'))
+    config = tp.get_config()
+    database = bd.make_database(root,[2022,2023],[site],len(bd.templateTraces),config)
+    tp.build(site,stage,database=database,traces=traces)
+    return(tq.traceStore(database=database),tq.traceStore(database=database,usePyramid=False))
+
+# (start, end) per level: whole bins, which are served from the aggregates, and unaligned or partial edges, which are not
+ranges = {
+    'daily':[(None,None),('2022-03-01','2023-02-28 23:30'),('2022-12-25','2023-01-07 23:30'),
+             ('2022-03-01 12:00','2022-03-10'),('2022-03-01 00:30','2022-03-10 23:30'),(None,'2022-06-30 12:00')],
+    'weekly':[(None,None),('2022-01-03','2023-01-01 23:30'),('2022-12-19','2023-01-08 23:30'),
+              ('2022-01-02','2023-01-01'),('2021-01-03','2023-01-01'),('2022-01-02 00:30','2023-01-02'),
+              ('2022-03-01','2022-06-30 23:30'),('2022-05-02',None)],
+    'monthly':[(None,None),('2022-01-01','2023-12-31 23:30'),('2022-11-01','2023-02-28 23:30'),
+               ('2022-01-15','2022-06-30 23:30'),('2022-01-01 00:30','2022-12-31'),('2022-02-01',None)],
+}
+whole = {'daily':[0,1,2],'weekly':[0,1,2,7],'monthly':[0,1,2,5]}
+
+@pytest.mark.parametrize('level,i',[(level,i) for level,r in ranges.items() for i in range(len(r))])
+def test_query_matches_raw(stores,level,i):
+    pyramid,raw = stores
+    start,end = ranges[level][i]
+    freq = tp.levels[level]
+    agg = ['mean','min','max','count']
+    served = pyramid.query_pyramid(site,traces,stage,start,end,freq,agg)
+    assert (served is not None) == (i in whole[level])
+    expected = raw.query(site,traces,stage,start,end,freq,agg)
+    pd.testing.assert_frame_equal(pyramid.query(site,traces,stage,start,end,freq,agg),expected,check_dtype=False,check_freq=False,rtol=1e-5)
+
+@pytest.mark.parametrize('level',list(tp.levels))
+def test_read_returns_whole_bins(stores,level):
+    # Bins that include any time from start to end, with the statistics of the whole bin
+    pyramid,raw = stores
+    start,end = '2022-05-01','2022-08-17 13:00'
+    df = tp.read(site,stage,traces[0],level,start,end,config=pyramid.config)
+    full = raw.query(site,[traces[0]],stage,freq=tp.levels[level],agg=tp.stats)
+    partial = raw.query(site,[traces[0]],stage,start,end,freq=tp.levels[level])
+    expected = full.loc[partial.index]
+    expected.columns = tp.stats
+    pd.testing.assert_frame_equal(df,expected,check_dtype=False,check_freq=False,check_names=False,rtol=1e-5)
+
+@pytest.mark.parametrize('level',list(tp.levels))
+def test_bin_bounds(level):
+    # Every timestamp is within the bounds of the bin pandas puts it in, and bins start on bin edges
+    index = pd.date_range('2022-12-01 00:30','2023-02-01 00:00',freq='30min')
+    groups = pd.Series(index,index=index).resample(tp.levels[level])
+    for label,times in groups:
+        left,right = tp.bin_bounds(level,pd.DatetimeIndex([label]))
+        assert ((times >= left[0]) & (times < right[0])).all()
+        assert tp.is_bin_edge(level,left[0]) and tp.is_bin_edge(level,right[0])
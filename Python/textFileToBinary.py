@@ -6,13 +6,18 @@ import datetime
 import pandas as pd
 from glob import glob
 import readConfig as rCfg
+import runMetrics as rm
+import traceArchive as ta
 
 template = ['config_files/gsheet_to_binary.yml','config_files/dat_to_binary.yml']
-os.chdir(os.path.split(__file__)[0])
 
 class writeBinaryTraces():
-    def __init__(self,tasks=template):
+    @rm.timed('writeBinaryTraces')
+    def __init__(self,tasks=template,database=None):
         self.config = rCfg.set_user_configuration(tasks)
+        # Optionally write to a database other than the one in user_path_definitions.yml
+        if database is not None:
+            self.config['rootDir']['Database'] = database
         for name,task in self.config['tasks'].items():
             if 'prefix' in task['site']: self.prefix = task['site']['prefix']
             else: self.prefix=''
@@ -39,6 +44,7 @@ class writeBinaryTraces():
         Data = pd.DataFrame()
         if task['formatting']['header'] == 'None':task['formatting']['header']=None
         for file in fileList:
+            rm.count_read(file)
             if 'autoDate' in task['formatting']:
                 df = pd.read_csv(file,header=task['formatting']['header'])
                 df.columns = df.columns.get_level_values(0)
@@ -102,6 +108,7 @@ class writeBinaryTraces():
         # write binary files by year following the Biomet format with a matlab datenum index
         for y in Data.index.year.unique():
             dout = os.path.abspath(os.path.join(self.config['rootDir']['Database'],str(y),self.siteID,self.stage))
+            ta.unpack_to_write(dout)
             os.makedirs(dout,exist_ok=True)
             Year = pd.DataFrame(data={'datetime':pd.date_range(start = f'{y}01010030',end=f'{y+1}01010001',freq='30T')})
             Year.set_index('datetime',inplace=True)
@@ -118,6 +125,7 @@ class writeBinaryTraces():
                 with open(f'{dout}/{traceName}','wb') as out:
                     print(f'Writing: {dout}/{traceName}')
                     Trace.tofile(out)
+                rm.count_written(nBytes=Trace.nbytes)
                 
     
     def toMatlabTimeVector(self,datetime_in):
@@ -137,10 +145,17 @@ if __name__ == '__main__':
         type=str,
         default=template,
         )
+
+    CLI.add_argument(
+        "--database", 
+        nargs='?',
+        type=str,
+        default=None,
+        )
       
     # Parse the args and make the call
     args = CLI.parse_args()
 
     # Call 
-    writeBinaryTraces(args.tasks)
+    writeBinaryTraces(args.tasks,args.database)
     
\ No newline at end of file
@@ -0,0 +1,320 @@
+# Compressed archive of the stage folders of completed years
+# pack replaces the files of Database/YYYY/SiteID/Stage/ with a single Database/YYYY/SiteID/Stage.archive file:
+    # each file is split into chunks (CHUNK_RECORDS values), byte-shuffled and compressed
+    # mostly NaN or slowly varying traces shrink to a small fraction of their size
+    # an index at the end of the file gives the location of each chunk, and the size, mtime and digest of the original file
+# The python readers (csvFromBinary, methaneGapfillML, traceQuery, tracePyramid) read archived traces transparently,
+#   and only decompress the chunks that overlap the requested period
+# The python writers (binaryFromText, textFileToBinary, firstStageCleaning, ERA5_to_binary, methaneGapfillML)
+#   unpack an archived folder before writing to it (unpack_to_write)
+# Files written to an archived folder by other tools take precedence over the archived copy
+#   and replace it the next time the folder is packed
+# Tools that read or write the files directly (e.g., the matlab tools) need the folder unpacked first
+
+# Codecs: zlib (standard library) or zstd/blosc if the zstandard/blosc packages are installed
+    # the codec is recorded in the archive, readers need the same package
+
+# Example calls from command line:
+    # py traceArchive.py pack --siteID BB --stage Third --years 2019 2020 2021
+    # py traceArchive.py unpack --siteID BB --stage Third --years 2020
+    # py traceArchive.py info --siteID BB --stage Third --years 2020
+# From python:
+    # import traceArchive as ta
+    # values = ta.read('C:/Database/2020/BB/Clean/ThirdStage/FC','float32',rows=slice(0,1488))
+
+import os
+import json
+import zlib
+import errno
+import struct
+import hashlib
+import argparse
+import threading
+import numpy as np
+import readConfig as rCfg
+from datetime import datetime
+
+SUFFIX = '.archive'
+MAGIC = b'BIOMETAR'
+VERSION = 1
+# Values per chunk: ~85 days of half-hourly data
+CHUNK_RECORDS = 4096
+
+defaultArgs = {
+    'siteID':'BB',
+    'stage':'Third',
+    'years':[],
+    'database':'None',
+    'codec':'auto',
+}
+
+def get_codec(name):
+    # (compress, decompress) functions of a codec
+    if name == 'zlib':
+        return(lambda b: zlib.compress(b,6),zlib.decompress)
+    if name == 'zstd':
+        import zstandard
+        return(zstandard.ZstdCompressor(level=9).compress,zstandard.ZstdDecompressor().decompress)
+    if name == 'blosc':
+        import blosc
+        # The bytes are shuffled here, so blosc only compresses
+        return(lambda b: blosc.compress(b,typesize=1,cname='zstd',shuffle=blosc.NOSHUFFLE),blosc.decompress)
+    raise ValueError(f"Unknown codec {name}, use zlib, zstd or blosc")
+
+def default_codec():
+    try:
+        import zstandard
+        return('zstd')
+    except ImportError:
+        return('zlib')
+
+def shuffle(raw,itemsize):
+    # Groups the n-th bytes of all values together, e.g. the exponent bytes of floats, which compress well
+    if itemsize == 1:
+        return(raw)
+    return(np.frombuffer(raw,np.uint8).reshape(-1,itemsize).T.tobytes())
+
+def unshuffle(raw,itemsize):
+    if itemsize == 1:
+        return(raw)
+    return(np.frombuffer(raw,np.uint8).reshape(itemsize,-1).T.tobytes())
+
+def archive_path(folder):
+    return(folder.rstrip('/\\')+SUFFIX)
+
+# Indices of the archives read so far, by (path,size,mtime)
+_indices = {}
+_lock = threading.Lock()
+
+def read_index(archive):
+    stat = os.stat(archive)
+    key = (archive,stat.st_size,stat.st_mtime_ns)
+    with _lock:
+        if key in _indices:
+            return(_indices[key])
+    with open(archive,'rb') as f:
+        f.seek(-16,os.SEEK_END)
+        length,magic = struct.unpack('<Q8s',f.read(16))
+        if magic != MAGIC:
+            raise ValueError(f"{archive} is not a trace archive")
+        f.seek(-16-length,os.SEEK_END)
+        index = json.loads(f.read(length))
+    with _lock:
+        _indices[key] = index
+    return(index)
+
+def find(path):
+    # (archive, index, member) of a file packed in the archive of its folder
+    folder,name = os.path.split(str(path))
+    archive = archive_path(folder)
+    if os.path.isfile(archive):
+        index = read_index(archive)
+        if name in index['files']:
+            return(archive,index,index['files'][name])
+    raise FileNotFoundError(errno.ENOENT,os.strerror(errno.ENOENT),str(path))
+
+def exists(path):
+    # True if the file is in its folder or in the folder's archive
+    if os.path.isfile(path):
+        return(True)
+    try:
+        find(path)
+        return(True)
+    except FileNotFoundError:
+        return(False)
+
+def file_stat(path):
+    # [size, mtime_ns] of the file, or of the original file for an archived copy
+    try:
+        stat = os.stat(path)
+        return([stat.st_size,stat.st_mtime_ns])
+    except FileNotFoundError:
+        member = find(path)[2]
+        return([member['size'],member['mtime_ns']])
+
+def listdir(folder):
+    # Files in a folder and in its archive
+    names = set()
+    if os.path.isdir(folder):
+        names.update(f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder,f)))
+    if os.path.isfile(archive_path(folder)):
+        names.update(read_index(archive_path(folder))['files'])
+    return(sorted(names))
+
+def read_bytes(archive,index,member,first=0,last=None):
+    # Raw bytes [first,last) of an archived file, decompressing only the chunks they overlap
+    last = member['size'] if last is None else min(last,member['size'])
+    if last <= first:
+        return(b'')
+    decompress = get_codec(index['codec'])[1]
+    chunkBytes = index['chunkRecords']*member['itemsize']
+    c0,c1 = first//chunkBytes,(last-1)//chunkBytes
+    chunks = member['chunks'][c0:c1+1]
+    # The chunks are stored one after another, so they are read at once
+    with open(archive,'rb') as f:
+        f.seek(chunks[0][0])
+        block = f.read(chunks[-1][0]+chunks[-1][1]-chunks[0][0])
+    raw = b''.join(unshuffle(decompress(block[o-chunks[0][0]:o-chunks[0][0]+n]),member['itemsize']) for o,n in chunks)
+    return(raw[first-c0*chunkBytes:last-c0*chunkBytes])
+
+def read(path,dtype,rows=None):
+    # Values of a binary file, from its folder or its folder's archive
+    # rows (a slice) limits the values read, or decompressed, to part of the file
+    dtype = np.dtype(dtype)
+    path = str(path)
+    if os.path.isfile(path):
+        if rows is None:
+            return(np.fromfile(path,dtype))
+        start,stop,_ = rows.indices(os.path.getsize(path)//dtype.itemsize)
+        return(np.fromfile(path,dtype,count=max(stop-start,0),offset=start*dtype.itemsize))
+    archive,index,member = find(path)
+    start,stop,_ = (rows or slice(None)).indices(member['size']//dtype.itemsize)
+    return(np.frombuffer(bytearray(read_bytes(archive,index,member,start*dtype.itemsize,stop*dtype.itemsize)),dtype))
+
+def itemsize(name,size,config):
+    # Shuffle by the size of the values: 8 for the timestamps, 4 for float32 traces, bytes for anything else
+    if name == config['dbase_metadata']['timestamp']['name']:
+        n = np.dtype(config['dbase_metadata']['timestamp']['dtype']).itemsize
+    elif '.' in name:
+        n = 1
+    else:
+        n = np.dtype(config['dbase_metadata']['traces']['dtype']).itemsize
+    return(n if size % n == 0 else 1)
+
+def pack_folder(folder,config,codec='auto',chunkRecords=CHUNK_RECORDS,remove=True):
+    # Packs the files of folder (and those already in its archive) into its archive; returns the archive's index
+    codec = default_codec() if codec == 'auto' else codec
+    compress = get_codec(codec)[0]
+    archive = archive_path(folder)
+    old = read_index(archive) if os.path.isfile(archive) else {'files':{}}
+    loose = [f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder,f))] if os.path.isdir(folder) else []
+    index = {'version':VERSION,'codec':codec,'chunkRecords':chunkRecords,'packed':datetime.now().isoformat(timespec='seconds'),'files':{}}
+    tmp = archive+'.tmp'
+    with open(tmp,'wb') as f:
+        f.write(MAGIC)
+        for name in sorted(set(loose)|set(old['files'])):
+            if name in loose:
+                with open(os.path.join(folder,name),'rb') as src:
+                    raw = src.read()
+                stat = os.stat(os.path.join(folder,name))
+                mtime = stat.st_mtime_ns
+            else:
+                raw = read_bytes(archive,old,old['files'][name])
+                mtime = old['files'][name]['mtime_ns']
+            n = itemsize(name,len(raw),config)
+            member = {'size':len(raw),'mtime_ns':mtime,'itemsize':n,
+                      'digest':hashlib.blake2b(raw,digest_size=16).hexdigest(),'chunks':[]}
+            step = chunkRecords*n
+            for i in range(0,len(raw),step):
+                block = compress(shuffle(raw[i:i+step],n))
+                member['chunks'].append([f.tell(),len(block)])
+                f.write(block)
+            index['files'][name] = member
+        payload = json.dumps(index).encode()
+        f.write(payload)
+        f.write(struct.pack('<Q8s',len(payload),MAGIC))
+    # Check the new archive before anything is removed
+    for name,member in read_index(tmp)['files'].items():
+        if hashlib.blake2b(read_bytes(tmp,index,member),digest_size=16).hexdigest() != member['digest']:
+            os.remove(tmp)
+            raise IOError(f"Could not verify {name} in {archive}, nothing was changed")
+    os.replace(tmp,archive)
+    if remove:
+        for name in loose:
+            os.remove(os.path.join(folder,name))
+        if not os.listdir(folder):
+            os.rmdir(folder)
+    return(index)
+
+def unpack_folder(folder,keep=False):
+    # Writes the archived files back to folder (with their original mtimes); files already in folder are left as they are
+    archive = archive_path(folder)
+    index = read_index(archive)
+    os.makedirs(folder,exist_ok=True)
+    for name,member in index['files'].items():
+        path = os.path.join(folder,name)
+        if os.path.isfile(path):
+            continue
+        with open(path,'wb') as f:
+            f.write(read_bytes(archive,index,member))
+        os.utime(path,ns=(member['mtime_ns'],member['mtime_ns']))
+    if not keep:
+        os.remove(archive)
+    return(list(index['files']))
+
+def unpack_to_write(folder):
+    # Writers call this before writing to folder: a file written next to the archive would hide the archived copy,
+    # and replace it when the folder is packed again, so an archived folder is unpacked first
+    if os.path.isfile(archive_path(folder)):
+        print(f"Unpacking {archive_path(folder)} before writing to it")
+        unpack_folder(folder)
+
+def stage_folders(config,siteID,stage,years):
+    root = config['rootDir']['database']
+    stage = config['stage'].get(stage,stage)
+    if not years:
+        years = sorted(y for y in os.listdir(root) if y.isnumeric())
+    return({int(y):os.path.join(root,str(y),siteID,stage) for y in years})
+
+def pack(siteID,stage='Third',years=[],database=None,codec='auto'):
+    # Archives the stage folders of completed years (all available by default)
+    config = rCfg.set_user_configuration()
+    if database is not None:
+        config['rootDir']['database'] = database
+    packed = {}
+    for year,folder in stage_folders(config,siteID,stage,years).items():
+        if year >= datetime.now().year:
+            print(f"Skipping {folder}: only completed years are archived")
+            continue
+        if not os.path.isdir(folder):
+            continue
+        before = sum(os.path.getsize(os.path.join(folder,f)) for f in os.listdir(folder) if os.path.isfile(os.path.join(folder,f)))
+        index = pack_folder(folder,config,codec)
+        packed[year] = archive_path(folder)
+        print(f"Packed {folder}: {len(index['files'])} files, {before/1024**2:.1f} MB -> {os.path.getsize(packed[year])/1024**2:.1f} MB ({index['codec']})")
+    return(packed)
+
+def unpack(siteID,stage='Third',years=[],database=None,keep=False):
+    config = rCfg.set_user_configuration()
+    if database is not None:
+        config['rootDir']['database'] = database
+    unpacked = {}
+    for year,folder in stage_folders(config,siteID,stage,years).items():
+        if os.path.isfile(archive_path(folder)):
+            unpacked[year] = unpack_folder(folder,keep)
+            print(f"Unpacked {len(unpacked[year])} files to {folder}")
+    return(unpacked)
+
+def info(siteID,stage='Third',years=[],database=None):
+    config = rCfg.set_user_configuration()
+    if database is not None:
+        config['rootDir']['database'] = database
+    for year,folder in stage_folders(config,siteID,stage,years).items():
+        archive = archive_path(folder)
+        if os.path.isfile(archive):
+            index = read_index(archive)
+            size = sum(m['size'] for m in index['files'].values())
+            print(f"{archive}: {len(index['files'])} files, {size/1024**2:.1f} MB in {os.path.getsize(archive)/1024**2:.1f} MB ({index['codec']}, packed {index['packed']})")
+
+# If called from command line ...
+if __name__ == '__main__':
+
+    CLI=argparse.ArgumentParser()
+    CLI.add_argument("action",choices=['pack','unpack','info'])
+
+    for key,val in defaultArgs.items():
+        if type(val) == list:
+            CLI.add_argument(f"--{key}",nargs='+',type=str,default=val)
+        else:
+            CLI.add_argument(f"--{key}",nargs="?",type=type(val),default=val)
+    CLI.add_argument("--keep",action='store_true',help='unpack: keep the archive')
+
+    # parse the command line
+    args = CLI.parse_args()
+    database = None if args.database == 'None' else args.database
+    if args.action == 'pack':
+        pack(args.siteID,args.stage,args.years,database,args.codec)
+    elif args.action == 'unpack':
+        unpack(args.siteID,args.stage,args.years,database,args.keep)
+    else:
+        info(args.siteID,args.stage,args.years,database)
@@ -0,0 +1,225 @@
+# Precomputed daily, weekly and monthly aggregates (mean, min, max, count) of the traces in the binary database
+# Coarse views of long records (e.g., a decade of half-hourly data) can then be read from a few hundred values per trace
+# The aggregates are a sidecar store, kept out of the database folders used by the other tools:
+    # <database>/aggregates/<siteID>/<stage>/<YYYY>/<trace>.npz
+    # one file per trace-year with <level>_time (bin label, int64 ns) and <level>_mean/_min/_max/_count arrays
+    # <database>/aggregates/<siteID>/<stage>/<YYYY>/manifest.json holds the size and mtime of the source files
+# Updates are incremental: only traces whose year file changed since the last build are aggregated again
+# Bins follow pandas resampling of the database timestamps, so a bin spanning two year files (e.g., a week at new year)
+#   is merged from both years' partial aggregates when read
+    # daily and monthly bins start at their label
+    # weekly (W-SUN) bins are labelled by their last day, the Sunday, and pandas includes the whole of that day:
+    #   the bin labelled Sunday D runs from Monday 00:00 (D - 6 days) to the next Monday 00:00 (D + 1 day)
+
+# Example calls from command line:
+    # py tracePyramid.py --siteID BB --stage Third
+    # py tracePyramid.py --siteID BB --stage Second --years 2023 2024 --database C:/Database
+# From python:
+    # import tracePyramid as tp
+    # tp.build('BB','Third')
+    # df = tp.read('BB','Third','FC','daily',start='2015-01-01',end='2024-12-31')
+
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import readConfig as rCfg
+import traceArchive as ta
+
+# Levels, from finest to coarsest, and their pandas frequencies
+levels = {
+    'daily':'1D',
+    'weekly':'W-SUN',
+    'monthly':'MS',
+}
+stats = ['mean','min','max','count']
+
+defaultArgs = {
+    'siteID':'BB',
+    'stage':'Third',
+    'years':[],
+    'database':'None',
+    'traces':[],
+}
+
+def get_config(database=None):
+    config = rCfg.set_user_configuration()
+    if database is not None:
+        config['rootDir']['database'] = database
+    return(config)
+
+def stage_path(config,stage):
+    return(config['stage'].get(stage,stage))
+
+def source_folder(config,siteID,stage,year):
+    return(os.path.join(config['rootDir']['database'],str(year),siteID,stage_path(config,stage)))
+
+def pyramid_folder(config,siteID,stage,year):
+    return(os.path.join(config['rootDir']['database'],'aggregates',siteID,stage_path(config,stage).replace('\\','/'),str(year)))
+
+def read_manifest(folder):
+    try:
+        with open(os.path.join(folder,'manifest.json')) as f:
+            return(json.load(f))
+    except (FileNotFoundError,json.JSONDecodeError):
+        return({})
+
+def available_years(config,siteID,stage):
+    root = config['rootDir']['database']
+    ts = config['dbase_metadata']['timestamp']['name']
+    return([int(y) for y in sorted(os.listdir(root)) if y.isnumeric()
+            and ta.exists(os.path.join(source_folder(config,siteID,stage,y),ts))])
+
+def aggregate(index,values):
+    # All levels and statistics of a block of traces (DataFrame columns) in one resampling pass per level
+    df = pd.DataFrame(values,index=index)
+    out = {name:{} for name in df.columns}
+    for level,freq in levels.items():
+        agg = df.resample(freq).agg(stats)
+        time = agg.index.values.astype('datetime64[ns]').astype(np.int64)
+        for name in df.columns:
+            out[name][f"{level}_time"] = time
+            for stat in stats:
+                out[name][f"{level}_{stat}"] = agg[(name,stat)].values.astype(np.int32 if stat == 'count' else np.float32)
+    return(out)
+
+def build_year(config,siteID,stage,year,traces=None,force=False):
+    # Aggregates the traces of one year that changed since the last build, returns their names
+    src = source_folder(config,siteID,stage,year)
+    dest = pyramid_folder(config,siteID,stage,year)
+    ts = config['dbase_metadata']['timestamp']
+    manifest = read_manifest(dest)
+    tv_stat = ta.file_stat(os.path.join(src,ts['name']))
+    if force or manifest.get(ts['name']) != tv_stat:
+        # New timestamps invalidate every trace of the year
+        manifest = {ts['name']:tv_stat}
+    if traces is None:
+        traces = [f for f in ta.listdir(src) if f != ts['name'] and '.' not in f]
+    changed = [t for t in traces if ta.exists(os.path.join(src,t)) and manifest.get(t) != ta.file_stat(os.path.join(src,t))]
+    if not changed:
+        return([])
+    tv = ta.read(os.path.join(src,ts['name']),ts['dtype'])
+    index = pd.DatetimeIndex(pd.to_datetime(tv-ts['base'],unit=ts['base_unit']).round('s'))
+    dtype = config['dbase_metadata']['traces']['dtype']
+    values = {}
+    for t in changed:
+        v = ta.read(os.path.join(src,t),dtype)
+        if v.size != tv.size:
+            print(f"Skipping {src}/{t}: {v.size} values for {tv.size} timestamps")
+            continue
+        values[t] = v
+    os.makedirs(dest,exist_ok=True)
+    for name,arrays in aggregate(index,values).items():
+        np.savez(os.path.join(dest,f"{name}.npz"),**arrays)
+        manifest[name] = ta.file_stat(os.path.join(src,name))
+    tmp = os.path.join(dest,'manifest.json.tmp')
+    with open(tmp,'w') as f:
+        json.dump(manifest,f)
+    os.replace(tmp,os.path.join(dest,'manifest.json'))
+    return(list(values.keys()))
+
+def build(siteID,stage='Third',years=None,database=None,traces=None,force=False):
+    # Builds or updates the aggregates of a site and stage; returns {year: [updated traces]}
+    config = get_config(database)
+    years = [int(y) for y in years] if years else available_years(config,siteID,stage)
+    updated = {}
+    for year in years:
+        updated[year] = build_year(config,siteID,stage,year,traces or None,force)
+        print(f"{siteID} {stage} {year}: {len(updated[year])} traces updated")
+    return(updated)
+
+def is_current(config,siteID,stage,year,trace):
+    # True if the year's aggregates of trace were built from the current source files
+    src = source_folder(config,siteID,stage,year)
+    manifest = read_manifest(pyramid_folder(config,siteID,stage,year))
+    try:
+        return(manifest.get(config['dbase_metadata']['timestamp']['name']) == ta.file_stat(os.path.join(src,config['dbase_metadata']['timestamp']['name']))
+               and manifest.get(trace) == ta.file_stat(os.path.join(src,trace)))
+    except FileNotFoundError:
+        return(False)
+
+def bin_bounds(level,labels):
+    # [left,right) edges of the bins with these labels
+    offset = pd.tseries.frequencies.to_offset(levels[level])
+    if pd.Grouper(freq=levels[level]).closed == 'right':
+        # Labelled by their last day, included whole
+        day = pd.Timedelta(days=1)
+        return(labels-offset+day,labels+day)
+    return(labels,labels+offset)
+
+def is_bin_edge(level,time):
+    # True if one of the level's bins starts at time
+    offset = pd.tseries.frequencies.to_offset(levels[level])
+    time = pd.Timestamp(time)
+    label = time-pd.Timedelta(days=1) if pd.Grouper(freq=levels[level]).closed == 'right' else time
+    return(time == time.normalize() and offset.is_on_offset(label))
+
+def merge(parts):
+    # Combines the partial aggregates of bins split across year files
+    df = pd.concat(parts)
+    df['total'] = df['mean'].astype(float).fillna(0)*df['count']
+    g = df.groupby(level=0)
+    out = pd.DataFrame({'min':g['min'].min(),'max':g['max'].max(),'count':g['count'].sum()})
+    out['mean'] = (g['total'].sum()/out['count']).where(out['count']>0)
+    return(out[stats])
+
+def read(siteID,stage,trace,level,start=None,end=None,years=None,database=None,config=None,strict=False):
+    # DataFrame of mean/min/max/count indexed by bin label, of the bins that include any time from start to end
+    # The statistics are over the whole bins, also for bins only partly within start and end
+    # years default to those overlapping start/end
+    # strict=True raises an error if any year's aggregates are missing or out of date
+    config = config if config is not None else get_config(database)
+    if years is None:
+        years = available_years(config,siteID,stage)
+        # A bin starting in the requested range can include data from the previous or next year file
+        if start is not None:
+            years = [y for y in years if y >= pd.Timestamp(start).year-1]
+        if end is not None:
+            years = [y for y in years if y <= pd.Timestamp(end).year+1]
+    parts = []
+    for year in years:
+        if strict and not is_current(config,siteID,stage,year,trace):
+            raise FileNotFoundError(f"Aggregates of {siteID}/{stage}/{trace} for {year} are missing or out of date")
+        path = os.path.join(pyramid_folder(config,siteID,stage,year),f"{trace}.npz")
+        if not os.path.isfile(path):
+            continue
+        with np.load(path) as z:
+            parts.append(pd.DataFrame({s:z[f"{level}_{s}"] for s in stats},index=pd.DatetimeIndex(z[f"{level}_time"].astype('datetime64[ns]'),name='datetime')))
+    if not parts:
+        return(pd.DataFrame(columns=stats,index=pd.DatetimeIndex([],name='datetime')))
+    df = merge(parts)
+    left,right = bin_bounds(level,df.index)
+    keep = np.ones(len(df),dtype=bool)
+    if start is not None:
+        keep &= right > pd.Timestamp(start)
+    if end is not None:
+        keep &= left <= pd.Timestamp(end)
+    return(df.loc[keep])
+
+def match_level(freq):
+    # Name of the level that serves a pandas frequency string, or None
+    try:
+        offset = pd.tseries.frequencies.to_offset(freq)
+    except (ValueError,TypeError):
+        return(None)
+    for level,f in levels.items():
+        if offset == pd.tseries.frequencies.to_offset(f):
+            return(level)
+    return(None)
+
+# If called from command line ...
+if __name__ == '__main__':
+
+    CLI=argparse.ArgumentParser()
+
+    for key,val in defaultArgs.items():
+        if type(val) == list:
+            CLI.add_argument(f"--{key}",nargs='+',type=str,default=val)
+        else:
+            CLI.add_argument(f"--{key}",nargs="?",type=type(val),default=val)
+    CLI.add_argument("--force",action='store_true',help='rebuild even if the source files are unchanged')
+
+    # parse the command line
+    args = CLI.parse_args()
+    build(args.siteID,args.stage,args.years,None if args.database == 'None' else args.database,args.traces,args.force)
@@ -0,0 +1,359 @@
+# Read-only query service over the binary database, so dashboards (e.g., the R Shiny apps) request only what they show
+# Queries select a site, stage (aliases from config.yml), traces, time range and optional aggregation:
+    # GET /sites                                   -> {site: [years]}
+    # GET /traces?site=BB&stage=Third              -> [trace names]
+    # GET /query?site=BB&stage=Third&traces=FC,LE&start=2024-01-01&end=2024-12-31&freq=1D&agg=mean,max
+# Site, stage and trace names can only contain letters, digits, _ . and - (status 400 otherwise)
+# /query returns an Arrow IPC stream by default (needs pyarrow), or csv/json with &format=csv or &format=json
+    # first column is "datetime"; with more than one aggregation columns are named <trace>_<agg>
+# Year files are cached in memory (up to cacheMB) and re-read only when they change on disk
+# Archived years (see traceArchive.py) are read from the archive, decompressing only the part of the year requested
+# Daily, weekly (1D, W) and monthly (MS) mean/min/max/count queries over whole bins are served from the precomputed
+#   aggregates (see tracePyramid.py) when they are up to date, otherwise from the year files
+
+# Start the service from command line (only reachable from this machine):
+    # py traceQuery.py --port 8765
+    # py traceQuery.py --port 8765 --database C:/Database --cacheMB 1024
+# From R (with the arrow and httr packages):
+    # r <- httr::GET("http://127.0.0.1:8765/query?site=BB&stage=Third&traces=FC,LE&freq=1D")
+    # df <- arrow::read_ipc_stream(httr::content(r,"raw"))
+# From python, without the server (e.g., in tests or notebooks):
+    # import traceQuery as tq
+    # client = tq.localClient()
+    # df = client.query('BB',['FC','LE'],stage='Third',start='2024-01-01',end='2024-12-31',freq='1D',agg=['mean','max'])
+# Or against a running server:
+    # client = tq.httpClient('http://127.0.0.1:8765')
+
+import io
+import os
+import re
+import json
+import time
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+import readConfig as rCfg
+import tracePyramid as tp
+import traceArchive as ta
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs, urlencode
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+defaultArgs = {
+    'database':'None',
+    'port':8765,
+    'cacheMB':256,
+}
+
+formats = {
+    'arrow':'application/vnd.apache.arrow.stream',
+    'csv':'text/csv',
+    'json':'application/json',
+}
+
+# Site, stage and trace names in requests; anything else (e.g., ../) is rejected
+validName = re.compile(r'^[\w.-]+$')
+
+class traceStore():
+    # Reads (and caches) traces from Database/YYYY/SiteID/Stage/
+    def __init__(self,database=None,cacheMB=256,listingTTL=60,usePyramid=True):
+        self.config = rCfg.set_user_configuration()
+        self.root = database if database is not None else self.config['rootDir']['database']
+        self.config['rootDir']['database'] = self.root
+        self.usePyramid = usePyramid
+        self.cacheLimit = cacheMB*1024**2
+        self.cacheBytes = 0
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.listingTTL = listingTTL
+        self.listing = None
+
+    def stage_path(self,stage):
+        return(self.config['stage'].get(stage,stage))
+
+    def check_names(self,site,stage,traces=[]):
+        # Raises ValueError for names that aren't plain file names
+        for kind,name in [('site',site),('stage',stage)]+[('trace',t) for t in traces]:
+            if not isinstance(name,str) or not validName.match(name) or not name.strip('.'):
+                raise ValueError(f"Invalid {kind} name: {name!r}")
+
+    def path(self,year,site,stage,name=None):
+        # Database/YYYY/SiteID/Stage/(name), which has to be inside the database
+        self.check_names(site,stage,[name] if name is not None else [])
+        path = os.path.join(self.root,str(year),site,self.stage_path(stage),*([name] if name is not None else []))
+        root = os.path.abspath(self.root)
+        if os.path.commonpath([root,os.path.abspath(path)]) != root:
+            raise ValueError(f"Invalid path: {path} is outside the database")
+        return(path)
+
+    def sites(self):
+        # {site: [years]}, re-scanned at most every listingTTL seconds
+        with self.lock:
+            if self.listing is not None and time.monotonic()-self.listing[0] < self.listingTTL:
+                return(self.listing[1])
+        sites = {}
+        years = sorted(d for d in os.listdir(self.root) if d.isnumeric() and os.path.isdir(os.path.join(self.root,d)))
+        for year in years:
+            for site in sorted(os.listdir(os.path.join(self.root,year))):
+                if os.path.isdir(os.path.join(self.root,year,site)):
+                    sites.setdefault(site,[]).append(int(year))
+        with self.lock:
+            self.listing = (time.monotonic(),sites)
+        return(sites)
+
+    def years(self,site,stage,start=None,end=None):
+        self.check_names(site,stage)
+        ts = self.config['dbase_metadata']['timestamp']['name']
+        years = [y for y in self.sites().get(site,[])
+                 if ta.exists(self.path(y,site,stage,ts))]
+        # Each year's files end with Jan 1 00:00 of the next year
+        if start is not None:
+            first = pd.Timestamp(start)-pd.Timedelta(self.config['dbase_metadata']['timestamp']['resolution'])
+            years = [y for y in years if y >= first.year]
+        if end is not None:
+            years = [y for y in years if y <= pd.Timestamp(end).year]
+        return(years)
+
+    def traces(self,site,stage='Third'):
+        names = set()
+        for year in self.years(site,stage):
+            names.update(ta.listdir(self.path(year,site,stage)))
+        names.discard(self.config['dbase_metadata']['timestamp']['name'])
+        return(sorted(n for n in names if not n.startswith('.') and '.' not in n))
+
+    def read(self,site,stage,year,name,dtype,rows=None,size=None):
+        # One year file (or the rows of it), from the cache while unchanged on disk
+        # None if it doesn't exist, or if it doesn't hold size values
+        path = self.path(year,site,stage,name)
+        try:
+            stat = ta.file_stat(path)
+        except FileNotFoundError:
+            return(None)
+        if size is not None and stat[0] != size*np.dtype(dtype).itemsize:
+            return(None)
+        key = (path,*stat,(rows.start,rows.stop) if rows is not None else None)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return(self.cache[key])
+        values = ta.read(path,dtype,rows)
+        values.flags.writeable = False
+        with self.lock:
+            self.cache[key] = values
+            self.cacheBytes += values.nbytes
+            while self.cache and self.cacheBytes > self.cacheLimit:
+                self.cacheBytes -= self.cache.popitem(last=False)[1].nbytes
+        return(values)
+
+    def query(self,site,traces,stage='Third',start=None,end=None,freq=None,agg=['mean']):
+        # DataFrame indexed by datetime, one column per trace (or per trace and aggregation)
+        if isinstance(traces,str):
+            traces = traces.split(',')
+        if isinstance(agg,str):
+            agg = agg.split(',')
+        self.check_names(site,stage,traces)
+        if freq is not None and self.usePyramid:
+            df = self.query_pyramid(site,traces,stage,start,end,freq,agg)
+            if df is not None:
+                return(df)
+        ts = self.config['dbase_metadata']['timestamp']
+        dtype = self.config['dbase_metadata']['traces']['dtype']
+        times,data = [],{t:[] for t in traces}
+        for year in self.years(site,stage,start,end):
+            tv = self.read(site,stage,year,ts['name'],ts['dtype'])
+            rows = self.rows(tv,start,end)
+            times.append(tv[rows] if rows is not None else tv)
+            for t in traces:
+                values = self.read(site,stage,year,t,dtype,rows,size=tv.size)
+                # Missing (or mismatched) traces are NaN for that year
+                data[t].append(values if values is not None else np.full(times[-1].size,np.nan,dtype=dtype))
+        if not times:
+            return(pd.DataFrame(columns=traces,index=pd.DatetimeIndex([],name='datetime')))
+        tv = np.concatenate(times)
+        index = pd.DatetimeIndex(pd.to_datetime(tv-ts['base'],unit=ts['base_unit']).round('s'),name='datetime')
+        df = pd.DataFrame({t:np.concatenate(v) for t,v in data.items()},index=index)
+        if freq is not None:
+            df = df.resample(freq).agg(agg)
+            if len(agg) == 1:
+                df.columns = df.columns.get_level_values(0)
+            else:
+                df.columns = [f"{t}_{a}" for t,a in df.columns]
+        return(df)
+
+    def rows(self,tv,start,end):
+        # Slice of a year's timestamps between start and end, None for the whole year
+        ts = self.config['dbase_metadata']['timestamp']
+        index = pd.DatetimeIndex(pd.to_datetime(tv-ts['base'],unit=ts['base_unit']).round('s'))
+        first = index.searchsorted(pd.Timestamp(start)) if start is not None else 0
+        last = index.searchsorted(pd.Timestamp(end),side='right') if end is not None else tv.size
+        return(None if (first,last) == (0,tv.size) else slice(first,last))
+
+    def query_pyramid(self,site,traces,stage,start,end,freq,agg):
+        # Same result as query() from the precomputed aggregates, or None if they can't serve the query
+        level = tp.match_level(freq)
+        if level is None or not set(agg) <= set(tp.stats):
+            return(None)
+        # Only whole bins match resampling the selected raw values: [start,end+resolution) has to start and end on bin edges
+        #   (weekly bins start on Mondays, see tracePyramid.py)
+        offset = pd.tseries.frequencies.to_offset(tp.levels[level])
+        resolution = pd.Timedelta(self.config['dbase_metadata']['timestamp']['resolution'])
+        for edge in [pd.Timestamp(start) if start is not None else None,
+                     pd.Timestamp(end)+resolution if end is not None else None]:
+            if edge is not None and not tp.is_bin_edge(level,edge):
+                return(None)
+        try:
+            levels = {t:tp.read(site,stage,t,level,start,end,config=self.config,strict=True) for t in traces}
+        except FileNotFoundError:
+            return(None)
+        index = pd.DatetimeIndex(sorted(set().union(*[df.index for df in levels.values()])),name='datetime')
+        if len(index):
+            index = pd.date_range(index[0],index[-1],freq=offset,name='datetime')
+        columns = {}
+        for t,df in levels.items():
+            df = df.reindex(index)
+            df['count'] = df['count'].fillna(0).astype(np.int64)
+            for a in agg:
+                columns[t if len(agg) == 1 else f"{t}_{a}"] = df[a].values
+        return(pd.DataFrame(columns,index=index))
+
+def encode(df,fmt='arrow'):
+    # DataFrame -> payload bytes, with the datetime index as the first column
+    df = df.reset_index()
+    if fmt == 'arrow':
+        import pyarrow as pa
+        table = pa.Table.from_pandas(df,preserve_index=False)
+        sink = io.BytesIO()
+        with pa.ipc.new_stream(sink,table.schema) as writer:
+            writer.write_table(table)
+        return(sink.getvalue())
+    if fmt == 'csv':
+        return(df.to_csv(index=False,date_format='%Y-%m-%d %H:%M:%S').encode())
+    if fmt == 'json':
+        return(df.to_json(orient='split',index=False,date_format='iso').encode())
+    raise ValueError(f"Unknown format {fmt}, use one of {list(formats)}")
+
+def decode(payload,fmt='arrow'):
+    if fmt == 'arrow':
+        import pyarrow as pa
+        df = pa.ipc.open_stream(payload).read_pandas()
+    elif fmt == 'csv':
+        df = pd.read_csv(io.BytesIO(payload),parse_dates=['datetime'])
+    else:
+        df = pd.read_json(io.BytesIO(payload),orient='split',convert_dates=['datetime'])
+    return(df.set_index('datetime'))
+
+def default_format():
+    # Arrow when pyarrow is installed, csv otherwise
+    try:
+        import pyarrow
+        return('arrow')
+    except ImportError:
+        return('csv')
+
+def parse_query(params):
+    # Query string -> traceStore.query arguments
+    get = lambda key,default=None: params[key][0] if key in params else default
+    return({
+        'site':get('site'),
+        'traces':get('traces','').split(','),
+        'stage':get('stage','Third'),
+        'start':get('start'),
+        'end':get('end'),
+        'freq':get('freq'),
+        'agg':get('agg','mean').split(','),
+    })
+
+class queryHandler(BaseHTTPRequestHandler):
+    store = None
+
+    def reply(self,status,body,contentType='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type',contentType)
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        try:
+            if url.path == '/sites':
+                self.reply(200,json.dumps(self.store.sites()).encode())
+            elif url.path == '/traces':
+                self.reply(200,json.dumps(self.store.traces(params['site'][0],params.get('stage',['Third'])[0])).encode())
+            elif url.path == '/query':
+                fmt = params.get('format',[default_format()])[0]
+                df = self.store.query(**parse_query(params))
+                self.reply(200,encode(df,fmt),formats[fmt])
+            else:
+                self.reply(404,json.dumps({'error':f"Unknown path {url.path}"}).encode())
+        except Exception as e:
+            self.reply(400,json.dumps({'error':f"{type(e).__name__}: {e}"}).encode())
+
+def serve(**kwargs):
+    kwargs = defaultArgs | kwargs
+    handler = type('handler',(queryHandler,),{'store':traceStore(
+        database=None if kwargs['database'] == 'None' else kwargs['database'],cacheMB=kwargs['cacheMB'])})
+    # Bound to the loopback interface: not reachable from other machines
+    server = ThreadingHTTPServer(('127.0.0.1',kwargs['port']),handler)
+    print(f"Serving {handler.store.root} on http://127.0.0.1:{kwargs['port']}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+class localClient():
+    # Stand-in for httpClient that queries a traceStore in this process, through the same payload encoding
+    def __init__(self,store=None,fmt=None,**kwargs):
+        self.store = store if store is not None else traceStore(**kwargs)
+        self.fmt = fmt or default_format()
+
+    def sites(self):
+        return(self.store.sites())
+
+    def traces(self,site,stage='Third'):
+        return(self.store.traces(site,stage))
+
+    def query(self,site,traces,**kwargs):
+        return(decode(encode(self.store.query(site,traces,**kwargs),self.fmt),self.fmt))
+
+class httpClient():
+    def __init__(self,url='http://127.0.0.1:8765',fmt=None):
+        self.url = url.rstrip('/')
+        self.fmt = fmt or default_format()
+
+    def get(self,path,params={}):
+        from urllib.request import urlopen
+        from urllib.error import HTTPError
+        try:
+            with urlopen(f"{self.url}{path}?{urlencode(params)}") as response:
+                return(response.read())
+        except HTTPError as e:
+            raise RuntimeError(json.loads(e.read()).get('error',str(e)))
+
+    def sites(self):
+        return(json.loads(self.get('/sites')))
+
+    def traces(self,site,stage='Third'):
+        return(json.loads(self.get('/traces',{'site':site,'stage':stage})))
+
+    def query(self,site,traces,stage='Third',start=None,end=None,freq=None,agg=['mean']):
+        params = {'site':site,'traces':','.join([traces] if isinstance(traces,str) else traces),'stage':stage,
+                  'agg':','.join([agg] if isinstance(agg,str) else agg),'format':self.fmt}
+        params.update({k:v for k,v in {'start':start,'end':end,'freq':freq}.items() if v is not None})
+        return(decode(self.get('/query',params),self.fmt))
+
+# If called from command line ...
+if __name__ == '__main__':
+
+    CLI=argparse.ArgumentParser()
+
+    for key,val in defaultArgs.items():
+        CLI.add_argument(f"--{key}",nargs="?",type=type(val),default=val)
+
+    # parse the command line
+    args = CLI.parse_args()
+    serve(**vars(args))
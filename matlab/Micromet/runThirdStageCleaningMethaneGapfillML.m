@@ -16,13 +16,17 @@ function fidLog = runThirdStageCleaningMethaneGapfillML(yearIn,siteID,TrainFill)
     
     pythonPath = findBiometPythonPath;
     scriptPath = fullfile(pythonPath, 'methaneGapfillML.py');
+    % runs the script in the Biomet python service if one is running (see biometService.py),
+    % otherwise runs it directly; the client authenticates with the user's key in
+    % ~/.biomet/service_key, so only the user's own service is used
+    clientPath = fullfile(pythonPath, 'biometService.py');
     databasePath = findDatabasePath;
     if TrainFill == 1
-        command = sprintf('python "%s" --site %s --year %s --db_path %s --mode %s', ...
-                          scriptPath, siteID, num2str(yearIn), databasePath, 'full');
+        command = sprintf('python "%s" run "%s" --site %s --year %s --db_path %s --mode %s', ...
+                          clientPath, scriptPath, siteID, num2str(yearIn), databasePath, 'full');
     elseif TrainFill == 0
-        command = sprintf('python "%s" --site %s --year %s --db_path %s --mode %s', ...
-                          scriptPath, siteID, num2str(yearIn), databasePath, 'gapfill');
+        command = sprintf('python "%s" run "%s" --site %s --year %s --db_path %s --mode %s', ...
+                          clientPath, scriptPath, siteID, num2str(yearIn), databasePath, 'gapfill');
     end
     status = system(command, '-echo');
    